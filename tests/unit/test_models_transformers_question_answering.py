@@ -3,12 +3,18 @@
 
 import pytest
 import os
-from utils_nlp.models.transformers.datasets import QADataset
+import numpy as np
+from utils_nlp.models.transformers.datasets import QADataset, QAInput
 from utils_nlp.models.transformers.question_answering import (
     QAProcessor,
     AnswerExtractor,
+    QAPredictions,
+    QAResult,
     CACHED_EXAMPLES_TEST_FILE,
     CACHED_FEATURES_TEST_FILE,
+    _compute_softmax,
+    _featurize_chunk,
+    _get_best_indexes,
 )
 
 import torch
@@ -171,6 +177,110 @@ def test_QAProcessor(qa_test_data, tmp):
         qa_processor.preprocess(qa_test_data["train_dataset_multi_answers"], is_training=True)
 
 
+def test_QAProcessor_parallel(qa_test_data, tmp):
+    qa_processor = QAProcessor()
+    for is_training, dataset in [
+        (True, qa_test_data["train_dataset"]),
+        (False, qa_test_data["test_dataset"]),
+    ]:
+        outputs = []
+        for num_workers in [1, 2]:
+            cache_dir = os.path.join(tmp, "workers_{}".format(num_workers))
+            dataloader = qa_processor.preprocess(
+                dataset,
+                is_training=is_training,
+                max_question_length=16,
+                max_seq_length=64,
+                doc_stride=32,
+                feature_cache_dir=cache_dir,
+                num_workers=num_workers,
+            )
+            files = []
+            for root, _, names in sorted(os.walk(cache_dir)):
+                for name in sorted(names):
+                    with open(os.path.join(root, name), "rb") as f:
+                        files.append(f.read())
+            outputs.append((dataloader.dataset.tensors, files))
+        (serial_tensors, serial_files), (parallel_tensors, parallel_files) = outputs
+        assert serial_files == parallel_files
+        for serial, parallel in zip(serial_tensors, parallel_tensors):
+            assert torch.equal(serial, parallel)
+
+
+def test_QAProcessor_shared_documents(qa_test_df):
+    qa_processor = QAProcessor()
+    df = qa_test_df["test_df"]
+    doc_text = df["doc_text"][1]
+    # questions on the same document, interleaved with a question on another document
+    qa_inputs = [
+        QAInput(doc_text, df["question_text"][1], "1", False, 515, "Saint Bernadette Soubirous"),
+        QAInput(df["doc_text"][0], df["question_text"][0], "2", False, 24, "blue"),
+        QAInput(doc_text, "What is atop the Main Building?", "3", False, 94, "golden statue"),
+        QAInput(doc_text, "What is the Grotto?", "4", False, 381, "a Marian place of prayer"),
+    ]
+    for is_training in [True, False]:
+        featurize_args = {
+            "model_type": qa_processor.model_type,
+            "tokenizer": qa_processor.tokenizer,
+            "is_training": is_training,
+            "max_question_length": 16,
+            "max_seq_length": 64,
+            "doc_stride": 32,
+            "custom_tokenize": None,
+        }
+        qa_examples, features = _featurize_chunk(qa_inputs, **featurize_args)
+        for example_index, qa_input in enumerate(qa_inputs):
+            expected_examples, expected_features = _featurize_chunk([qa_input], **featurize_args)
+            assert qa_examples[example_index] == expected_examples[0]
+            example_features = [f for f in features if f["example_index"] == example_index]
+            assert len(example_features) == len(expected_features)
+            for feature, expected in zip(example_features, expected_features):
+                for key in expected:
+                    if key not in ["unique_id", "example_index"]:
+                        assert feature[key] == expected[key]
+
+
+def test_QAProcessor_preprocessing_cache(qa_test_df, qa_test_data, tmp):
+    qa_processor = QAProcessor()
+    cache_file = os.path.join(tmp, "qa_preprocessing_cache.db")
+    preprocess_args = {
+        "is_training": False,
+        "max_question_length": 16,
+        "max_seq_length": 64,
+        "doc_stride": 32,
+    }
+    expected = qa_processor.preprocess(
+        qa_test_data["test_dataset"],
+        feature_cache_dir=os.path.join(tmp, "no_cache"),
+        **preprocess_args
+    )
+
+    # new documents and questions, cached documents and questions, new questions only
+    df = qa_test_df["test_df"]
+    new_question_df = df.assign(question_text=df["question_text"] + " Really?")
+    for test_df in [df, df, new_question_df]:
+        dataset = QADataset(
+            df=test_df,
+            doc_text_col=qa_test_df["doc_text_col"],
+            question_text_col=qa_test_df["question_text_col"],
+            qa_id_col=qa_test_df["qa_id_col"],
+        )
+        dataloader = qa_processor.preprocess(
+            dataset,
+            feature_cache_dir=os.path.join(tmp, "cache"),
+            preprocessing_cache_file=cache_file,
+            **preprocess_args
+        )
+        if test_df is df:
+            for cached, serial in zip(dataloader.dataset.tensors, expected.dataset.tensors):
+                assert torch.equal(cached, serial)
+    expected = qa_processor.preprocess(
+        dataset, feature_cache_dir=os.path.join(tmp, "no_cache"), **preprocess_args
+    )
+    for cached, serial in zip(dataloader.dataset.tensors, expected.dataset.tensors):
+        assert torch.equal(cached, serial)
+
+
 def test_AnswerExtractor(qa_test_data, tmp):
     # test bert
     qa_extractor_bert = AnswerExtractor(cache_dir=tmp)
@@ -193,6 +303,46 @@ def test_AnswerExtractor(qa_test_data, tmp):
     qa_extractor_distilbert.predict(qa_test_data["test_features_distilbert"])
 
 
+def test_get_best_indexes():
+    logits = np.array([[0.1, 0.5, -1.0, 0.5, 2.0], [3.0, 2.0, 1.0, 0.0, -1.0]])
+    # ties are ordered by index
+    assert _get_best_indexes(logits, 3).tolist() == [[4, 1, 3], [0, 1, 2]]
+    assert _get_best_indexes(logits, 10).tolist() == [[4, 1, 3, 0, 2], [0, 1, 2, 3, 4]]
+    # the n-best boundary falls inside a tie, the lowest tied indexes are kept
+    tied = np.array([[1.0, 2.0, 1.0, 1.0, 1.0, 0.5, 1.0]], dtype=np.float16)
+    assert _get_best_indexes(tied, 3).tolist() == [[1, 0, 2]]
+    rows = np.random.RandomState(0).randint(0, 4, size=(100, 20)).astype(np.float16)
+    expected = [
+        [i for i, _ in sorted(enumerate(row), key=lambda x: x[1], reverse=True)][:5]
+        for row in rows
+    ]
+    assert _get_best_indexes(rows, 5).tolist() == expected
+    assert _compute_softmax([]) == []
+    assert np.allclose(_compute_softmax([1000.0, 1000.0, -np.inf]), [0.5, 0.5, 0.0])
+
+
+def test_QAPredictions(tmp):
+    results = [
+        QAResult(unique_id=1000000004, start_logits=[0.5, 1.0], end_logits=[1.5, -1.0]),
+        QAResult(unique_id=1000000002, start_logits=[2.0, 0.0], end_logits=[0.0, 2.0]),
+    ]
+    predictions = QAPredictions.from_results(results)
+    assert QAPredictions.from_results(predictions) is predictions
+    assert predictions.arrays["start_logits"].shape == (2, 2)
+    assert list(predictions) == results
+    assert predictions.index_of([1000000002, 1000000004]).tolist() == [1, 0]
+    with pytest.raises(KeyError):
+        predictions.index_of([1000000006])
+
+    predictions = QAPredictions.concatenate([predictions, predictions.take([1])])
+    assert list(predictions) == results + results[1:]
+
+    predictions.save(os.path.join(tmp, "predictions"))
+    loaded = QAPredictions.load(os.path.join(tmp, "predictions"))
+    assert sorted(loaded.arrays) == ["end_logits", "start_logits"]
+    assert list(loaded) == list(predictions)
+
+
 def test_postprocess_bert_answer(qa_test_data, tmp):
     qa_processor = QAProcessor()
     test_features = qa_processor.preprocess(
@@ -205,6 +355,8 @@ def test_postprocess_bert_answer(qa_test_data, tmp):
     )
     qa_extractor = AnswerExtractor(cache_dir=tmp)
     predictions = qa_extractor.predict(test_features)
+    assert len(predictions) == len(test_features.dataset)
+    assert predictions.arrays["start_logits"].dtype == np.float32
 
     qa_processor.postprocess(
         results=predictions,
@@ -220,6 +372,15 @@ def test_postprocess_bert_answer(qa_test_data, tmp):
         verbose_logging=True,
     )
 
+    # compact predictions
+    predictions = qa_extractor.predict(test_features, logits_dtype=np.float16)
+    assert predictions.arrays["end_logits"].dtype == np.float16
+    qa_processor.postprocess(
+        results=predictions,
+        examples_file=os.path.join(tmp, CACHED_EXAMPLES_TEST_FILE),
+        features_file=os.path.join(tmp, CACHED_FEATURES_TEST_FILE),
+    )
+
 
 def test_postprocess_xlnet_answer(qa_test_data, tmp):
     qa_processor = QAProcessor(model_name="xlnet-base-cased")
@@ -247,3 +408,93 @@ def test_postprocess_xlnet_answer(qa_test_data, tmp):
         unanswerable_exists=True,
         verbose_logging=True,
     )
+
+    # only the 3 x 2 best spans of the beam search are stored
+    predictions = qa_extractor.predict(test_features, n_top_start=3, n_top_end=2)
+    assert predictions.arrays["start_top_index"].shape == (len(test_features.dataset), 3)
+    assert predictions.arrays["end_top_index"].shape == (len(test_features.dataset), 6)
+    qa_processor.postprocess(
+        results=predictions,
+        examples_file=os.path.join(tmp, CACHED_EXAMPLES_TEST_FILE),
+        features_file=os.path.join(tmp, CACHED_FEATURES_TEST_FILE),
+    )
+
+
+def test_postprocess_stream(qa_test_data, tmp):
+    for model_name in ["bert-base-cased", "xlnet-base-cased"]:
+        qa_processor = QAProcessor(model_name=model_name)
+        test_features = qa_processor.preprocess(
+            qa_test_data["test_dataset"],
+            batch_size=1,
+            is_training=False,
+            max_question_length=16,
+            max_seq_length=64,
+            doc_stride=32,
+            feature_cache_dir=tmp,
+        )
+        qa_extractor = AnswerExtractor(model_name=model_name, cache_dir=tmp)
+        examples_file = os.path.join(tmp, CACHED_EXAMPLES_TEST_FILE)
+        features_file = os.path.join(tmp, CACHED_FEATURES_TEST_FILE)
+
+        result_batches = list(qa_extractor.predict_stream(test_features))
+        assert len(result_batches) == len(test_features)
+        final_answers, answer_probs, nbest_answers = qa_processor.postprocess(
+            results=[r for results in result_batches for r in results],
+            examples_file=examples_file,
+            features_file=features_file,
+        )
+
+        # the results may arrive in any order
+        answers = list(
+            qa_processor.postprocess_stream(
+                reversed(result_batches), examples_file=examples_file, features_file=features_file
+            )
+        )
+        assert [a.qa_id for a in answers] == list(final_answers)
+        for answer in answers:
+            assert answer.text == final_answers[answer.qa_id]
+            assert answer.probability == answer_probs[answer.qa_id]
+            assert answer.nbest == nbest_answers[answer.qa_id]
+
+        with pytest.raises(ValueError):
+            list(
+                qa_processor.postprocess_stream(
+                    result_batches[:-1], examples_file=examples_file, features_file=features_file
+                )
+            )
+
+
+def test_postprocess_parallel(qa_test_data, tmp):
+    for model_name in ["bert-base-cased", "xlnet-base-cased"]:
+        qa_processor = QAProcessor(model_name=model_name)
+        test_features = qa_processor.preprocess(
+            qa_test_data["test_dataset"],
+            is_training=False,
+            max_question_length=16,
+            max_seq_length=64,
+            doc_stride=32,
+            feature_cache_dir=tmp,
+        )
+        qa_extractor = AnswerExtractor(model_name=model_name, cache_dir=tmp)
+        predictions = qa_extractor.predict(test_features)
+
+        outputs = []
+        for num_workers in [1, 2]:
+            output_dir = os.path.join(tmp, "workers_{}".format(num_workers))
+            os.makedirs(output_dir, exist_ok=True)
+            qa_processor.postprocess(
+                results=predictions,
+                examples_file=os.path.join(tmp, CACHED_EXAMPLES_TEST_FILE),
+                features_file=os.path.join(tmp, CACHED_FEATURES_TEST_FILE),
+                unanswerable_exists=True,
+                output_prediction_file=os.path.join(output_dir, "qa_predictions.json"),
+                output_nbest_file=os.path.join(output_dir, "nbest_predictions.json"),
+                output_null_log_odds_file=os.path.join(output_dir, "null_odds.json"),
+                num_workers=num_workers,
+            )
+            files = []
+            for name in sorted(os.listdir(output_dir)):
+                with open(os.path.join(output_dir, name)) as f:
+                    files.append(f.read())
+            outputs.append(files)
+        assert outputs[0] == outputs[1]
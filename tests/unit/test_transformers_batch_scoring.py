@@ -0,0 +1,115 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import socket
+import time
+
+import pandas as pd
+import pytest
+
+from utils_nlp.models.transformers.batch_scoring import (
+    _claim,
+    _remove_stale_lock,
+    plan_shards,
+    read_shard,
+    score_files,
+)
+
+
+@pytest.fixture()
+def input_files(tmpdir):
+    df = pd.DataFrame(
+        {"id": range(10), "text": ["hi", "hello", "what's wrong", "can I leave?", "ok"] * 2}
+    )
+    csv_file = os.path.join(str(tmpdir), "part_0.csv")
+    jsonl_file = os.path.join(str(tmpdir), "part_1.jsonl")
+    df.iloc[:7].to_csv(csv_file, index=False)
+    df.iloc[7:].to_json(jsonl_file, orient="records", lines=True)
+    return [csv_file, jsonl_file]
+
+
+def test_plan_shards(input_files):
+    shards = plan_shards(input_files, shard_size=3)
+    assert [s["num_rows"] for s in shards] == [3, 3, 1, 3]
+    assert [s["shard"] for s in shards] == [0, 1, 2, 3]
+    ids = pd.concat([read_shard(s) for s in shards])["id"].tolist()
+    assert ids == list(range(10))
+
+
+def test_plan_shards_csv_records(tmpdir):
+    csv_file = os.path.join(str(tmpdir), "multiline.csv")
+    with open(csv_file, "w") as f:
+        f.write('id,text\n\n0,"two\nlines"\n1,"say ""hi""\n\n"\n\n2,plain\n3,"a,b"\n4,last\n')
+    shards = plan_shards([csv_file], shard_size=2)
+    assert [s["num_rows"] for s in shards] == [2, 2, 1]
+    with open(csv_file, "rb") as f:
+        data = f.read()
+    assert [data[s["offset"] :].split(b",")[0] for s in shards] == [b"0", b"2", b"4"]
+    df = pd.concat([read_shard(s) for s in shards])
+    assert df["id"].tolist() == list(range(5))
+    assert df["text"].tolist() == ["two\nlines", 'say "hi"\n\n', "plain", "a,b", "last"]
+
+
+def test_claim_stale_lock(tmpdir):
+    lock_file = os.path.join(str(tmpdir), "shard_000000.lock")
+    with open(lock_file, "w") as f:
+        f.write("other-host 1")
+    old = time.time() - 100
+    os.utime(lock_file, (old, old))
+    assert not _claim(lock_file, lock_timeout=None)
+    assert _claim(lock_file, lock_timeout=10)
+    with open(lock_file) as f:
+        assert f.read() == "{0} {1}".format(socket.gethostname(), os.getpid())
+
+    # a lock claimed again by another process since it was found stale is put back
+    stale_stat = os.stat(lock_file)
+    os.remove(lock_file)
+    with open(lock_file, "w") as f:
+        f.write("other-host 2")
+    os.utime(lock_file, (old + 1, old + 1))
+    assert not _remove_stale_lock(lock_file, stale_stat)
+    with open(lock_file) as f:
+        assert f.read() == "other-host 2"
+    assert os.listdir(str(tmpdir)) == ["shard_000000.lock"]
+
+
+def test_score_files_no_rows(tmpdir):
+    csv_file = os.path.join(str(tmpdir), "empty.csv")
+    with open(csv_file, "w") as f:
+        f.write("id,text\n")
+    with pytest.raises(ValueError):
+        score_files([csv_file], os.path.join(str(tmpdir), "scores"), "distilbert-base-uncased")
+
+
+@pytest.mark.cpu
+def test_score_files(input_files, tmpdir):
+    output_dir = os.path.join(str(tmpdir), "scores")
+    merged_file = score_files(
+        input_files,
+        output_dir,
+        model_name="distilbert-base-uncased",
+        keep_cols=["id"],
+        cache_dir=str(tmpdir),
+        max_len=16,
+        batch_size=2,
+        shard_size=3,
+        num_workers=2,
+        num_gpus=0,
+    )
+    merged = pd.read_csv(merged_file)
+    assert merged["id"].tolist() == list(range(10))
+    assert merged["prediction"].isin([0, 1]).all()
+
+    # a rerun only merges the completed shards again
+    os.remove(merged_file)
+    assert score_files(
+        input_files,
+        output_dir,
+        model_name="distilbert-base-uncased",
+        keep_cols=["id"],
+        cache_dir=str(tmpdir),
+        shard_size=3,
+        num_gpus=0,
+    ) == merged_file
+    assert pd.read_csv(merged_file).equals(merged)
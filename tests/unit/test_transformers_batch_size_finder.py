@@ -0,0 +1,81 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from utils_nlp.models.transformers.batch_size_finder import find_max_batch_size
+
+
+class _Classifier(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embeddings = nn.Embedding(100, 8)
+        self.classifier = nn.Linear(8, 2)
+
+    def forward(self, input_ids, attention_mask, labels=None):
+        logits = self.classifier(self.embeddings(input_ids).mean(dim=1))
+        if labels is None:
+            return (logits,)
+        return (nn.functional.cross_entropy(logits, labels), logits)
+
+
+class _SmallMemoryClassifier(_Classifier):
+    def forward(self, input_ids, attention_mask, labels=None):
+        if input_ids.size(0) > 3:
+            raise RuntimeError(
+                "[enforce fail at CPUAllocator.cpp:64] . DefaultCPUAllocator: can't allocate "
+                "memory: you tried to allocate 1073741824 bytes."
+            )
+        if input_ids.size(0) > 2:
+            raise MemoryError()
+        return super().forward(input_ids, attention_mask, labels)
+
+
+class _Transformer:
+    model_name = "bert-base-cased"
+
+    def __init__(self, model=None):
+        self.model = _Classifier() if model is None else model
+
+
+def _get_inputs(batch, model_name, train_mode=True):
+    inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
+    if train_mode:
+        inputs["labels"] = batch[2]
+    return inputs
+
+
+def test_find_max_batch_size():
+    input_ids = torch.randint(1, 100, (4, 16))
+    dataloader = DataLoader(
+        TensorDataset(input_ids, torch.ones_like(input_ids), torch.tensor([0, 1, 0, 1])),
+        batch_size=2,
+    )
+    transformer = _Transformer()
+
+    config = find_max_batch_size(
+        transformer, dataloader, _get_inputs, max_len=32, max_batch_size=8, train=False
+    )
+    assert config["batch_size"] == 8
+    assert config["gradient_accumulation_steps"] == 1
+    assert config["peak_memory"] <= config["memory_limit"]
+
+    config = find_max_batch_size(
+        transformer, dataloader, _get_inputs, max_len=32, max_batch_size=4, target_batch_size=10
+    )
+    assert config["gradient_accumulation_steps"] == 3
+    assert config["batch_size"] == 4
+    assert config["effective_batch_size"] >= 10
+
+
+def test_find_max_batch_size_cpu_out_of_memory():
+    input_ids = torch.randint(1, 100, (4, 16))
+    dataloader = DataLoader(TensorDataset(input_ids, torch.ones_like(input_ids)), batch_size=2)
+    transformer = _Transformer(_SmallMemoryClassifier())
+
+    config = find_max_batch_size(
+        transformer, dataloader, _get_inputs, max_len=32, max_batch_size=8, train=False
+    )
+    assert config["batch_size"] == 2
@@ -0,0 +1,113 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+
+import pandas as pd
+import pytest
+
+from utils_nlp.models.transformers.checkpoint_evaluation import (
+    evaluate_classifier_checkpoints,
+    evaluate_qa_checkpoints,
+)
+from utils_nlp.models.transformers.datasets import QADataset
+from utils_nlp.models.transformers.question_answering import (
+    CACHED_EXAMPLES_TEST_FILE,
+    CACHED_FEATURES_TEST_FILE,
+    AnswerExtractor,
+    QAProcessor,
+)
+from utils_nlp.models.transformers.sequence_classification import SequenceClassifier, Processor
+
+
+@pytest.mark.cpu
+def test_evaluate_classifier_checkpoints(tmpdir):
+    df = pd.DataFrame(
+        {"text": ["hi", "hello", "what's wrong with us", "can I leave?"] * 2, "label": [0, 1] * 4}
+    )
+    model_name = "distilbert-base-uncased"
+    processor = Processor(model_name=model_name, cache_dir=tmpdir)
+    dataloader = processor.create_dataloader_from_df(
+        df, "text", "label", max_len=16, batch_size=4, num_gpus=0
+    )
+
+    checkpoint_dirs = []
+    for i in range(2):
+        classifier = SequenceClassifier(model_name=model_name, num_labels=2, cache_dir=tmpdir)
+        checkpoint_dir = os.path.join(str(tmpdir), "checkpoint_{}".format(i))
+        os.makedirs(checkpoint_dir)
+        classifier.model.save_pretrained(checkpoint_dir)
+        checkpoint_dirs.append(checkpoint_dir)
+
+    results_file = os.path.join(str(tmpdir), "ranking.csv")
+    ranking = evaluate_classifier_checkpoints(
+        SequenceClassifier,
+        {"model_name": model_name, "num_labels": 2},
+        checkpoint_dirs,
+        dataloader,
+        num_gpus=0,
+        num_cpus=2,
+        results_file=results_file,
+    )
+    assert set(ranking["checkpoint"]) == set(checkpoint_dirs)
+    assert ranking["accuracy"].is_monotonic_decreasing
+    assert {"precision", "recall", "f1", "eval_time"} <= set(ranking.columns)
+    assert os.path.exists(results_file)
+
+
+@pytest.mark.cpu
+def test_evaluate_qa_checkpoints(qa_test_df, tmpdir):
+    dataset = QADataset(
+        df=qa_test_df["test_df"],
+        doc_text_col=qa_test_df["doc_text_col"],
+        question_text_col=qa_test_df["question_text_col"],
+        answer_start_col=qa_test_df["answer_start_col"],
+        answer_text_col=qa_test_df["answer_text_col"],
+        qa_id_col=qa_test_df["qa_id_col"],
+    )
+    model_name = "distilbert-base-uncased"
+    feature_cache_dir = os.path.join(str(tmpdir), "features")
+    processor = QAProcessor(model_name=model_name, to_lower=True, cache_dir=tmpdir)
+    dataloader = processor.preprocess(
+        dataset,
+        is_training=False,
+        batch_size=2,
+        num_gpus=0,
+        max_question_length=16,
+        max_seq_length=64,
+        doc_stride=32,
+        feature_cache_dir=feature_cache_dir,
+    )
+
+    checkpoint_dirs = []
+    for i in range(2):
+        extractor = AnswerExtractor(model_name=model_name, cache_dir=tmpdir)
+        checkpoint_dir = os.path.join(str(tmpdir), "checkpoint_{}".format(i))
+        os.makedirs(checkpoint_dir)
+        extractor.model.save_pretrained(checkpoint_dir)
+        checkpoint_dirs.append(checkpoint_dir)
+
+    output_dir = os.path.join(str(tmpdir), "qa_evaluation")
+    results_file = os.path.join(str(tmpdir), "qa_ranking.csv")
+    ranking = evaluate_qa_checkpoints(
+        {"model_name": model_name, "cache_dir": str(tmpdir)},
+        checkpoint_dirs,
+        dataloader,
+        os.path.join(feature_cache_dir, CACHED_EXAMPLES_TEST_FILE),
+        os.path.join(feature_cache_dir, CACHED_FEATURES_TEST_FILE),
+        dataset,
+        output_dir,
+        do_lower_case=True,
+        postprocess_args={"n_best_size": 5, "max_answer_length": 10},
+        num_gpus=0,
+        num_cpus=2,
+        results_file=results_file,
+    )
+    assert set(ranking["checkpoint"]) == set(checkpoint_dirs)
+    assert ranking["f1"].is_monotonic_decreasing
+    assert {"exact", "eval_time"} <= set(ranking.columns)
+    assert os.path.exists(results_file)
+    for i in range(2):
+        assert os.path.exists(
+            os.path.join(output_dir, "checkpoint_{}".format(i), "qa_predictions.json")
+        )
@@ -0,0 +1,146 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import contextlib
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, TensorDataset
+from transformers.modeling_bert import BertConfig, BertForSequenceClassification
+
+from utils_nlp.models.transformers.common import Transformer
+from utils_nlp.models.transformers.gradient_checkpointing import is_gradient_checkpointing_enabled
+from utils_nlp.models.transformers.sequence_classification import Processor
+from utils_nlp.models.transformers.tracing import BucketedTracedModel
+
+WORLD_SIZE = 2
+MODEL_NAME = "bert-base-uncased"
+
+
+class _TinyClassifier(Transformer):
+    def __init__(self):
+        super().__init__(model_class=None, model_name=MODEL_NAME)
+
+    @staticmethod
+    def list_supported_models():
+        return [MODEL_NAME]
+
+    def _create_model(self, model_class, num_labels):
+        torch.manual_seed(0)
+        config = BertConfig(
+            50,
+            hidden_size=8,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+            intermediate_size=16,
+            num_labels=num_labels,
+        )
+        return BertForSequenceClassification(config)
+
+
+def _run_gradient_accumulation(rank, init_file):
+    dist.init_process_group(
+        "gloo", init_method="file://" + init_file, rank=rank, world_size=WORLD_SIZE
+    )
+    input_ids = torch.randint(1, 50, (12, 8))
+    labels = torch.randint(0, 2, (12,))
+    dataset = TensorDataset(
+        input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids), labels
+    )
+    classifier = _TinyClassifier()
+
+    num_batches = []
+    no_sync_batches = []
+    num_clips = []
+    no_sync = torch.nn.parallel.DistributedDataParallel.no_sync
+    clip_grad_norm_ = torch.nn.utils.clip_grad_norm_
+
+    def _get_inputs(batch, model_name, train_mode=True):
+        num_batches.append(1)
+        return Processor.get_inputs(batch, model_name, train_mode)
+
+    @contextlib.contextmanager
+    def _no_sync(self):
+        no_sync_batches.append(len(num_batches) - 1)
+        with no_sync(self):
+            yield
+
+    def _clip_grad_norm(*args, **kwargs):
+        num_clips.append(len(num_batches) - 1)
+        return clip_grad_norm_(*args, **kwargs)
+
+    torch.nn.parallel.DistributedDataParallel.no_sync = _no_sync
+    torch.nn.utils.clip_grad_norm_ = _clip_grad_norm
+    try:
+        global_step, _ = classifier.fine_tune(
+            train_dataloader=DataLoader(dataset, batch_size=2),
+            get_inputs=_get_inputs,
+            device=torch.device("cpu"),
+            n_gpu=0,
+            gradient_accumulation_steps=3,
+            local_rank=rank,
+            verbose=False,
+        )
+    finally:
+        torch.nn.parallel.DistributedDataParallel.no_sync = no_sync
+        torch.nn.utils.clip_grad_norm_ = clip_grad_norm_
+
+    # 6 micro-batches, the gradients are only all-reduced by the last one of each step
+    assert global_step == 2
+    assert no_sync_batches == [0, 1, 3, 4]
+    assert num_clips == [2, 5]
+    dist.destroy_process_group()
+
+
+@pytest.mark.cpu
+def test_fine_tune_gradient_accumulation_no_sync(tmpdir):
+    init_file = os.path.join(str(tmpdir), "init")
+    mp.spawn(_run_gradient_accumulation, args=(init_file,), nprocs=WORLD_SIZE, join=True)
+
+
+@pytest.mark.cpu
+def test_predict_uses_traced_model(monkeypatch):
+    input_ids = torch.randint(1, 50, (6, 8))
+    dataset = TensorDataset(input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids))
+    dataloader = DataLoader(dataset, batch_size=2)
+    classifier = _TinyClassifier()
+    device = torch.device("cpu")
+    classifier.trace(dataloader, Processor.get_inputs, buckets=[(2, 8)], device=device)
+
+    calls = []
+    call = BucketedTracedModel.__call__
+
+    def _call(self, inputs):
+        calls.append(inputs["input_ids"].shape)
+        return call(self, inputs)
+
+    monkeypatch.setattr(BucketedTracedModel, "__call__", _call)
+    preds = list(classifier.predict(dataloader, Processor.get_inputs, device, verbose=False))
+    assert len(preds) == len(calls) == 3
+
+
+@pytest.mark.cpu
+def test_fine_tune_disables_gradient_checkpointing_on_error():
+    input_ids = torch.randint(1, 50, (4, 8))
+    labels = torch.randint(0, 2, (4,))
+    dataset = TensorDataset(
+        input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids), labels
+    )
+    classifier = _TinyClassifier()
+
+    def _get_inputs(batch, model_name, train_mode=True):
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        classifier.fine_tune(
+            train_dataloader=DataLoader(dataset, batch_size=2),
+            get_inputs=_get_inputs,
+            device=torch.device("cpu"),
+            n_gpu=0,
+            verbose=False,
+            gradient_checkpointing=True,
+        )
+    assert not is_gradient_checkpointing_enabled(classifier.model)
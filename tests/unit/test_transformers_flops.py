@@ -0,0 +1,51 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from utils_nlp.models.transformers.flops import FlopCounter, forward_flops, get_model_dims
+
+
+@pytest.mark.cpu
+def test_get_model_dims():
+    bert = SimpleNamespace(num_hidden_layers=12, hidden_size=768, intermediate_size=3072)
+    distilbert = SimpleNamespace(n_layers=6, dim=768, hidden_dim=3072)
+    xlnet = SimpleNamespace(n_layer=12, d_model=768, d_inner=3072)
+    assert get_model_dims(bert)["num_layers"] == 12
+    assert get_model_dims(distilbert)["num_layers"] == 6
+    assert get_model_dims(distilbert)["hidden_size"] == 768
+    assert get_model_dims(xlnet)["relative_attention"]
+    assert not get_model_dims(bert)["relative_attention"]
+
+
+@pytest.mark.cpu
+def test_flop_counter():
+    config = SimpleNamespace(num_hidden_layers=2, hidden_size=4, intermediate_size=16)
+    dims = get_model_dims(config)
+    # one layer: 8 * 16 + 4 * 64 = 384 FLOPs per token, 16 FLOPs per token pair
+    assert forward_flops(dims, 1, 1) == 2 * (384 + 16)
+
+    attention_mask = torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0]])
+    inputs = {"input_ids": torch.zeros_like(attention_mask), "attention_mask": attention_mask}
+    counter = FlopCounter(config, train=False)
+    counter.update(inputs)
+    report = counter.report(elapsed=2.0, peak_flops=1e4)
+    real = forward_flops(dims, 3 + 2, 9 + 4)
+    padded = forward_flops(dims, 2 * 4, 2 * 16)
+    assert report["model_flops"] == real
+    assert report["executed_flops"] == padded
+    assert report["padding_fraction"] == pytest.approx(1 - real / padded)
+    assert report["model_flops_per_s"] == pytest.approx(real / 2.0)
+    assert report["mfu"] == pytest.approx(real / 2.0 / 1e4)
+
+    counter = FlopCounter(config, train=True, gradient_checkpointing=True)
+    counter.update(inputs)
+    counter.update({"input_ids": torch.zeros(1, 4, dtype=torch.long)})
+    report = counter.report(elapsed=1.0)
+    assert report["num_batches"] == 2
+    assert report["model_flops"] == 3 * (real + forward_flops(dims, 4, 16))
+    assert report["executed_flops"] == 4 * 3 * forward_flops(dims, 4, 16)
+    assert "mfu" not in report
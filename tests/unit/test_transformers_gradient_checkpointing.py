@@ -0,0 +1,56 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import torch
+import torch.nn as nn
+
+from utils_nlp.models.transformers.gradient_checkpointing import (
+    disable_gradient_checkpointing,
+    enable_gradient_checkpointing,
+    is_gradient_checkpointing_enabled,
+)
+
+
+class _Layer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.dense = nn.Linear(8, 8)
+
+    def forward(self, x, mask=None):
+        return (torch.tanh(self.dense(x)) * mask, None)
+
+
+class _Encoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layer = nn.ModuleList([_Layer() for _ in range(3)])
+
+    def forward(self, x):
+        mask = torch.ones_like(x)
+        for layer in self.layer:
+            x = layer(x=x, mask=mask)[0]
+        return x.sum()
+
+
+def _gradients(model, x):
+    model.zero_grad()
+    model(x).backward()
+    return [p.grad.clone() for p in model.parameters()]
+
+
+def test_gradient_checkpointing():
+    model = _Encoder()
+    # as for the embedding outputs of a transformer, the input of the first layer requires grad
+    x = torch.randn(4, 8, requires_grad=True)
+    state_dict_keys = list(model.state_dict())
+    expected = _gradients(model, x)
+
+    enable_gradient_checkpointing(model)
+    assert is_gradient_checkpointing_enabled(model)
+    assert list(model.state_dict()) == state_dict_keys
+    for grad, expected_grad in zip(_gradients(model, x), expected):
+        assert torch.allclose(grad, expected_grad)
+
+    disable_gradient_checkpointing(model)
+    assert not is_gradient_checkpointing_enabled(model)
+    assert type(model.layer[0]) is _Layer
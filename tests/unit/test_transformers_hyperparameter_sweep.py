@@ -0,0 +1,58 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+
+import pandas as pd
+import pytest
+from sklearn.metrics import accuracy_score
+
+from utils_nlp.models.transformers.hyperparameter_sweep import (
+    expand_param_grid,
+    get_rungs,
+    run_hyperparameter_sweep,
+)
+from utils_nlp.models.transformers.sequence_classification import SequenceClassifier, Processor
+
+
+def test_expand_param_grid():
+    configs = expand_param_grid({"learning_rate": [1e-5, 5e-5], "num_epochs": [1, 3]})
+    assert len(configs) == 4
+    assert {"learning_rate": 5e-5, "num_epochs": 3} in configs
+    assert expand_param_grid([{"learning_rate": 1e-5}]) == [{"learning_rate": 1e-5}]
+
+
+def test_get_rungs():
+    assert get_rungs(10, 1, 3) == [1, 3, 9]
+    assert get_rungs(2, 1, 2) == [1]
+    assert get_rungs(1) == []
+
+
+@pytest.mark.cpu
+def test_run_hyperparameter_sweep(tmpdir):
+    df = pd.DataFrame(
+        {"text": ["hi", "hello", "what's wrong with us", "can I leave?"] * 2, "label": [0, 1] * 4}
+    )
+    model_name = "distilbert-base-uncased"
+    processor = Processor(model_name=model_name, cache_dir=tmpdir)
+    dataloader = processor.create_dataloader_from_df(
+        df, "text", "label", max_len=16, batch_size=4, num_gpus=0
+    )
+    results_file = os.path.join(tmpdir, "results.csv")
+    results = run_hyperparameter_sweep(
+        SequenceClassifier,
+        {"model_name": model_name, "num_labels": 2, "cache_dir": str(tmpdir)},
+        dataloader,
+        dataloader,
+        {"learning_rate": [1e-5, 5e-5], "num_epochs": [2]},
+        val_metric=accuracy_score,
+        fit_args={"verbose": False},
+        reduction_factor=2,
+        num_gpus=0,
+        num_cpus=2,
+        results_file=results_file,
+    )
+    assert len(results) == 2
+    assert set(results["status"]) <= {"completed", "pruned"}
+    assert results["best_score"].is_monotonic_decreasing
+    assert os.path.exists(results_file)
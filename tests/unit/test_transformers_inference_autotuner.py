@@ -0,0 +1,56 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+
+import pandas as pd
+import pytest
+import torch
+
+from utils_nlp.models.transformers.inference_autotuner import (
+    apply_inference_config,
+    autotune_cpu_inference,
+)
+from utils_nlp.models.transformers.sequence_classification import SequenceClassifier, Processor
+
+
+@pytest.mark.cpu
+def test_autotune_cpu_inference(tmpdir, monkeypatch):
+    # configurations with more threads than cores are skipped, the grid must not depend on the host
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    df = pd.DataFrame(
+        {"text": ["hi", "hello", "what's wrong with us", "can I leave?"] * 4, "label": [0, 1] * 8}
+    )
+    model_name = "distilbert-base-uncased"
+    processor = Processor(model_name=model_name, cache_dir=tmpdir)
+    dataloader = processor.create_dataloader_from_df(
+        df, "text", "label", max_len=16, batch_size=4, num_gpus=0
+    )
+    classifier = SequenceClassifier(model_name=model_name, num_labels=2, cache_dir=tmpdir)
+
+    output_file = os.path.join(tmpdir, "inference_config.json")
+    config = autotune_cpu_inference(
+        classifier,
+        dataloader.dataset,
+        Processor.get_inputs,
+        thread_counts=[1],
+        process_counts=[1, 2],
+        batch_sizes=[2, 8],
+        num_samples=16,
+        output_file=output_file,
+    )
+    assert len(config["results"]) == 4
+    assert config["batch_size"] in [2, 8]
+    assert config["max_len"] == 16
+    assert os.path.exists(output_file)
+
+    num_threads = torch.get_num_threads()
+    preds = classifier.predict(dataloader, num_gpus=0, verbose=False, inference_config=output_file)
+    assert len(preds) == len(df)
+    assert torch.get_num_threads() == num_threads
+
+    with apply_inference_config(dict(config, num_threads=1), dataloader) as tuned_dataloader:
+        assert torch.get_num_threads() == 1
+        assert tuned_dataloader.batch_size == config["batch_size"]
+        assert tuned_dataloader.collate_fn is dataloader.collate_fn
+    assert torch.get_num_threads() == num_threads
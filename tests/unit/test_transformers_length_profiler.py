@@ -0,0 +1,81 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+from utils_nlp.models.transformers.length_profiler import (
+    count_doc_spans,
+    profile_question_answering,
+    profile_sequence_classification,
+    profile_token_classification,
+    recommend_batch_size,
+)
+
+
+@pytest.fixture()
+def processor():
+    # one token per word
+    return SimpleNamespace(tokenizer=SimpleNamespace(tokenize=str.split), custom_tokenize=None)
+
+
+@pytest.mark.cpu
+def test_count_doc_spans():
+    assert count_doc_spans(0, 10, 4) == 0
+    assert count_doc_spans(10, 10, 4) == 1
+    # spans start at 0, 4, 8
+    assert count_doc_spans(17, 10, 4) == 3
+    assert count_doc_spans(18, 10, 4) == 3
+    assert count_doc_spans(19, 10, 4) == 4
+    # the window never moves by more than its length
+    assert count_doc_spans(25, 10, 20) == 3
+
+
+@pytest.mark.cpu
+def test_recommend_batch_size():
+    assert recommend_batch_size(512) == 32
+    assert recommend_batch_size(128) == 128
+    assert recommend_batch_size(100, tokens_per_batch=1000) == 8
+    assert recommend_batch_size(2048, tokens_per_batch=1000) == 1
+
+
+@pytest.mark.cpu
+def test_profile_sequence_classification(processor):
+    df = pd.DataFrame({"text": ["word " * n for n in range(1, 101)], "text2": ["a b"] * 100})
+    report = profile_sequence_classification(processor, df, "text", max_lens=(32, 64, 128))
+    assert report["num_samples"] == 100
+    assert report["percentiles"][100] == 102
+    rates = report["candidates"]["truncation_rate"].tolist()
+    assert rates == [0.7, 0.38, 0.0]
+    assert report["recommended"]["max_len"] == 128
+    assert report["recommended"]["batch_size"] == 128
+
+    report = profile_sequence_classification(
+        processor, df, "text", "text2", sample_size=10, max_lens=(32, 64, 128)
+    )
+    assert report["num_samples"] == 10
+    assert report["total_samples"] == 100
+
+    report = profile_token_classification(
+        processor, [["a"] * 10, ["b"] * 20], max_lens=(16, 32), max_truncation_rate=0.5
+    )
+    assert report["recommended"]["max_len"] == 16
+
+
+@pytest.mark.cpu
+def test_profile_question_answering(processor):
+    df = pd.DataFrame(
+        {"doc": ["word " * 300, "word " * 50], "question": ["what is it?", "why not?"]}
+    )
+    report = profile_question_answering(
+        processor, df, "doc", "question", max_lens=(64, 128, 512), doc_strides=(16, 32)
+    )
+    candidates = report["candidates"].set_index(["max_len", "doc_stride"])
+    # 300 tokens, 58 tokens per span for the first question, moved by 32 tokens
+    assert candidates.loc[(64, 32), "features_per_example"] == (1 + 8 + 1) / 2
+    assert candidates.loc[(512, 16), "features_per_example"] == 1
+    assert candidates.loc[(128, 32), "truncation_rate"] == 0.5
+    assert report["recommended"]["max_len"] == 512
+    assert report["recommended"]["doc_stride"] == 32
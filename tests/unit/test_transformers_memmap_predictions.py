@@ -0,0 +1,47 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+
+import numpy as np
+import pytest
+
+from utils_nlp.models.transformers.memmap_predictions import (
+    get_label_dtype,
+    write_predictions_to_memmap,
+)
+
+
+def test_get_label_dtype():
+    assert get_label_dtype(2) == np.uint8
+    assert get_label_dtype(256) == np.uint8
+    assert get_label_dtype(257) == np.uint16
+
+
+def test_write_predictions_to_memmap(tmpdir):
+    logits = np.random.randn(10, 7, 5).astype(np.float32)
+    batches = (logits[i : i + 4] for i in range(0, len(logits), 4))
+    output_prefix = os.path.join(str(tmpdir), "preds")
+    arrays = write_predictions_to_memmap(
+        batches, len(logits), output_prefix, outputs=["logits", "preds", "top_k"], top_k=3
+    )
+    assert set(arrays) == {"logits", "preds", "top_k_labels", "top_k_probs"}
+
+    preds = np.load(output_prefix + ".preds.npy", mmap_mode="r")
+    assert preds.dtype == np.uint8
+    assert (preds == logits.argmax(axis=-1)).all()
+    assert np.allclose(np.load(output_prefix + ".logits.npy"), logits)
+
+    top_k_labels = np.load(output_prefix + ".top_k_labels.npy")
+    top_k_probs = np.load(output_prefix + ".top_k_probs.npy")
+    assert top_k_labels.shape == (10, 7, 3)
+    assert top_k_probs.dtype == np.float16
+    assert (top_k_labels[..., 0] == preds).all()
+    assert (np.diff(top_k_probs.astype(np.float32), axis=-1) <= 0).all()
+
+
+def test_write_predictions_to_memmap_wrong_size(tmpdir):
+    with pytest.raises(ValueError):
+        write_predictions_to_memmap(
+            [np.zeros((2, 3))], 3, os.path.join(str(tmpdir), "preds"), outputs=["preds"]
+        )
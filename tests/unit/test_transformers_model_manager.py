@@ -0,0 +1,65 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import pytest
+import torch.nn as nn
+
+from utils_nlp.models.transformers.model_manager import ModelManager, get_model_size
+
+
+class _DummyModel:
+    def __init__(self, model_name, load_model_from_dir=None, num_labels=2):
+        self.model_name = model_name
+        self.load_model_from_dir = load_model_from_dir
+        self.model = nn.Linear(10, num_labels)
+
+
+def _size(num_labels=2):
+    return get_model_size(nn.Linear(10, num_labels))
+
+
+def test_get_model_size():
+    # 10 x 2 weights + 2 biases, float32
+    assert get_model_size(nn.Linear(10, 2)) == 22 * 4
+    assert get_model_size(_DummyModel("m")) == 22 * 4
+
+
+def test_model_manager_lru_eviction():
+    manager = ModelManager(memory_budget=2 * _size())
+    for name in ["a", "b", "c"]:
+        manager.register(name, _DummyModel, model_name="m", load_model_from_dir=name)
+
+    model_a = manager.get("a")
+    assert model_a.load_model_from_dir == "a"
+    manager.get("b")
+    assert manager.get("a") is model_a
+    manager.get("c")
+
+    # b is the least recently used model
+    assert manager.resident_models == ["a", "c"]
+    stats = manager.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 3
+    assert stats["evictions"] == 1
+    assert stats["resident_bytes"] == 2 * _size()
+    assert len(stats["load_times"]["a"]) == 1
+
+
+def test_model_manager_pin():
+    manager = ModelManager(memory_budget=_size())
+    manager.register("a", _DummyModel, model_name="m", pin=True)
+    manager.register("b", _DummyModel, model_name="m")
+
+    manager.get("a")
+    manager.get("b")
+    assert manager.is_resident("a")
+    assert manager.is_resident("b")
+
+    manager.unpin("a")
+    assert not manager.is_resident("a")
+    assert manager.is_resident("b")
+
+    with pytest.raises(KeyError):
+        manager.get("c")
+    with pytest.raises(ValueError):
+        manager.register("a", _DummyModel, model_name="m")
@@ -0,0 +1,81 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+import torch.nn as nn
+
+from utils_nlp.models.transformers.multi_task import (
+    MultiTaskClassifier,
+    MultiTaskModel,
+    create_multi_task_dataloader,
+)
+from utils_nlp.models.transformers.sequence_classification import Processor
+
+
+@pytest.mark.cpu
+def test_multi_task_classifier(tmpdir):
+    df = pd.DataFrame({"text": ["hi", "hello", "what's wrong with us", "can I leave?"]})
+    model_name = "distilbert-base-uncased"
+    max_len = 16
+    processor = Processor(model_name=model_name, cache_dir=tmpdir)
+    dataloader = processor.create_dataloader_from_df(df, "text", max_len=max_len, num_gpus=0)
+    labels = {
+        "intent": [0, 0, 1, 2],
+        # the first sample isn't labeled for the sentiment task
+        "sentiment": [-100, 1, 0, 1],
+        "tags": np.random.randint(0, 4, size=(len(df), max_len)),
+    }
+    train_dataloader = create_multi_task_dataloader(dataloader, labels, batch_size=2)
+
+    tasks = {"intent": ("sequence", 3), "sentiment": ("sequence", 2), "tags": ("token", 4)}
+    classifier = MultiTaskClassifier(model_name=model_name, tasks=tasks, cache_dir=tmpdir)
+    classifier.fit(train_dataloader, num_gpus=0, verbose=False)
+    encoder_weights = {k: v.clone() for k, v in classifier.model.encoder.state_dict().items()}
+    classifier.fit(
+        train_dataloader, tasks=["sentiment"], freeze_encoder=True, num_gpus=0, verbose=False
+    )
+    for k, v in classifier.model.encoder.state_dict().items():
+        assert (v == encoder_weights[k]).all()
+
+    preds = classifier.predict(train_dataloader, num_gpus=0, verbose=False)
+    assert preds["intent"].shape == (len(df),)
+    assert preds["sentiment"].shape == (len(df),)
+    assert preds["tags"].shape == (len(df), max_len)
+
+    model_dir = os.path.join(str(tmpdir), "multi_task")
+    classifier.model.save_pretrained(model_dir)
+    loaded = MultiTaskClassifier(model_name=model_name, load_model_from_dir=model_dir)
+    assert loaded.task_names == list(tasks)
+    loaded_preds = loaded.predict(train_dataloader, tasks=["intent"], num_gpus=0, verbose=False)
+    assert list(loaded_preds) == ["intent"]
+    assert (loaded_preds["intent"] == preds["intent"]).all()
+
+
+class _EmbeddingEncoder(nn.Module):
+    """Encoder whose hidden states are the embeddings of the tokens."""
+
+    def __init__(self):
+        super().__init__()
+        self.config = SimpleNamespace(hidden_size=4, hidden_dropout_prob=0.0)
+        self.embeddings = nn.Embedding(10, 4)
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None):
+        return (self.embeddings(input_ids),)
+
+
+@pytest.mark.cpu
+def test_multi_task_model_xlnet_pooling():
+    model = MultiTaskModel(_EmbeddingEncoder(), "xlnet-base-cased", {"intent": ("sequence", 2)})
+    model.eval()
+    # the classification token comes first and the sequences are padded on the right
+    input_ids = torch.tensor([[1, 5, 0, 0], [1, 5, 7, 9]])
+    with torch.no_grad():
+        logits = model(input_ids, attention_mask=(input_ids > 0).long())[0]["intent"]
+        expected = model.heads["intent"](model.encoder.embeddings(torch.tensor([1, 1])))
+    assert torch.allclose(logits, expected)
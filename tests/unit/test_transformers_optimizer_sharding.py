@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import copy
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from utils_nlp.models.transformers.optimizer_sharding import ShardedOptimizer, partition_parameters
+
+WORLD_SIZE = 2
+
+
+def _create_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.Linear(6, 4), torch.nn.Linear(4, 2))
+
+
+def _run_sharded_optimizer(rank, init_file):
+    dist.init_process_group(
+        "gloo", init_method="file://" + init_file, rank=rank, world_size=WORLD_SIZE
+    )
+    model = _create_model()
+    reference = copy.deepcopy(model)
+    optimizer = ShardedOptimizer(torch.optim.Adam, model.parameters(), lr=0.1)
+    reference_optimizer = torch.optim.Adam(reference.parameters(), lr=0.1)
+
+    for step in range(3):
+        # the gradients are the same on all processes, as after a DDP backward pass
+        torch.manual_seed(step)
+        x = torch.randn(5, 8)
+        for m in [model, reference]:
+            m.zero_grad()
+            m(x).pow(2).sum().backward()
+        optimizer.step()
+        reference_optimizer.step()
+
+    for p, ref in zip(model.parameters(), reference.parameters()):
+        assert torch.allclose(p, ref, atol=1e-6)
+    num_states = len(optimizer.state)
+    assert 0 < num_states < len(list(model.parameters()))
+    dist.destroy_process_group()
+
+
+def test_partition_parameters():
+    params = [torch.zeros(n) for n in [10, 4, 4, 3]]
+    owners = partition_parameters(params, 2)
+    assert owners == [0, 1, 1, 1]
+
+
+@pytest.mark.cpu
+def test_sharded_optimizer_gloo(tmpdir):
+    init_file = os.path.join(str(tmpdir), "init")
+    mp.spawn(_run_sharded_optimizer, args=(init_file,), nprocs=WORLD_SIZE, join=True)
@@ -0,0 +1,88 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+
+import numpy as np
+import pytest
+
+from utils_nlp.models.transformers.qa_feature_store import (
+    QAExampleStore,
+    QAFeatureStore,
+    write_qa_examples,
+    write_qa_features,
+)
+
+
+@pytest.mark.cpu
+def test_qa_feature_store(tmp):
+    examples = [
+        {"qa_id": 7, "doc_tokens": ["The", "sky", "is", "blue."]},
+        {"qa_id": 8, "doc_tokens": []},
+        {"qa_id": 9, "doc_tokens": ["Café", "au", "lait"]},
+    ]
+    features = [
+        {
+            "unique_id": 1000000001,
+            "example_index": 0,
+            "tokens": ["[CLS]", "what", "[SEP]", "the", "sky", "is", "blue", ".", "[SEP]"],
+            "token_to_orig_map": {3: 0, 4: 1, 5: 2, 6: 3, 7: 3},
+            "token_is_max_context": {3: True, 4: True, 5: False, 6: True, 7: True},
+            "paragraph_len": 5,
+        },
+        {
+            "unique_id": 1000000002,
+            "example_index": 2,
+            "tokens": ["café", "au", "la", "##it", "[SEP]", "what", "[SEP]", "[CLS]"],
+            "token_to_orig_map": {0: 0, 1: 1, 2: 2, 3: 2},
+            "token_is_max_context": {0: True, 1: True, 2: True, 3: True},
+            "paragraph_len": 4,
+        },
+    ]
+    examples_dir = os.path.join(tmp, "examples")
+    features_dir = os.path.join(tmp, "features")
+    write_qa_examples(examples_dir, examples)
+    write_qa_features(features_dir, features)
+
+    example_store = QAExampleStore(examples_dir)
+    assert len(example_store) == 3
+    assert [example_store.qa_id(i) for i in range(3)] == [7, 8, 9]
+    assert example_store.doc_tokens(0) == examples[0]["doc_tokens"]
+    assert example_store.doc_tokens(0, 1, 3) == ["sky", "is"]
+    assert example_store.doc_tokens(1) == []
+    assert example_store.doc_tokens(2, 0, 1) == ["Café"]
+
+    feature_store = QAFeatureStore(features_dir)
+    assert len(feature_store) == 2
+    assert list(feature_store.example_features(3)) == [0, 1, 1, 2]
+    assert feature_store.index_of(1000000002) == 1
+    with pytest.raises(KeyError):
+        feature_store.index_of(1000000003)
+
+    for index, expected in enumerate(features):
+        feature = feature_store[index]
+        assert feature.unique_id == expected["unique_id"]
+        assert feature.example_index == expected["example_index"]
+        assert feature.paragraph_len == expected["paragraph_len"]
+        assert feature.num_tokens == len(expected["tokens"])
+        assert feature.tokens() == expected["tokens"]
+        assert feature.tokens(2, 4) == expected["tokens"][2:4]
+        for i in range(len(expected["tokens"])):
+            assert feature.is_doc_token(i) == (i in expected["token_to_orig_map"])
+            assert feature.is_max_context(i) == expected["token_is_max_context"].get(i, False)
+            if i in expected["token_to_orig_map"]:
+                assert feature.orig_index(i) == expected["token_to_orig_map"][i]
+
+    positions = np.array([[2, 5, 7, 8], [0, 3, 4, 7]])
+    assert feature_store.doc_token_mask(0, 2, positions).tolist() == [
+        [False, True, True, False],
+        [True, True, False, False],
+    ]
+    assert feature_store.max_context_mask(0, 2, positions).tolist() == [
+        [False, False, True, False],
+        [True, True, False, False],
+    ]
+    assert feature_store.max_context_mask(1, 2, positions[1:, :, None]).shape == (1, 4, 1)
+
+    with pytest.raises(ValueError):
+        QAFeatureStore(examples_dir)
@@ -0,0 +1,67 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+
+import pytest
+
+from utils_nlp.models.transformers.datasets import QAInput
+from utils_nlp.models.transformers.qa_preprocessing_cache import (
+    QAPreprocessingCache,
+    get_tokenizer_id,
+)
+
+
+def _open_cache(cache_file, tokenizer_id, max_seq_length=384):
+    return QAPreprocessingCache(
+        cache_file,
+        tokenizer_id=tokenizer_id,
+        model_type="bert",
+        is_training=False,
+        max_question_length=64,
+        max_seq_length=max_seq_length,
+        doc_stride=128,
+    )
+
+
+@pytest.mark.cpu
+def test_qa_preprocessing_cache(tmp):
+    cache_file = os.path.join(tmp, "cache.db")
+    tokenizer_id = get_tokenizer_id("bert-base-cased", False)
+    assert tokenizer_id != get_tokenizer_id("bert-base-cased", True)
+    assert tokenizer_id != get_tokenizer_id("bert-base-cased", False, str.split)
+
+    qa_input = QAInput(
+        doc_text="The sky is blue.",
+        question_text="What color is the sky?",
+        qa_id=1,
+        is_impossible=False,
+        answer_start=-1,
+        answer_text="",
+    )
+    features = [{"unique_id": 1000000002, "qa_id": 1, "example_index": 0, "tokens": ["[CLS]"]}]
+
+    cache = _open_cache(cache_file, tokenizer_id)
+    assert cache.get_document(qa_input.doc_text) is None
+    assert cache.get_features(qa_input) is None
+    cache.put_document(qa_input.doc_text, (["The", "sky", "is", "blue."],))
+    cache.put_features(qa_input, features)
+    cache.commit()
+    cache.close()
+
+    cache = _open_cache(cache_file, tokenizer_id)
+    assert cache.get_document(qa_input.doc_text) == (["The", "sky", "is", "blue."],)
+    # the positional fields are not cached and the qa_id isn't part of the key
+    assert cache.get_features(qa_input._replace(qa_id=2)) == [{"tokens": ["[CLS]"]}]
+    assert cache.get_features(qa_input._replace(question_text="Why?")) is None
+    cache.close()
+
+    # the documents are shared by all sequence lengths, the features aren't
+    cache = _open_cache(cache_file, tokenizer_id, max_seq_length=512)
+    assert cache.get_document(qa_input.doc_text) is not None
+    assert cache.get_features(qa_input) is None
+    cache.close()
+
+    cache = _open_cache(cache_file, get_tokenizer_id("bert-base-uncased", True))
+    assert cache.get_document(qa_input.doc_text) is None
+    cache.close()
@@ -1,9 +1,13 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import numpy as np
 import pytest
 import pandas as pd
+import torch
+from sklearn.metrics import accuracy_score
 
+from utils_nlp.models.transformers.common import Transformer
 from utils_nlp.models.transformers.sequence_classification import SequenceClassifier, Processor
 
 
@@ -49,3 +53,97 @@ def test_classifier_gpu_train_cpu_predict(data, tmpdir):
     assert next(classifier.model.parameters()).is_cuda is True
     preds = classifier.predict(train_dataloader, num_gpus=0, verbose=False)
     assert next(classifier.model.parameters()).is_cuda is False
+
+
+@pytest.mark.cpu
+def test_classifier_max_len_schedule(data, tmpdir):
+
+    df = pd.DataFrame({"text": data[0], "label": data[1]})
+    num_labels = len(pd.unique(data[1]))
+    model_name = "bert-base-uncased"
+    processor = Processor(model_name=model_name, cache_dir=tmpdir)
+    train_dataloader = processor.create_dataloader_from_df(
+        df, "text", "label", batch_size=2, num_gpus=0, max_len=32, cache_tokens=True
+    )
+
+    # cached tokenization gives the same features as on the fly tokenization
+    for i, text in enumerate(data[0]):
+        expected = Processor.text_transform(text, processor.tokenizer, max_len=32)
+        sample = train_dataloader.dataset[i]
+        assert [t.tolist() for t in sample[:3]] == [list(x) for x in expected]
+
+    train_dataloader.dataset.set_max_len(8)
+    assert next(iter(train_dataloader))[0].shape == (2, 8)
+    train_dataloader.dataset.set_max_len(32)
+
+    classifier = SequenceClassifier(model_name=model_name, num_labels=num_labels, cache_dir=tmpdir)
+    classifier.fit(
+        train_dataloader=train_dataloader,
+        num_epochs=2,
+        num_gpus=0,
+        verbose=False,
+        max_len_schedule=[8, 32],
+    )
+    assert train_dataloader.dataset.max_len == 32
+
+
+@pytest.mark.cpu
+def test_classifier_early_stopping(data, tmpdir):
+
+    df = pd.DataFrame({"text": data[0], "label": data[1]})
+    num_labels = len(pd.unique(data[1]))
+    model_name = "bert-base-uncased"
+    processor = Processor(model_name=model_name, cache_dir=tmpdir)
+    train_dataloader = processor.create_dataloader_from_df(
+        df, "text", "label", batch_size=2, num_gpus=0, max_len=16
+    )
+    classifier = SequenceClassifier(model_name=model_name, num_labels=num_labels, cache_dir=tmpdir)
+    classifier.fit(
+        train_dataloader=train_dataloader,
+        num_epochs=3,
+        num_gpus=0,
+        verbose=False,
+        val_dataloader=train_dataloader,
+        val_metric=accuracy_score,
+        validation_steps=1,
+        early_stopping_patience=1,
+    )
+    assert 0 < len(classifier.validation_history) <= 6
+    best_score = max(score for _, score in classifier.validation_history)
+    device = next(classifier.model.parameters()).device
+    assert classifier._validate(
+        train_dataloader, Processor.get_inputs, device, val_metric=accuracy_score
+    ) == pytest.approx(best_score)
+
+
+@pytest.mark.cpu
+@pytest.mark.skipif(not hasattr(torch, "autocast"), reason="bf16 autocast requires PyTorch 1.10")
+def test_classifier_bf16(data, tmpdir):
+
+    df = pd.DataFrame({"text": data[0], "label": data[1]})
+    num_labels = len(pd.unique(data[1]))
+    model_name = "bert-base-uncased"
+    processor = Processor(model_name=model_name, cache_dir=tmpdir)
+    dataloader = processor.create_dataloader_from_df(
+        df, "text", "label", batch_size=2, num_gpus=0, max_len=16
+    )
+    classifier = SequenceClassifier(model_name=model_name, num_labels=num_labels, cache_dir=tmpdir)
+    classifier.fit(train_dataloader=dataloader, num_gpus=0, verbose=False, bf16=True)
+    assert next(classifier.model.parameters()).dtype == torch.float32
+
+    # bf16 logits are close to the fp32 logits
+    device = torch.device("cpu")
+    logits_fp32 = np.concatenate(
+        list(Transformer.predict(classifier, dataloader, Processor.get_inputs, device, False))
+    )
+    logits_bf16 = np.concatenate(
+        list(
+            Transformer.predict(
+                classifier, dataloader, Processor.get_inputs, device, False, bf16=True
+            )
+        )
+    )
+    assert logits_bf16.dtype == np.float32
+    assert np.allclose(logits_fp32, logits_bf16, atol=5e-2)
+    preds = classifier.predict(dataloader, num_gpus=0, verbose=False, bf16=True)
+    assert len(preds) == len(data[1])
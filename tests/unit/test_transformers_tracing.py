@@ -0,0 +1,92 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import pytest
+import torch
+import torch.nn as nn
+
+from utils_nlp.models.transformers.tracing import BucketedTracedModel, pad_inputs
+
+
+class _TokenModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embeddings = nn.Embedding(100, 8)
+        self.classifier = nn.Linear(8, 3)
+
+    def forward(self, input_ids, attention_mask):
+        hidden = self.embeddings(input_ids) * attention_mask.unsqueeze(-1).float()
+        return (self.classifier(hidden),)
+
+
+class _TokenAndSequenceModel(_TokenModel):
+    def __init__(self, num_labels):
+        super().__init__()
+        self.sequence_classifier = nn.Linear(8, num_labels)
+
+    def forward(self, input_ids, attention_mask):
+        token_logits = super().forward(input_ids, attention_mask)[0]
+        hidden = self.embeddings(input_ids) * attention_mask.unsqueeze(-1).float()
+        return (token_logits, self.sequence_classifier(hidden.mean(dim=1)))
+
+
+@pytest.fixture()
+def inputs():
+    input_ids = torch.tensor([[5, 6, 7, 0], [8, 9, 0, 0], [10, 11, 12, 13]])
+    return {"input_ids": input_ids, "attention_mask": (input_ids > 0).long()}
+
+
+def test_pad_inputs(inputs):
+    padded = pad_inputs(inputs, batch_size=4, seq_len=6)
+    assert padded["input_ids"].shape == (4, 6)
+    assert padded["input_ids"][3].tolist() == [5, 6, 7, 0, 0, 0]
+    assert padded["attention_mask"][:, 4:].sum().item() == 0
+
+    truncated = pad_inputs(inputs, batch_size=2, seq_len=2)
+    assert truncated["input_ids"].tolist() == [[5, 6], [8, 9]]
+
+
+def test_bucketed_traced_model(inputs):
+    model = _TokenModel()
+    traced = BucketedTracedModel(model, inputs, buckets=[(4, 8), (8, 16)])
+    assert traced.get_bucket(3, 4) == (4, 8)
+    assert traced.get_bucket(5, 4) == (8, 16)
+    assert traced.get_bucket(16, 4) is None
+
+    with torch.no_grad():
+        outputs = traced(inputs)
+        expected = model(**inputs)
+    assert outputs[0].shape == expected[0].shape
+    assert torch.allclose(outputs[0], expected[0], atol=1e-5)
+
+
+def test_bucketed_traced_model_sequence_outputs(inputs):
+    # the number of labels equals the bucket length, only the token logits are sliced
+    model = _TokenAndSequenceModel(num_labels=8)
+    traced = BucketedTracedModel(model, inputs, buckets=[(4, 8)])
+    assert traced.sequence_outputs == [True, False]
+
+    with torch.no_grad():
+        outputs = traced(inputs)
+        expected = model(**inputs)
+    assert outputs[0].shape == (3, 4, 3)
+    assert outputs[1].shape == (3, 8)
+    for out, exp in zip(outputs, expected):
+        assert torch.allclose(out, exp, atol=1e-5)
+
+
+def test_bucketed_traced_model_runs_on(inputs):
+    traced = BucketedTracedModel(_TokenModel(), inputs, buckets=[(4, 8)])
+    assert traced.runs_on(torch.device("cpu"))
+    assert not traced.runs_on(torch.device("cuda"))
+
+
+@pytest.mark.gpu
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires a GPU")
+def test_bucketed_traced_model_runs_on_gpu(inputs):
+    device = torch.device("cuda", torch.cuda.current_device())
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    traced = BucketedTracedModel(_TokenModel().to(device), inputs, buckets=[(4, 8)])
+    assert traced.runs_on(torch.device("cuda"))
+    assert traced.runs_on(device)
+    assert not traced.runs_on(torch.device("cpu"))
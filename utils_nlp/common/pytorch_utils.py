@@ -88,3 +88,19 @@ def move_to_device(model, device, num_gpus=None):
             "Device type '{}' not supported. Currently, only cpu "
             "and cuda devices are supported.".format(device.type)
         )
+
+
+def bf16_autocast():
+    """
+    Returns a context manager running the enclosed CPU operations in bfloat16 mixed precision.
+
+    Matrix multiplications and other autocast-eligible operations run in bfloat16, while the
+    parameters, and operations that need the range of float32, e.g. softmax and losses, stay in
+    float32. Requires PyTorch 1.10 or later.
+
+    Returns:
+        torch.autocast: The autocast context manager.
+    """
+    if not hasattr(torch, "autocast"):
+        raise ImportError("bfloat16 autocast requires PyTorch 1.10 or later.")
+    return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
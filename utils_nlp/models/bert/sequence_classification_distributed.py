@@ -72,7 +72,12 @@ class BERTSequenceClassifier:
                 warnings.warn("No GPU available! Using CPU.")
 
     def create_optimizer(
-        self, num_train_optimization_steps, lr=2e-5, fp16_allreduce=False, warmup_proportion=None
+        self,
+        num_train_optimization_steps,
+        lr=2e-5,
+        fp16_allreduce=False,
+        warmup_proportion=None,
+        gradient_accumulation_steps=1,
     ):
 
         """
@@ -85,6 +90,10 @@ class BERTSequenceClassifier:
                 perform linear learning rate warmup for. e.g., 0.1 = 10% of
                 training. defaults to none.
             fp16_allreduce(bool, optional)L if true, use fp16 compression during allreduce
+            gradient_accumulation_steps(int, optional): Number of backward passes whose
+                gradients are accumulated before each optimizer step. The gradients are
+                allreduced once per optimizer step instead of after every backward pass.
+                Defaults to 1.
 
         Returns:
             pytorch_pretrained_bert.optimization.BertAdam  : A BertAdam optimizer with user
@@ -107,7 +116,10 @@ class BERTSequenceClassifier:
         if self.use_distributed:
             compression = hvd.Compression.fp16 if fp16_allreduce else hvd.Compression.none
             optimizer = hvd.DistributedOptimizer(
-                optimizer, named_parameters=self.model.named_parameters(), compression=compression
+                optimizer,
+                named_parameters=self.model.named_parameters(),
+                compression=compression,
+                backward_passes_per_step=gradient_accumulation_steps,
             )
 
         return optimizer
@@ -172,6 +184,7 @@ class BERTSequenceClassifier:
         warmup_proportion=None,
         fp16_allreduce=False,
         num_train_optimization_steps=10,
+        gradient_accumulation_steps=1,
     ):
         """
         Method to fine-tune the bert classifier using the given training data
@@ -179,7 +192,9 @@ class BERTSequenceClassifier:
         Args:
             train_loader(torch.DataLoader): Torch Dataloader created from Torch Dataset
             epoch(int): Current epoch number of training.
-            bert_optimizer(optimizer): optimizer can be BERTAdam for local and Dsitributed if Horovod
+            bert_optimizer(optimizer): optimizer can be BERTAdam for local and Dsitributed if
+                Horovod. A Horovod optimizer must be created with backward_passes_per_step equal
+                to gradient_accumulation_steps, see create_optimizer.
             num_epochs(int): the number of epochs to run
             num_gpus(int): the number of gpus. If None is specified, all available GPUs will be used.
             lr (float): learning rate of the adam optimizer. defaults to 2e-5.
@@ -188,6 +203,8 @@ class BERTSequenceClassifier:
                 training. defaults to none.
             fp16_allreduce(bool): if true, use fp16 compression during allreduce
             num_train_optimization_steps: number of steps the optimizer should take.
+            gradient_accumulation_steps(int, optional): Number of batches whose gradients are
+                accumulated before each optimizer step. Defaults to 1.
         """
 
         device, num_gpus = get_device(num_gpus)
@@ -200,6 +217,7 @@ class BERTSequenceClassifier:
                 lr=lr,
                 warmup_proportion=warmup_proportion,
                 fp16_allreduce=fp16_allreduce,
+                gradient_accumulation_steps=gradient_accumulation_steps,
             )
 
         if self.use_distributed:
@@ -228,7 +246,8 @@ class BERTSequenceClassifier:
                 token_type_ids_batch = data["token_type_ids"]
                 token_type_ids_batch = token_type_ids_batch.cuda()
 
-            bert_optimizer.zero_grad()
+            if batch_idx % gradient_accumulation_steps == 0:
+                bert_optimizer.zero_grad()
 
             y_h = self.model(
                 input_ids=x_batch,
@@ -238,10 +257,17 @@ class BERTSequenceClassifier:
             )
 
             loss = loss_func(y_h, y_batch).mean()
+            if gradient_accumulation_steps > 1:
+                loss = loss / gradient_accumulation_steps
             loss.backward()
 
-            bert_optimizer.synchronize()
-            bert_optimizer.step()
+            # the Horovod optimizer allreduces the gradients once every
+            # gradient_accumulation_steps backward passes, before the optimizer step, and
+            # synchronize allreduces the gradients of a shorter last window
+            is_last_batch = batch_idx + 1 == len(train_loader)
+            if (batch_idx + 1) % gradient_accumulation_steps == 0 or is_last_batch:
+                bert_optimizer.synchronize()
+                bert_optimizer.step()
 
             if batch_idx % num_print == 0:
                 print(
@@ -0,0 +1,471 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Restartable offline scoring of large files, sharded across processes and hosts."""
+
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+from utils_nlp.common.timer import Timer
+from utils_nlp.models.transformers.sequence_classification import Processor, SequenceClassifier
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "shards.json"
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl", ".parquet": "parquet"}
+
+
+def _get_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(
+            "Unsupported file {0}, the supported extensions are {1}.".format(path, list(FORMATS))
+        )
+    return FORMATS[ext]
+
+
+def _record_offsets(path, file_format):
+    """
+    Yields the byte offsets of the records of a CSV or JSON lines file, skipping blank lines
+    like pandas. A CSV record ends at the first newline outside quoted fields.
+    """
+    offset = 0
+    start = None
+    in_quotes = False
+    with open(path, "rb") as f:
+        for line in f:
+            if start is None:
+                if not line.strip():
+                    offset += len(line)
+                    continue
+                start = offset
+            if file_format == "csv" and line.count(b'"') % 2 == 1:
+                # quotes are escaped by doubling them, so an odd count opens or closes a field
+                in_quotes = not in_quotes
+            offset += len(line)
+            if not in_quotes:
+                yield start
+                start = None
+    if start is not None:
+        yield start
+
+
+def plan_shards(input_files, shard_size=100000):
+    """
+    Splits input files into shards of consecutive rows.
+
+    CSV files are expected to have a header and JSON lines files one record per line, and they
+    are split every `shard_size` rows, at byte offsets that let each shard be read without
+    parsing the rows before it. Parquet files are split by row group. The plan only depends on
+    the files and `shard_size`, so it's the same on every host.
+
+    Args:
+        input_files (list): Paths of CSV, JSON lines or parquet files.
+        shard_size (int, optional): Number of rows per shard of CSV and JSON lines files.
+            Defaults to 100000.
+
+    Returns:
+        list: List of shard dictionaries with keys "shard", "file", "format", "start",
+            "num_rows" and, for parquet files, "row_group" or, for CSV and JSON lines files,
+            "offset".
+    """
+    shards = []
+    for path in input_files:
+        file_format = _get_format(path)
+        if file_format == "parquet":
+            import pyarrow.parquet as pq
+
+            metadata = pq.ParquetFile(path).metadata
+            sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+        else:
+            records = _record_offsets(path, file_format)
+            if file_format == "csv":
+                next(records, None)
+            offsets = []
+            num_rows = 0
+            for offset in records:
+                if num_rows % shard_size == 0:
+                    offsets.append(offset)
+                num_rows += 1
+            sizes = [min(shard_size, num_rows - s) for s in range(0, num_rows, shard_size)]
+        start = 0
+        for i, size in enumerate(sizes):
+            shard = {
+                "shard": len(shards),
+                "file": os.path.abspath(path),
+                "format": file_format,
+                "start": start,
+                "num_rows": size,
+            }
+            if file_format == "parquet":
+                shard["row_group"] = i
+            else:
+                shard["offset"] = offsets[i]
+            shards.append(shard)
+            start += size
+    return shards
+
+
+def read_shard(shard):
+    """Reads the rows of a shard into a data frame."""
+    if shard["format"] == "csv":
+        columns = pd.read_csv(shard["file"], nrows=0).columns
+        with open(shard["file"], "rb") as f:
+            f.seek(shard["offset"])
+            return pd.read_csv(f, header=None, names=list(columns), nrows=shard["num_rows"])
+    if shard["format"] == "jsonl":
+        with open(shard["file"], "rb") as f:
+            f.seek(shard["offset"])
+            lines = (line for line in f if line.strip())
+            return pd.DataFrame(
+                [json.loads(line) for line in itertools.islice(lines, shard["num_rows"])]
+            )
+    import pyarrow.parquet as pq
+
+    return pq.ParquetFile(shard["file"]).read_row_group(shard["row_group"]).to_pandas()
+
+
+def _shard_path(output_dir, shard, suffix):
+    return os.path.join(output_dir, "shard_{0:06d}{1}".format(shard["shard"], suffix))
+
+
+def _write_output(df, path, output_format):
+    # write to a temporary file first, so that a crash never leaves a partial output
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    if output_format == "csv":
+        df.to_csv(tmp_path, index=False)
+    elif output_format == "jsonl":
+        df.to_json(tmp_path, orient="records", lines=True)
+    else:
+        df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def _is_stale(lock_file, lock_timeout):
+    """Whether a lock was left by a dead process of this host or is older than lock_timeout."""
+    try:
+        with open(lock_file) as f:
+            host, pid = f.read().split()
+        if host == socket.gethostname():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return lock_timeout is not None and time.time() - os.path.getmtime(lock_file) > lock_timeout
+    except (OSError, ValueError):
+        return False
+
+
+def _remove_stale_lock(lock_file, stat):
+    """
+    Removes a lock found stale with the given stat result, returns whether this process removed
+    it. The lock is renamed to a name unique to this process first, so that of several processes
+    reclaiming it, only one moves it, and a lock created again in between is put back.
+    """
+    moved_file = "{0}.{1}.{2}.stale".format(lock_file, socket.gethostname(), os.getpid())
+    try:
+        os.rename(lock_file, moved_file)
+    except FileNotFoundError:
+        return False
+    moved_stat = os.stat(moved_file)
+    if (moved_stat.st_ino, moved_stat.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+        # another process reclaimed the lock and claimed the shard since it was found stale
+        try:
+            os.link(moved_file, lock_file)
+        except FileExistsError:
+            pass
+        os.remove(moved_file)
+        return False
+    os.remove(moved_file)
+    return True
+
+
+def _claim(lock_file, lock_timeout):
+    """Atomically creates the lock file of a shard, returns whether this process owns it."""
+    for _ in range(2):
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                stat = os.stat(lock_file)
+            except FileNotFoundError:
+                continue
+            if not _is_stale(lock_file, lock_timeout):
+                return False
+            if not _remove_stale_lock(lock_file, stat):
+                return False
+            logger.warning("Reclaimed stale lock {}".format(lock_file))
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write("{0} {1}".format(socket.gethostname(), os.getpid()))
+        return True
+    return False
+
+
+class _LockHeartbeat:
+    """Touches a lock file periodically, so that other hosts don't take it for stale."""
+
+    def __init__(self, lock_file, interval):
+        self.lock_file = lock_file
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.lock_file)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        if self.interval is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def _score_worker(worker_id, output_dir, shards, config):
+    """Scores the shards that aren't done or claimed by another process."""
+    num_gpus = config["num_gpus"]
+    if num_gpus > 0:
+        torch.cuda.set_device(worker_id % num_gpus)
+    else:
+        torch.set_num_threads(config["num_threads_per_worker"])
+
+    processor = Processor(
+        model_name=config["model_name"], to_lower=config["to_lower"], cache_dir=config["cache_dir"]
+    )
+    classifier = SequenceClassifier(
+        model_name=config["model_name"],
+        num_labels=config["num_labels"],
+        cache_dir=config["cache_dir"],
+        load_model_from_dir=config["load_model_from_dir"],
+    )
+
+    for shard in shards:
+        done_file = _shard_path(output_dir, shard, ".done")
+        lock_file = _shard_path(output_dir, shard, ".lock")
+        if os.path.exists(done_file) or not _claim(lock_file, config["lock_timeout"]):
+            continue
+        lock_timeout = config["lock_timeout"]
+        heartbeat = _LockHeartbeat(lock_file, None if lock_timeout is None else lock_timeout / 3)
+        with heartbeat, Timer() as t:
+            df = read_shard(shard)
+            dataloader = processor.create_dataloader_from_df(
+                df,
+                config["text_col"],
+                text2_col=config["text2_col"],
+                max_len=config["max_len"],
+                batch_size=config["batch_size"],
+                num_gpus=min(num_gpus, 1),
+            )
+            preds = classifier.predict(dataloader, num_gpus=min(num_gpus, 1), verbose=False)
+            output = df[config["keep_cols"]].copy() if config["keep_cols"] else pd.DataFrame()
+            output["prediction"] = preds
+            _write_output(
+                output,
+                _shard_path(output_dir, shard, "." + config["output_format"]),
+                config["output_format"],
+            )
+        with open(done_file, "w") as f:
+            json.dump({"num_rows": len(output), "seconds": t.interval}, f)
+        os.remove(lock_file)
+        logger.info(
+            "Worker {0} scored shard {1} ({2} rows) in {3:.2f} s".format(
+                worker_id, shard["shard"], len(output), t.interval
+            )
+        )
+
+
+def merge_shards(output_dir, merged_file, output_format="csv"):
+    """
+    Concatenates the outputs of all shards in the order of the input rows.
+
+    Args:
+        output_dir (str): Directory of the scoring outputs.
+        merged_file (str): Path of the merged file.
+        output_format (str, optional): Format of the shard outputs, "csv", "jsonl" or "parquet".
+            Defaults to "csv".
+
+    Returns:
+        int: Number of rows of the merged file.
+    """
+    with open(os.path.join(output_dir, MANIFEST_FILE)) as f:
+        shards = json.load(f)["shards"]
+    if not shards:
+        raise ValueError("The plan in {} has no shards to merge.".format(output_dir))
+    missing = [
+        s["shard"] for s in shards if not os.path.exists(_shard_path(output_dir, s, ".done"))
+    ]
+    if missing:
+        raise RuntimeError("Shards {} are not done yet.".format(missing))
+
+    paths = [_shard_path(output_dir, s, "." + output_format) for s in shards]
+    tmp_file = "{0}.{1}.tmp".format(merged_file, os.getpid())
+    num_rows = 0
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = None
+        for path in paths:
+            table = pq.read_table(path)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_file, table.schema)
+            writer.write_table(table)
+            num_rows += table.num_rows
+        writer.close()
+    else:
+        # text outputs are concatenated without parsing, keeping only the first CSV header
+        with open(tmp_file, "wb") as out:
+            for i, path in enumerate(paths):
+                with open(path, "rb") as f:
+                    if output_format == "csv" and i > 0:
+                        f.readline()
+                    for line in f:
+                        out.write(line)
+                        num_rows += 1
+        if output_format == "csv":
+            num_rows -= 1
+    os.replace(tmp_file, merged_file)
+    logger.info("Merged {0} shards, {1} rows, into {2}".format(len(paths), num_rows, merged_file))
+    return num_rows
+
+
+def score_files(
+    input_files,
+    output_dir,
+    model_name,
+    num_labels=2,
+    load_model_from_dir=None,
+    text_col="text",
+    text2_col=None,
+    keep_cols=None,
+    to_lower=False,
+    cache_dir=".",
+    max_len=512,
+    batch_size=32,
+    shard_size=100000,
+    num_workers=1,
+    num_gpus=None,
+    num_threads_per_worker=1,
+    output_format="csv",
+    lock_timeout=None,
+    merged_file=None,
+):
+    """
+    Scores large files with a sequence classifier, sharded across worker processes and hosts.
+
+    The input files are split into deterministic shards, whose plan is saved in `output_dir`.
+    Worker processes claim shards through lock files in `output_dir`, write the predictions of
+    each shard to its own file and mark it done. Running the same call on several hosts sharing
+    `output_dir` spreads the shards across the hosts, and running it again after a crash only
+    scores the shards that aren't done. When all shards are done, the outputs are merged in the
+    order of the input rows.
+
+    Args:
+        input_files (list): Paths of CSV, JSON lines or parquet files.
+        output_dir (str): Directory shared by the workers, for the plan, locks, completion
+            markers and shard outputs.
+        model_name (str): Name of the pre-trained model.
+        num_labels (int, optional): Number of labels of the classifier. Defaults to 2.
+        load_model_from_dir (str, optional): Directory of the fine-tuned model. Defaults to None.
+        text_col (str, optional): Column of the texts. Defaults to "text".
+        text2_col (str, optional): Column of the second texts of sequence pairs. Defaults to
+            None.
+        keep_cols (list, optional): Input columns copied to the output, e.g. row ids. Defaults
+            to None.
+        to_lower (bool, optional): Whether to lowercase the texts. Defaults to False.
+        cache_dir (str, optional): Directory to cache the pre-trained model. Defaults to ".".
+        max_len (int, optional): Maximum number of tokens per text. Defaults to 512.
+        batch_size (int, optional): Batch size. Defaults to 32.
+        shard_size (int, optional): Number of rows per shard of CSV and JSON lines files.
+            Defaults to 100000.
+        num_workers (int, optional): Number of worker processes on this host. Defaults to 1.
+        num_gpus (int, optional): Number of GPUs of this host, shared round-robin by the
+            workers. Defaults to None, all available GPUs.
+        num_threads_per_worker (int, optional): Number of threads of each CPU worker. Defaults
+            to 1.
+        output_format (str, optional): Format of the outputs, "csv", "jsonl" or "parquet".
+            Defaults to "csv".
+        lock_timeout (float, optional): Age in seconds after which a lock of another host is
+            considered stale and its shard rescored. The owner of a lock refreshes it every
+            third of `lock_timeout` while it scores the shard, so the timeout only needs to
+            exceed the pauses of a live host, not the scoring time of a shard. Locks of dead
+            processes of this host are always reclaimed. Defaults to None, locks of other hosts
+            never expire.
+        merged_file (str, optional): Path of the merged output. Defaults to None, "predictions"
+            with the extension of `output_format` in `output_dir`.
+
+    Returns:
+        str: Path of the merged file, or None if shards claimed by other hosts aren't done yet.
+    """
+    if output_format not in ["csv", "jsonl", "parquet"]:
+        raise ValueError("Unsupported output format {}.".format(output_format))
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    plan = {
+        "input_files": [os.path.abspath(f) for f in input_files],
+        "shard_size": shard_size,
+    }
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if {k: manifest[k] for k in plan} != plan:
+            raise ValueError(
+                "{} was created for other input files or shard size.".format(manifest_file)
+            )
+    else:
+        manifest = dict(plan, shards=plan_shards(input_files, shard_size))
+        if not manifest["shards"]:
+            raise ValueError("The input files {} have no rows to score.".format(input_files))
+        tmp_file = "{0}.{1}.tmp".format(manifest_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_file, manifest_file)
+    shards = manifest["shards"]
+
+    if num_gpus is None:
+        num_gpus = torch.cuda.device_count()
+    config = {
+        "model_name": model_name,
+        "num_labels": num_labels,
+        "load_model_from_dir": load_model_from_dir,
+        "text_col": text_col,
+        "text2_col": text2_col,
+        "keep_cols": keep_cols,
+        "to_lower": to_lower,
+        "cache_dir": cache_dir,
+        "max_len": max_len,
+        "batch_size": batch_size,
+        "num_gpus": min(num_gpus, torch.cuda.device_count()),
+        "num_threads_per_worker": num_threads_per_worker,
+        "output_format": output_format,
+        "lock_timeout": lock_timeout,
+    }
+    logger.info("Scoring {0} shards with {1} workers".format(len(shards), num_workers))
+    mp.spawn(_score_worker, args=(output_dir, shards, config), nprocs=num_workers, join=True)
+
+    if not all(os.path.exists(_shard_path(output_dir, s, ".done")) for s in shards):
+        logger.info("Shards claimed by other hosts are still running.")
+        return None
+    if merged_file is None:
+        merged_file = os.path.join(output_dir, "predictions." + output_format)
+    merge_shards(output_dir, merged_file, output_format)
+    return merged_file
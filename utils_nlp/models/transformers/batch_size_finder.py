@@ -0,0 +1,208 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Utilities to find the largest batch size fitting in memory for training and inference."""
+
+import logging
+import math
+import os
+
+import torch
+
+from utils_nlp.models.transformers.tracing import pad_inputs
+
+logger = logging.getLogger(__name__)
+
+
+def _get_rss():
+    """Returns the resident memory of the current process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        import resource
+
+        # peak resident memory, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _get_total_memory(device):
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _is_out_of_memory(error):
+    # CUDA reports "out of memory", the CPU allocator "can't allocate memory"
+    message = str(error)
+    return (
+        isinstance(error, MemoryError)
+        or "out of memory" in message
+        or "can't allocate memory" in message
+    )
+
+
+def measure_peak_memory(model, inputs, device, train=True):
+    """
+    Runs one forward pass, and a backward pass if `train` is True, and returns the peak memory.
+
+    Args:
+        model (torch.nn.Module): The model.
+        inputs (dict): Dictionary of model inputs, including labels if `train` is True.
+        device (torch.device): Device the model and inputs are on.
+        train (bool, optional): Whether to run a training step. Defaults to True.
+
+    Returns:
+        int: Peak CUDA memory allocated on GPUs, or peak resident memory of the process on CPU,
+            in bytes.
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_max_memory_allocated(device)
+
+    if train:
+        model.train()
+        outputs = model(**inputs)
+        loss = outputs[0].mean()
+        rss_peak = _get_rss()
+        loss.backward()
+        model.zero_grad()
+    else:
+        model.eval()
+        with torch.no_grad():
+            outputs = model(**inputs)
+        rss_peak = _get_rss()
+    del outputs
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    return max(rss_peak, _get_rss())
+
+
+def find_max_batch_size(
+    transformer,
+    dataloader,
+    get_inputs,
+    max_len,
+    device=None,
+    train=True,
+    memory_limit=None,
+    max_batch_size=1024,
+    target_batch_size=None,
+):
+    """
+    Finds the largest batch size that fits in memory for a transformer model at a given maximum
+    sequence length.
+
+    The batch size is doubled until a step runs out of memory or exceeds `memory_limit`, then
+    refined by binary search. On GPUs the peak CUDA memory allocated is measured. On CPU the
+    resident memory of the whole process is measured, so `memory_limit` should account for other
+    data held by the process. For training, the memory of the AdamW moment buffers, twice the
+    parameter memory, is added to the measured peak.
+
+    Args:
+        transformer (Transformer): Model to probe, e.g. an instance of
+            :class:`utils_nlp.models.transformers.sequence_classification.SequenceClassifier`.
+        dataloader (DataLoader): Dataloader whose first batch is repeated and padded to
+            `max_len` to create the probe inputs. It must contain labels if `train` is True.
+        get_inputs (function): Function converting a batch into model inputs, e.g.
+            :meth:`utils_nlp.models.transformers.sequence_classification.Processor.get_inputs`.
+        max_len (int): Sequence length of the probe inputs.
+        device (torch.device, optional): Device to probe. Defaults to None, the device of the
+            model parameters.
+        train (bool, optional): Whether to probe training, forward and backward passes, or
+            inference, forward passes without gradients. Defaults to True.
+        memory_limit (int, optional): Maximum number of bytes to use. Defaults to None, 90% of
+            the GPU memory or of the physical memory.
+        max_batch_size (int, optional): Largest batch size to try. Defaults to 1024.
+        target_batch_size (int, optional): Effective batch size to reach with gradient
+            accumulation if it doesn't fit in memory. Defaults to None.
+
+    Returns:
+        dict: Recommended configuration with keys "batch_size", "gradient_accumulation_steps",
+            "effective_batch_size", "max_len", "peak_memory" (bytes used by the recommended
+            batch size) and "memory_limit".
+    """
+    model = transformer.model
+    if device is None:
+        device = next(model.parameters()).device
+    model.to(device)
+    if memory_limit is None:
+        memory_limit = int(0.9 * _get_total_memory(device))
+
+    optimizer_memory = 0
+    if train:
+        optimizer_memory = 2 * sum(
+            p.numel() * p.element_size() for p in model.parameters() if p.requires_grad
+        )
+
+    batch = tuple(t.to(device) for t in next(iter(dataloader)))
+    example_inputs = get_inputs(batch, transformer.model_name, train_mode=train)
+    peak_memory = {}
+
+    def _fits(batch_size):
+        inputs = pad_inputs(example_inputs, batch_size, max_len)
+        try:
+            peak = measure_peak_memory(model, inputs, device, train) + optimizer_memory
+        except (RuntimeError, MemoryError) as e:
+            if not _is_out_of_memory(e):
+                raise
+            peak = None
+        finally:
+            del inputs
+            model.zero_grad()
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+        fits = peak is not None and peak <= memory_limit
+        logger.info(
+            "Batch size {0}: {1}".format(
+                batch_size, "{} bytes".format(peak) if peak is not None else "out of memory"
+            )
+        )
+        if fits:
+            peak_memory[batch_size] = peak
+        return fits
+
+    if not _fits(1):
+        raise RuntimeError(
+            "A batch of size 1 with max_len {0} doesn't fit in {1} bytes.".format(
+                max_len, memory_limit
+            )
+        )
+
+    # grow exponentially, then binary search between the last fitting and the first failing size
+    low = 1
+    high = None
+    while low < max_batch_size:
+        candidate = min(2 * low, max_batch_size)
+        if _fits(candidate):
+            low = candidate
+        else:
+            high = candidate
+            break
+    if high is not None:
+        while high - low > 1:
+            mid = (low + high) // 2
+            if _fits(mid):
+                low = mid
+            else:
+                high = mid
+
+    batch_size = low
+    gradient_accumulation_steps = 1
+    if target_batch_size is not None and target_batch_size > batch_size:
+        gradient_accumulation_steps = int(math.ceil(target_batch_size / batch_size))
+        # spread the target evenly across the accumulation steps
+        batch_size = int(math.ceil(target_batch_size / gradient_accumulation_steps))
+    elif target_batch_size is not None:
+        batch_size = target_batch_size
+
+    return {
+        "batch_size": batch_size,
+        "gradient_accumulation_steps": gradient_accumulation_steps,
+        "effective_batch_size": batch_size * gradient_accumulation_steps,
+        "max_len": max_len,
+        "peak_memory": peak_memory.get(batch_size, peak_memory[low]),
+        "memory_limit": memory_limit,
+    }
@@ -0,0 +1,315 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Concurrent evaluation and ranking of fine-tuned model checkpoints."""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, SequentialSampler
+
+from utils_nlp.common.timer import Timer
+from utils_nlp.eval.classification import eval_classification
+from utils_nlp.eval.question_answering import evaluate_qa
+from utils_nlp.models.transformers.hyperparameter_sweep import tensorize_dataset
+from utils_nlp.models.transformers.question_answering import (
+    AnswerExtractor,
+    QAProcessor,
+    postprocess_bert_answer,
+    postprocess_xlnet_answer,
+)
+
+logger = logging.getLogger(__name__)
+
+# state of an evaluation worker process, set by _init_worker
+_WORKER = {}
+
+
+def _init_worker(dataset, batch_size, devices, num_threads):
+    device = devices.get()
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    else:
+        torch.set_num_threads(num_threads)
+    _WORKER.update(
+        {
+            "dataloader": DataLoader(
+                dataset, sampler=SequentialSampler(dataset), batch_size=batch_size
+            ),
+            "num_gpus": 1 if device.type == "cuda" else 0,
+        }
+    )
+
+
+def _evaluate_classifier(checkpoint_dir, model_class, model_args, labels, metric_fn):
+    with Timer() as t:
+        model = model_class(load_model_from_dir=checkpoint_dir, **model_args)
+        preds = model.predict(_WORKER["dataloader"], num_gpus=_WORKER["num_gpus"], verbose=False)
+    del model
+    result = metric_fn(labels, preds)
+    if not isinstance(result, dict):
+        result = {"score": result}
+    result["eval_time"] = t.interval
+    return result
+
+
+def _evaluate_answer_extractor(
+    checkpoint_dir,
+    output_dir,
+    model_args,
+    examples_file,
+    features_file,
+    actual_dataset,
+    do_lower_case,
+    unanswerable_exists,
+    postprocess_args,
+):
+    with Timer() as t:
+        model = AnswerExtractor(load_model_from_dir=checkpoint_dir, **model_args)
+        results = model.predict(_WORKER["dataloader"], num_gpus=_WORKER["num_gpus"], verbose=False)
+    del model
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = {
+        "output_prediction_file": os.path.join(output_dir, "qa_predictions.json"),
+        "output_nbest_file": os.path.join(output_dir, "nbest_predictions.json"),
+        "output_null_log_odds_file": os.path.join(output_dir, "null_odds.json"),
+    }
+    model_name = model_args.get("model_name", "bert-base-cased")
+    if model_name.split("-")[0] == "xlnet":
+        tokenizer = QAProcessor(
+            model_name=model_name,
+            to_lower=do_lower_case,
+            cache_dir=model_args.get("cache_dir", "."),
+        ).tokenizer
+        final_answers, _, _ = postprocess_xlnet_answer(
+            results,
+            examples_file,
+            features_file,
+            tokenizer=tokenizer,
+            unanswerable_exists=unanswerable_exists,
+            **dict(output_files, **postprocess_args)
+        )
+    else:
+        final_answers, _, _ = postprocess_bert_answer(
+            results,
+            examples_file,
+            features_file,
+            do_lower_case=do_lower_case,
+            unanswerable_exists=unanswerable_exists,
+            **dict(output_files, **postprocess_args)
+        )
+    result = dict(
+        evaluate_qa(
+            actual_dataset,
+            final_answers,
+            unanswerable_exists=unanswerable_exists,
+            out_file=os.path.join(output_dir, "eval_results.json"),
+        )
+    )
+    result["eval_time"] = t.interval
+    return result
+
+
+def _run(task, task_args, dataset, batch_size, num_gpus, num_cpus, num_threads_per_worker):
+    """Runs a task on each checkpoint in a pool of worker processes sharing the eval features."""
+    if num_gpus is None:
+        num_gpus = torch.cuda.device_count()
+    num_gpus = min(num_gpus, torch.cuda.device_count())
+    if num_gpus > 0:
+        devices = [torch.device("cuda", i) for i in range(num_gpus)]
+    else:
+        num_cpus = num_cpus or os.cpu_count()
+        devices = [torch.device("cpu")] * max(1, num_cpus // num_threads_per_worker)
+    num_workers = min(len(devices), len(task_args))
+    logger.info("Evaluating {0} checkpoints on {1} workers".format(len(task_args), num_workers))
+
+    ctx = mp.get_context("spawn")
+    manager = ctx.Manager()
+    device_queue = manager.Queue()
+    for device in devices[:num_workers]:
+        device_queue.put(device)
+    pool = ctx.Pool(
+        num_workers,
+        initializer=_init_worker,
+        initargs=(dataset, batch_size, device_queue, num_threads_per_worker),
+    )
+    try:
+        results = pool.starmap(task, task_args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        manager.shutdown()
+    return results
+
+
+def _rank(checkpoint_dirs, results, rank_by, results_file):
+    rows = []
+    for checkpoint_dir, result in zip(checkpoint_dirs, results):
+        row = {"checkpoint": checkpoint_dir}
+        # per-class metrics, e.g. the precision, recall and f1 lists of eval_classification,
+        # are ranked by their macro average
+        row.update({k: np.mean(v) if isinstance(v, list) else v for k, v in result.items()})
+        rows.append(row)
+    ranking = pd.DataFrame(rows)
+    if rank_by not in ranking:
+        raise ValueError("Metric {0} not in {1}.".format(rank_by, list(ranking.columns)))
+    ranking = ranking.sort_values(rank_by, ascending=False).reset_index(drop=True)
+    if results_file is not None:
+        ranking.to_csv(results_file, index=False)
+        logger.info("Checkpoint ranking saved to {}".format(results_file))
+    return ranking
+
+
+def evaluate_classifier_checkpoints(
+    model_class,
+    model_args,
+    checkpoint_dirs,
+    eval_dataloader,
+    labels=None,
+    metric_fn=eval_classification,
+    rank_by="accuracy",
+    num_gpus=None,
+    num_cpus=None,
+    num_threads_per_worker=1,
+    results_file=None,
+):
+    """
+    Evaluates sequence classification checkpoints concurrently and ranks them.
+
+    The evaluation set is tokenized once, into tensors in shared memory used by all workers, and
+    the checkpoints are evaluated in worker processes, one per GPU, or one per
+    `num_threads_per_worker` CPU cores when no GPU is used.
+
+    Args:
+        model_class (type): Model class, e.g.
+            :class:`utils_nlp.models.transformers.sequence_classification.SequenceClassifier`.
+        model_args (dict): Arguments of the model constructor other than `load_model_from_dir`,
+            e.g. {"model_name": "bert-base-uncased", "num_labels": 2}.
+        checkpoint_dirs (list): Directories of the checkpoints, e.g. the `fine_tuned` directories
+            saved by `save_model` or the `best_model_dir` of `fit`.
+        eval_dataloader (DataLoader): Evaluation dataloader.
+        labels (array-like, optional): True labels. Defaults to None, the last tensor of the
+            evaluation samples is used.
+        metric_fn (function, optional): Function taking the true and predicted labels and
+            returning a score or a dictionary of metrics. It must be picklable. Defaults to
+            :func:`utils_nlp.eval.classification.eval_classification`.
+        rank_by (str, optional): Metric to rank the checkpoints by, "score" if `metric_fn`
+            returns a number. Defaults to "accuracy".
+        num_gpus (int, optional): Number of GPUs, and of concurrent evaluations, to use.
+            Defaults to None, all available GPUs. If 0 or no GPU is available, CPU is used.
+        num_cpus (int, optional): Number of CPU cores to use when running on CPU. Defaults to
+            None, all cores.
+        num_threads_per_worker (int, optional): Number of threads of each CPU worker. Defaults
+            to 1.
+        results_file (str, optional): CSV file to write the ranking to. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: One row per checkpoint with its metrics, per-class metrics averaged,
+            and "eval_time" in seconds, sorted by decreasing `rank_by`.
+    """
+    dataset = tensorize_dataset(eval_dataloader.dataset)
+    if labels is None:
+        labels = dataset.tensors[-1].numpy()
+    task_args = [
+        (checkpoint_dir, model_class, model_args, labels, metric_fn)
+        for checkpoint_dir in checkpoint_dirs
+    ]
+    results = _run(
+        _evaluate_classifier,
+        task_args,
+        dataset,
+        eval_dataloader.batch_size,
+        num_gpus,
+        num_cpus,
+        num_threads_per_worker,
+    )
+    return _rank(checkpoint_dirs, results, rank_by, results_file)
+
+
+def evaluate_qa_checkpoints(
+    model_args,
+    checkpoint_dirs,
+    eval_dataloader,
+    examples_file,
+    features_file,
+    actual_dataset,
+    output_dir,
+    do_lower_case=False,
+    unanswerable_exists=False,
+    postprocess_args=None,
+    rank_by="f1",
+    num_gpus=None,
+    num_cpus=None,
+    num_threads_per_worker=1,
+    results_file=None,
+):
+    """
+    Evaluates question answering checkpoints concurrently and ranks them.
+
+    Each checkpoint's logits are postprocessed with :func:`postprocess_bert_answer` or
+    :func:`postprocess_xlnet_answer` of :mod:`utils_nlp.models.transformers.question_answering`
+    and scored with :func:`utils_nlp.eval.question_answering.evaluate_qa`. The evaluation
+    features are shared in memory by the worker processes, see
+    :func:`evaluate_classifier_checkpoints`.
+
+    Args:
+        model_args (dict): Arguments of the AnswerExtractor constructor other than
+            `load_model_from_dir`, e.g. {"model_name": "bert-base-uncased"}.
+        checkpoint_dirs (list): Directories of the checkpoints.
+        eval_dataloader (DataLoader): Evaluation dataloader created by
+            :meth:`utils_nlp.models.transformers.question_answering.QAProcessor.preprocess`
+            with `is_training=False`.
+        examples_file (str): Examples file cached by `QAProcessor.preprocess`.
+        features_file (str): Features file cached by `QAProcessor.preprocess`.
+        actual_dataset (QADataset): Dataset with the ground truth answers.
+        output_dir (str): Directory where the predictions and evaluation results of each
+            checkpoint are saved, in a "checkpoint_<index>" subdirectory.
+        do_lower_case (bool, optional): Whether the tokenizer lowercases the text. Defaults to
+            False.
+        unanswerable_exists (bool, optional): Whether there are unanswerable questions. Defaults
+            to False.
+        postprocess_args (dict, optional): Additional arguments of the postprocessing function,
+            e.g. {"n_best_size": 20, "max_answer_length": 30}. Defaults to None.
+        rank_by (str, optional): Metric to rank the checkpoints by. Defaults to "f1".
+        num_gpus (int, optional): Number of GPUs, and of concurrent evaluations, to use.
+            Defaults to None, all available GPUs. If 0 or no GPU is available, CPU is used.
+        num_cpus (int, optional): Number of CPU cores to use when running on CPU. Defaults to
+            None, all cores.
+        num_threads_per_worker (int, optional): Number of threads of each CPU worker. Defaults
+            to 1.
+        results_file (str, optional): CSV file to write the ranking to. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: One row per checkpoint with the "exact" and "f1" scores, and the
+            other metrics of `evaluate_qa`, and "eval_time" in seconds, sorted by decreasing
+            `rank_by`.
+    """
+    task_args = [
+        (
+            checkpoint_dir,
+            os.path.join(output_dir, "checkpoint_{}".format(i)),
+            model_args,
+            examples_file,
+            features_file,
+            actual_dataset,
+            do_lower_case,
+            unanswerable_exists,
+            postprocess_args or {},
+        )
+        for i, checkpoint_dir in enumerate(checkpoint_dirs)
+    ]
+    results = _run(
+        _evaluate_answer_extractor,
+        task_args,
+        tensorize_dataset(eval_dataloader.dataset),
+        eval_dataloader.batch_size,
+        num_gpus,
+        num_cpus,
+        num_threads_per_worker,
+    )
+    return _rank(checkpoint_dirs, results, rank_by, results_file)
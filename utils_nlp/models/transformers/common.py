@@ -4,6 +4,7 @@
 # This script reuses some code from
 # https://github.com/huggingface/pytorch-transformers/blob/master/examples/run_glue.py
 
+import contextlib
 import logging
 import os
 import random
@@ -21,6 +22,18 @@ from transformers.tokenization_distilbert import DistilBertTokenizer
 from transformers.tokenization_roberta import RobertaTokenizer
 from transformers.tokenization_xlnet import XLNetTokenizer
 
+from utils_nlp.common.pytorch_utils import bf16_autocast
+from utils_nlp.common.timer import Timer
+from utils_nlp.models.transformers.flops import FlopCounter, get_model_config, log_flops_report
+from utils_nlp.models.transformers.gradient_checkpointing import (
+    NON_REENTRANT_CHECKPOINT,
+    disable_gradient_checkpointing,
+    enable_gradient_checkpointing,
+    is_gradient_checkpointing_enabled,
+)
+from utils_nlp.models.transformers.optimizer_sharding import ShardedOptimizer
+from utils_nlp.models.transformers.tracing import BucketedTracedModel
+
 TOKENIZER_CLASS = {}
 TOKENIZER_CLASS.update({k: BertTokenizer for k in BERT_PRETRAINED_MODEL_ARCHIVE_MAP})
 TOKENIZER_CLASS.update({k: RobertaTokenizer for k in ROBERTA_PRETRAINED_MODEL_ARCHIVE_MAP})
@@ -46,21 +59,31 @@ class Transformer:
             raise ValueError(
                 "Model name {0} is not supported by {1}. "
                 "Call '{1}.list_supported_models()' to get all supported model "
-                "names.".format(value, self.__class__.__name__)
+                "names.".format(model_name, self.__class__.__name__)
             )
         self._model_name = model_name
         self._model_type = model_name.split("-")[0]
         self.cache_dir = cache_dir
         self.load_model_from_dir = load_model_from_dir
-        if load_model_from_dir is None:
-            self.model = model_class[model_name].from_pretrained(
-                model_name, cache_dir=cache_dir, num_labels=num_labels, output_loading_info=False
-            )
-        else:
-            logger.info("Loading cached model from {}".format(load_model_from_dir))
-            self.model = model_class[model_name].from_pretrained(
-                load_model_from_dir, num_labels=num_labels, output_loading_info=False
+        self.model = self._create_model(model_class, num_labels)
+        self.traced_model = None
+        # peak FLOP/s of the hardware, to report the model FLOPs utilization of the runs
+        self.peak_flops = None
+        self.flops_report = None
+
+    def _create_model(self, model_class, num_labels):
+        """Loads the pre-trained model, or the model saved in `load_model_from_dir`."""
+        if self.load_model_from_dir is None:
+            return model_class[self.model_name].from_pretrained(
+                self.model_name,
+                cache_dir=self.cache_dir,
+                num_labels=num_labels,
+                output_loading_info=False,
             )
+        logger.info("Loading cached model from {}".format(self.load_model_from_dir))
+        return model_class[self.model_name].from_pretrained(
+            self.load_model_from_dir, num_labels=num_labels, output_loading_info=False
+        )
 
     @property
     def model_name(self):
@@ -96,13 +119,44 @@ class Transformer:
         warmup_steps=0,
         fp16=False,
         fp16_opt_level="O1",
+        bf16=False,
         local_rank=-1,
         verbose=True,
         seed=None,
+        max_len_schedule=None,
+        val_dataloader=None,
+        val_metric=None,
+        validation_steps=None,
+        early_stopping_patience=None,
+        best_model_dir=None,
+        gradient_checkpointing=False,
+        shard_optimizer_state=False,
+        validation_callback=None,
     ):
         if seed is not None:
             Transformer.set_seed(seed, n_gpu > 0)
 
+        if self.traced_model is not None:
+            logger.info("Discarding the traced model, call trace() again after fine-tuning.")
+            self.traced_model = None
+
+        Transformer._check_bf16(bf16, device, fp16)
+
+        if gradient_checkpointing and local_rank != -1 and not NON_REENTRANT_CHECKPOINT:
+            # DDP with find_unused_parameters fails on the reentrant backward passes
+            raise ValueError(
+                "gradient_checkpointing with distributed training requires torch 1.11 or later."
+            )
+
+        if shard_optimizer_state:
+            if local_rank == -1:
+                raise ValueError("shard_optimizer_state requires distributed training.")
+            if optimizer is not None or fp16:
+                raise ValueError(
+                    "shard_optimizer_state creates its own AdamW optimizer and can't be combined "
+                    "with a custom optimizer or fp16."
+                )
+
         if max_steps > 0:
             t_total = max_steps
             num_train_epochs = (
@@ -131,93 +185,391 @@ class Transformer:
                     "weight_decay": 0.0,
                 },
             ]
-            optimizer = AdamW(optimizer_grouped_parameters, lr=learning_rate, eps=adam_epsilon)
+            if shard_optimizer_state:
+                # each process keeps the AdamW moments of its shard of the parameters only
+                optimizer = ShardedOptimizer(
+                    AdamW, optimizer_grouped_parameters, lr=learning_rate, eps=adam_epsilon
+                )
+            else:
+                optimizer = AdamW(optimizer_grouped_parameters, lr=learning_rate, eps=adam_epsilon)
 
         if scheduler is None:
             scheduler = WarmupLinearSchedule(optimizer, warmup_steps=warmup_steps, t_total=t_total)
 
-        if fp16:
-            try:
-                from apex import amp
-            except ImportError:
-                raise ImportError("Please install apex from https://www.github.com/nvidia/apex")
-            self.model, optimizer = amp.initialize(self.model, optimizer, opt_level=fp16_opt_level)
-
-        # multi-gpu training (should be after apex fp16 initialization)
-        if n_gpu > 1:
-            self.model = torch.nn.DataParallel(self.model)
-
-        # Distributed training (should be after apex fp16 initialization)
-        if local_rank != -1:
-            self.model = torch.nn.parallel.DistributedDataParallel(
-                self.model,
-                device_ids=[local_rank],
-                output_device=local_rank,
-                find_unused_parameters=True,
-            )
+        enabled_checkpointing = False
+        if gradient_checkpointing and not is_gradient_checkpointing_enabled(self.model):
+            enable_gradient_checkpointing(self.model)
+            enabled_checkpointing = True
 
-        global_step = 0
-        tr_loss = 0.0
-        self.model.zero_grad()
-        train_iterator = trange(
-            int(num_train_epochs), desc="Epoch", disable=local_rank not in [-1, 0] or not verbose
-        )
+        try:
+            if fp16:
+                try:
+                    from apex import amp
+                except ImportError:
+                    raise ImportError("Please install apex from https://www.github.com/nvidia/apex")
+                self.model, optimizer = amp.initialize(
+                    self.model, optimizer, opt_level=fp16_opt_level
+                )
 
-        for _ in train_iterator:
-            epoch_iterator = tqdm(
-                train_dataloader, desc="Iteration", disable=local_rank not in [-1, 0] or not verbose
-            )
-            for step, batch in enumerate(epoch_iterator):
-                self.model.train()
-                batch = tuple(t.to(device) for t in batch)
-                inputs = get_inputs(batch, self.model_name)
-                outputs = self.model(**inputs)
-                loss = outputs[0]
+            # multi-gpu training (should be after apex fp16 initialization)
+            if n_gpu > 1:
+                self.model = torch.nn.DataParallel(self.model)
 
-                if n_gpu > 1:
-                    loss = loss.mean()
-                if gradient_accumulation_steps > 1:
-                    loss = loss / gradient_accumulation_steps
+            # Distributed training (should be after apex fp16 initialization)
+            if local_rank != -1:
+                # CPU processes, e.g. with the gloo backend, don't take device ids
+                device_ids = [local_rank] if device.type == "cuda" else None
+                self.model = torch.nn.parallel.DistributedDataParallel(
+                    self.model,
+                    device_ids=device_ids,
+                    output_device=local_rank if device_ids else None,
+                    find_unused_parameters=True,
+                )
 
-                if step % 10 == 0 and verbose:
-                    tqdm.write("Loss:{:.6f}".format(loss))
+            if max_len_schedule is not None:
+                if not hasattr(train_dataloader.dataset, "set_max_len"):
+                    raise ValueError(
+                        "max_len_schedule requires a dataset supporting set_max_len, e.g. a "
+                        "dataloader created with cache_tokens=True."
+                    )
+                initial_max_len = train_dataloader.dataset.max_len
 
-                if fp16:
-                    with amp.scale_loss(loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), max_grad_norm)
+            global_step = 0
+            tr_loss = 0.0
+            self.validation_history = []
+            best_score = None
+            best_state_dict = None
+            num_bad_validations = 0
+            stop_training = False
+
+            def _validate():
+                """Scores the model, keeps the best weights and returns whether to stop early."""
+                nonlocal best_score, best_state_dict, num_bad_validations
+                score = self._validate(val_dataloader, get_inputs, device, n_gpu, val_metric, bf16)
+                self.validation_history.append((global_step, score))
+                if verbose:
+                    tqdm.write("Step {0}, validation score:{1:.6f}".format(global_step, score))
+                if best_score is None or score > best_score:
+                    best_score = score
+                    num_bad_validations = 0
+                    model_to_save = (
+                        self.model.module if hasattr(self.model, "module") else self.model
+                    )
+                    if best_model_dir is None:
+                        best_state_dict = {
+                            k: v.detach().cpu().clone()
+                            for k, v in model_to_save.state_dict().items()
+                        }
+                    elif local_rank in [-1, 0]:
+                        # the processes share best_model_dir, only the first one writes it
+                        os.makedirs(best_model_dir, exist_ok=True)
+                        model_to_save.save_pretrained(best_model_dir)
                 else:
-                    loss.backward()
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_grad_norm)
-
-                tr_loss += loss.item()
-                if (step + 1) % gradient_accumulation_steps == 0:
-                    optimizer.step()
-                    scheduler.step()
-                    self.model.zero_grad()
-                    global_step += 1
-
-                if max_steps > 0 and global_step > max_steps:
-                    epoch_iterator.close()
+                    num_bad_validations += 1
+                if (
+                    early_stopping_patience is not None
+                    and num_bad_validations >= early_stopping_patience
+                ):
+                    logger.info(
+                        "Stopping early at step {0}, the validation score did not improve "
+                        "in the last {1} evaluations.".format(global_step, early_stopping_patience)
+                    )
+                    return True
+                if validation_callback is not None and validation_callback(global_step, score):
+                    logger.info(
+                        "Stopping at step {}, requested by the validation callback.".format(
+                            global_step
+                        )
+                    )
+                    return True
+                return False
+
+            if device.type == "cuda":
+                torch.cuda.reset_max_memory_allocated(device)
+            flop_counter = FlopCounter(
+                get_model_config(self.model),
+                train=True,
+                gradient_checkpointing=gradient_checkpointing,
+            )
+            train_timer = Timer()
+            train_timer.start()
+
+            self.model.zero_grad()
+            train_iterator = trange(
+                int(num_train_epochs),
+                desc="Epoch",
+                disable=local_rank not in [-1, 0] or not verbose,
+            )
+
+            for epoch in train_iterator:
+                if max_len_schedule is not None:
+                    # short sequences first, the full length in the later epochs
+                    max_len = max_len_schedule[min(epoch, len(max_len_schedule) - 1)]
+                    train_dataloader.dataset.set_max_len(max_len)
+                    logger.info("Epoch {0}: training with max_len {1}".format(epoch, max_len))
+                epoch_iterator = tqdm(
+                    train_dataloader,
+                    desc="Iteration",
+                    disable=local_rank not in [-1, 0] or not verbose,
+                )
+                for step, batch in enumerate(epoch_iterator):
+                    self.model.train()
+                    batch = tuple(t.to(device) for t in batch)
+                    inputs = get_inputs(batch, self.model_name)
+                    flop_counter.update(inputs)
+                    sync_gradients = (step + 1) % gradient_accumulation_steps == 0
+
+                    # gradients of the non-final micro-batches are accumulated locally and
+                    # all-reduced once, by the backward pass of the last micro-batch
+                    with contextlib.ExitStack() as stack:
+                        if local_rank != -1 and not sync_gradients:
+                            stack.enter_context(self.model.no_sync())
+                        if bf16:
+                            # the forward pass runs in bfloat16, the loss and the optimizer in
+                            # float32
+                            with bf16_autocast():
+                                outputs = self.model(**inputs)
+                            loss = outputs[0].float()
+                        else:
+                            outputs = self.model(**inputs)
+                            loss = outputs[0]
+
+                        if n_gpu > 1:
+                            loss = loss.mean()
+                        if gradient_accumulation_steps > 1:
+                            loss = loss / gradient_accumulation_steps
+
+                        if step % 10 == 0 and verbose:
+                            tqdm.write("Loss:{:.6f}".format(loss))
+
+                        if fp16:
+                            with amp.scale_loss(loss, optimizer) as scaled_loss:
+                                scaled_loss.backward()
+                        else:
+                            loss.backward()
+
+                    tr_loss += loss.item()
+                    if sync_gradients:
+                        # clip the accumulated gradients, which are identical across processes
+                        if fp16:
+                            torch.nn.utils.clip_grad_norm_(
+                                amp.master_params(optimizer), max_grad_norm
+                            )
+                        else:
+                            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_grad_norm)
+                        optimizer.step()
+                        scheduler.step()
+                        self.model.zero_grad()
+                        global_step += 1
+
+                        if (
+                            val_dataloader is not None
+                            and validation_steps is not None
+                            and global_step % validation_steps == 0
+                        ):
+                            stop_training = _validate()
+
+                    if (max_steps > 0 and global_step > max_steps) or stop_training:
+                        epoch_iterator.close()
+                        break
+                if val_dataloader is not None and validation_steps is None and not stop_training:
+                    stop_training = _validate()
+                if (max_steps > 0 and global_step > max_steps) or stop_training:
+                    train_iterator.close()
                     break
-            if max_steps > 0 and global_step > max_steps:
-                train_iterator.close()
-                break
 
-            # empty cache
-            del [batch]
-            torch.cuda.empty_cache()
+                # empty cache
+                del [batch]
+                torch.cuda.empty_cache()
+
+            if max_len_schedule is not None:
+                train_dataloader.dataset.set_max_len(initial_max_len)
+
+            train_timer.stop()
+            logger.info(
+                "Trained {0} steps in {1} s ({2:.4f} s per step){3}, "
+                "gradient checkpointing: {4}".format(
+                    global_step,
+                    train_timer,
+                    train_timer.interval / max(1, global_step),
+                    ", peak memory {} bytes".format(torch.cuda.max_memory_allocated(device))
+                    if device.type == "cuda"
+                    else "",
+                    gradient_checkpointing,
+                )
+            )
+            self.flops_report = flop_counter.report(train_timer.interval, self.peak_flops)
+            log_flops_report(self.flops_report, prefix="Training: ")
+        finally:
+            if enabled_checkpointing:
+                # also after an exception, not to leave the layer classes swapped
+                disable_gradient_checkpointing(self.model)
+
+        if best_score is not None:
+            # restore the weights with the best validation score
+            logger.info("Restoring the model with validation score {}".format(best_score))
+            model_to_load = self.model.module if hasattr(self.model, "module") else self.model
+            if best_model_dir is not None:
+                if local_rank != -1:
+                    # wait for the first process to finish writing the best weights
+                    torch.distributed.barrier()
+                best_state_dict = torch.load(
+                    os.path.join(best_model_dir, "pytorch_model.bin"), map_location="cpu"
+                )
+            model_to_load.load_state_dict(best_state_dict)
         return global_step, tr_loss / global_step
 
-    def predict(self, eval_dataloader, get_inputs, device, verbose=True):
+    @staticmethod
+    def _check_bf16(bf16, device, fp16=False):
+        if not bf16:
+            return
+        if fp16:
+            raise ValueError("fp16 and bf16 can't be used together.")
+        if device.type != "cpu":
+            raise ValueError(
+                "bf16 autocast is only supported on CPU, use fp16 for mixed precision on GPUs."
+            )
+
+    def _validate(
+        self, val_dataloader, get_inputs, device, n_gpu=1, val_metric=None, bf16=False
+    ):
+        """
+        Scores the model on validation data. Higher scores are better.
+
+        Args:
+            val_dataloader (DataLoader): Dataloader of the validation data, including labels.
+            get_inputs (function): Function converting a batch into model inputs.
+            device (torch.device): Device to run the model on.
+            n_gpu (int, optional): Number of GPUs the model is run on. Defaults to 1.
+            val_metric (function, optional): Function taking the arrays of true and predicted
+                labels and returning a score, e.g. `sklearn.metrics.accuracy_score`. For token
+                classification, padded tokens are excluded. Defaults to None, the negative
+                mean validation loss is used.
+            bf16 (bool, optional): Whether to run the model with CPU bfloat16 autocast.
+                Defaults to False.
+
+        Returns:
+            float: The validation score.
+        """
+        self.model.eval()
+        total_loss = 0.0
+        y_true = []
+        y_pred = []
+        for batch in val_dataloader:
+            batch = tuple(t.to(device) for t in batch)
+            with torch.no_grad():
+                inputs = get_inputs(batch, self.model_name)
+                if bf16:
+                    with bf16_autocast():
+                        outputs = self.model(**inputs)
+                else:
+                    outputs = self.model(**inputs)
+            loss = outputs[0].float()
+            if n_gpu > 1:
+                loss = loss.mean()
+            total_loss += loss.item()
+            if val_metric is not None:
+                if "labels" not in inputs:
+                    raise ValueError(
+                        "val_metric is only supported for classification models, the validation "
+                        "loss is used for other models."
+                    )
+                labels = inputs["labels"]
+                preds = outputs[1].argmax(dim=-1)
+                if labels.dim() > 1:
+                    # token classification, ignore padded tokens
+                    mask = inputs["attention_mask"] == 1
+                    labels = labels[mask]
+                    preds = preds[mask]
+                y_true.append(labels.cpu().numpy())
+                y_pred.append(preds.cpu().numpy())
+        self.model.train()
+
+        if val_metric is None:
+            return -total_loss / max(1, len(val_dataloader))
+        return val_metric(np.concatenate(y_true), np.concatenate(y_pred))
+
+    def trace(
+        self,
+        eval_dataloader,
+        get_inputs,
+        buckets,
+        device=None,
+        num_warmup=2,
+        validate=True,
+        rtol=1e-3,
+        atol=1e-4,
+    ):
+        """
+        Traces the model with TorchScript at a set of (batch size, sequence length) buckets.
+
+        Once traced, :meth:`predict` pads each batch to the smallest bucket that fits it and runs
+        the traced model, which avoids the Python dispatch overhead of the eager model at small
+        batch sizes. Every bucket is warmed up here so that the first batches are not slower.
+        The traced model is discarded by :meth:`fine_tune`.
+
+        Args:
+            eval_dataloader (DataLoader): Dataloader whose first batch is used as example input.
+            get_inputs (function): Function converting a batch into model inputs, e.g.
+                :meth:`utils_nlp.models.transformers.sequence_classification.Processor.get_inputs`.
+            buckets (list): List of (batch_size, seq_len) tuples to trace the model at.
+            device (torch.device, optional): Device to run the traced model on. Defaults to None,
+                the device of the model parameters.
+            num_warmup (int, optional): Number of warmup forward passes per bucket. Defaults to 2.
+            validate (bool, optional): Whether to check the traced outputs against the eager
+                model outputs. Defaults to True.
+            rtol (float, optional): Relative tolerance of the validation. Defaults to 1e-3.
+            atol (float, optional): Absolute tolerance of the validation. Defaults to 1e-4.
+
+        Returns:
+            :class:`utils_nlp.models.transformers.tracing.BucketedTracedModel`: The traced model.
+        """
+        if device is None:
+            device = next(self.model.parameters()).device
+        self.model.to(device)
+        batch = tuple(t.to(device) for t in next(iter(eval_dataloader)))
+        example_inputs = get_inputs(batch, self.model_name, train_mode=False)
+        self.traced_model = BucketedTracedModel(
+            self.model,
+            example_inputs,
+            buckets,
+            num_warmup=num_warmup,
+            validate=validate,
+            rtol=rtol,
+            atol=atol,
+        )
+        return self.traced_model
+
+    def _forward(self, inputs, device, bf16=False):
+        """
+        Runs the model with CPU bfloat16 autocast if `bf16` is True, otherwise the traced model
+        if available on `device`, and the eager model otherwise.
+        """
+        if bf16:
+            with bf16_autocast():
+                return self.model(**inputs)
+        if self.traced_model is not None and self.traced_model.runs_on(device):
+            return self.traced_model(inputs)
+        return self.model(**inputs)
+
+    def predict(self, eval_dataloader, get_inputs, device, verbose=True, bf16=False):
+        Transformer._check_bf16(bf16, device)
+        flop_counter = FlopCounter(get_model_config(self.model), train=False)
+        predict_timer = Timer()
+        predict_timer.start()
         for batch in tqdm(eval_dataloader, desc="Evaluating", disable=not verbose):
             self.model.eval()
             batch = tuple(t.to(device) for t in batch)
             with torch.no_grad():
                 inputs = get_inputs(batch, self.model_name, train_mode=False)
-                outputs = self.model(**inputs)
+                flop_counter.update(inputs)
+                outputs = self._forward(inputs, device, bf16)
                 logits = outputs[0]
-            yield logits.detach().cpu().numpy()
+            # numpy doesn't support bfloat16
+            yield logits.detach().cpu().float().numpy()
+        predict_timer.stop()
+        self.flops_report = flop_counter.report(predict_timer.interval, self.peak_flops)
+        log_flops_report(self.flops_report, prefix="Prediction: ")
 
     def save_model(self):
         output_model_dir = os.path.join(self.cache_dir, "fine_tuned")
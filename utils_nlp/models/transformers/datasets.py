@@ -119,6 +119,62 @@ class SPCDataSet(Dataset):
         return self.df.shape[0]
 
 
+class TokenizedDataSet(Dataset):
+    """
+    Dataset for sequence or sequence pair classification tasks that tokenizes the texts once.
+
+    The truncation and padding transform is applied to the cached tokens on access, so the
+    maximum sequence length can be changed with :meth:`set_max_len` without re-tokenizing,
+    e.g. to train the first epochs on shorter sequences.
+    """
+
+    def __init__(self, df, text_cols, label_col, tokenize, transform, max_len, **transform_args):
+        cols = list(df.columns)
+        self.transform = transform
+        self.transform_args = transform_args
+        self.max_len = max_len
+
+        text_col_ids = []
+        for text_col in text_cols:
+            if isinstance(text_col, int):
+                text_col_ids.append(text_col)
+            elif isinstance(text_col, str):
+                text_col_ids.append(cols.index(text_col))
+            else:
+                raise TypeError("text_col must be of type int or str")
+
+        if label_col is None:
+            self.labels = None
+        elif isinstance(label_col, int):
+            self.labels = df.iloc[:, label_col].tolist()
+        elif isinstance(label_col, str):
+            self.labels = df[label_col].tolist()
+        else:
+            raise TypeError("label_col must be of type int or str")
+
+        self.tokens = [[tokenize(t) for t in df.iloc[:, c]] for c in text_col_ids]
+
+    def set_max_len(self, max_len):
+        """Sets the maximum sequence length of the samples."""
+        self.max_len = max_len
+
+    def __getitem__(self, idx):
+        input_ids, attention_mask, token_type_ids = self.transform(
+            *[tokens[idx] for tokens in self.tokens], max_len=self.max_len, **self.transform_args
+        )
+        items = [
+            torch.tensor(input_ids, dtype=torch.long),
+            torch.tensor(attention_mask, dtype=torch.long),
+            torch.tensor(token_type_ids, dtype=torch.long),
+        ]
+        if self.labels is not None:
+            items.append(torch.tensor(self.labels[idx], dtype=torch.long))
+        return tuple(items)
+
+    def __len__(self):
+        return len(self.tokens[0])
+
+
 # QAInput is a data structure representing an unique document-question-answer triplet.
 # Args:
 #    doc_text (str): Input document text.
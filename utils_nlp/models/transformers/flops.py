@@ -0,0 +1,178 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Analytic FLOP counts of the transformer models and hardware utilization reporting."""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_model_dims(config):
+    """
+    Returns the dimensions of a BERT, RoBERTa, XLNet or DistilBERT model from its configuration.
+
+    Args:
+        config (PretrainedConfig): Model configuration.
+
+    Returns:
+        dict: Dictionary with the "num_layers", "hidden_size", "intermediate_size" and
+            "relative_attention" (True for XLNet) of the model.
+    """
+    if hasattr(config, "d_model"):
+        # XLNet
+        return {
+            "num_layers": config.n_layer,
+            "hidden_size": config.d_model,
+            "intermediate_size": config.d_inner,
+            "relative_attention": True,
+        }
+    if hasattr(config, "n_layers") and hasattr(config, "dim"):
+        # DistilBERT
+        return {
+            "num_layers": config.n_layers,
+            "hidden_size": config.dim,
+            "intermediate_size": config.hidden_dim,
+            "relative_attention": False,
+        }
+    return {
+        "num_layers": config.num_hidden_layers,
+        "hidden_size": config.hidden_size,
+        "intermediate_size": config.intermediate_size,
+        "relative_attention": False,
+    }
+
+
+def get_model_config(model):
+    """Returns the configuration of a model, a parallel wrapper or a multi-task model."""
+    if hasattr(model, "module"):
+        model = model.module
+    if hasattr(model, "config"):
+        return model.config
+    return model.encoder.config
+
+
+def forward_flops(dims, sum_len, sum_sq_len):
+    """
+    Returns the FLOPs of the encoder forward passes of a set of sequences, counting a
+    multiply-add as 2 FLOPs and ignoring embeddings, layer norms, softmax and heads.
+
+    Each layer runs per token the query, key, value and output projections, 8 h^2 FLOPs, and the
+    feed-forward network, 4 h i FLOPs, and per pair of tokens the attention scores and weighted
+    sum, 4 h FLOPs. XLNet's relative attention adds the projection of the 2 n relative
+    positions, 4 n h^2 FLOPs per sequence, and the position scores, 4 h FLOPs per token pair.
+
+    Args:
+        dims (dict): Model dimensions returned by :func:`get_model_dims`.
+        sum_len (int): Sum of the lengths n of the sequences.
+        sum_sq_len (int): Sum of the squared lengths n^2 of the sequences.
+
+    Returns:
+        int: Number of FLOPs.
+    """
+    h = dims["hidden_size"]
+    i = dims["intermediate_size"]
+    per_token = 8 * h * h + 4 * h * i
+    per_token_pair = 4 * h
+    if dims["relative_attention"]:
+        per_token += 4 * h * h
+        per_token_pair += 4 * h
+    return dims["num_layers"] * (per_token * sum_len + per_token_pair * sum_sq_len)
+
+
+class FlopCounter:
+    """
+    Accumulates the FLOPs of the batches of a training or inference run from their real token
+    counts and their padded shapes.
+
+    The token counts are summed on the device of the batches and only read when the report is
+    created, so that counting doesn't synchronize the GPU at every step.
+
+    Args:
+        config (PretrainedConfig): Model configuration.
+        train (bool, optional): Whether the batches are training steps, counted as 3 forward
+            passes, the backward pass costing twice the forward pass. Defaults to True.
+        gradient_checkpointing (bool, optional): Whether the activations are recomputed during the
+            backward pass, which adds one forward pass to the executed FLOPs but not to the
+            model FLOPs. Defaults to False.
+    """
+
+    def __init__(self, config, train=True, gradient_checkpointing=False):
+        self.dims = get_model_dims(config)
+        self.passes = 3 if train else 1
+        self.recompute_passes = 1 if train and gradient_checkpointing else 0
+        self.num_batches = 0
+        self.sum_len = 0
+        self.sum_sq_len = 0
+        self.padded_sum_len = 0
+        self.padded_sum_sq_len = 0
+
+    def update(self, inputs):
+        """
+        Adds a batch.
+
+        Args:
+            inputs (dict): Model inputs of the batch, with "input_ids" and, if the batch is
+                padded, "attention_mask".
+        """
+        batch_size, seq_len = inputs["input_ids"].shape[:2]
+        self.num_batches += 1
+        self.padded_sum_len += batch_size * seq_len
+        self.padded_sum_sq_len += batch_size * seq_len * seq_len
+        mask = inputs.get("attention_mask")
+        if mask is None:
+            self.sum_len += batch_size * seq_len
+            self.sum_sq_len += batch_size * seq_len * seq_len
+        else:
+            lengths = mask.sum(dim=1)
+            self.sum_len = lengths.sum() + self.sum_len
+            self.sum_sq_len = (lengths * lengths).sum() + self.sum_sq_len
+
+    def report(self, elapsed, peak_flops=None):
+        """
+        Returns the FLOP counts and utilization of the batches added so far.
+
+        Args:
+            elapsed (float): Duration of the run in seconds.
+            peak_flops (float, optional): Peak FLOP/s of the hardware, e.g. 125e12 for the
+                float16 tensor cores of a V100 GPU. Defaults to None, the utilization isn't
+                computed.
+
+        Returns:
+            dict: Dictionary with the "model_flops", FLOPs of the unpadded tokens, the
+                "executed_flops", FLOPs of the padded batches including recomputation, the
+                "padding_fraction" of the executed forward FLOPs spent on padding, the achieved
+                "model_flops_per_s" and "executed_flops_per_s", and the model FLOPs utilization
+                "mfu" if `peak_flops` is provided.
+        """
+        real = forward_flops(self.dims, int(self.sum_len), int(self.sum_sq_len))
+        padded = forward_flops(self.dims, self.padded_sum_len, self.padded_sum_sq_len)
+        model_flops = self.passes * real
+        executed_flops = (self.passes + self.recompute_passes) * padded
+        elapsed = max(elapsed, 1e-9)
+        report = {
+            "num_batches": self.num_batches,
+            "model_flops": model_flops,
+            "executed_flops": executed_flops,
+            "padding_fraction": 1 - real / padded if padded else 0.0,
+            "model_flops_per_s": model_flops / elapsed,
+            "executed_flops_per_s": executed_flops / elapsed,
+        }
+        if peak_flops:
+            report["mfu"] = report["model_flops_per_s"] / peak_flops
+        return report
+
+
+def log_flops_report(report, prefix=""):
+    """Logs a report returned by :meth:`FlopCounter.report`."""
+    logger.info(
+        "{0}{1:.3e} model FLOPs, {2:.3e} FLOP/s achieved ({3:.3e} executed FLOP/s), "
+        "{4:.1%} padding FLOPs{5}".format(
+            prefix,
+            report["model_flops"],
+            report["model_flops_per_s"],
+            report["executed_flops_per_s"],
+            report["padding_fraction"],
+            ", MFU {:.1%}".format(report["mfu"]) if "mfu" in report else "",
+        )
+    )
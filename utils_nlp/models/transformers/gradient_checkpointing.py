@@ -0,0 +1,163 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Activation (gradient) checkpointing of the encoder layers of transformer models."""
+
+import inspect
+import logging
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+from utils_nlp.common.timer import Timer
+from utils_nlp.models.transformers.batch_size_finder import measure_peak_memory
+
+logger = logging.getLogger(__name__)
+
+# checkpointed subclasses of the encoder layer classes
+_CHECKPOINTED_CLASSES = {}
+
+# non-reentrant checkpointing, available from torch 1.11, supports DDP with unused parameters
+NON_REENTRANT_CHECKPOINT = "use_reentrant" in inspect.signature(checkpoint).parameters
+_CHECKPOINT_KWARGS = {"use_reentrant": False} if NON_REENTRANT_CHECKPOINT else {}
+
+
+def _checkpointed_class(cls):
+    """Creates a subclass of a layer class whose forward pass is checkpointed when training."""
+    if cls in _CHECKPOINTED_CLASSES:
+        return _CHECKPOINTED_CLASSES[cls]
+
+    def forward(self, *args, **kwargs):
+        if not (self.training and torch.is_grad_enabled()):
+            return cls.forward(self, *args, **kwargs)
+
+        # checkpoint only accepts positional inputs, so keyword inputs, e.g. the hidden states
+        # of DistilBERT layers, are passed positionally and put back in place
+        keys = list(kwargs)
+        num_args = len(args)
+        none_outputs = []
+
+        def _run(*inputs):
+            outputs = cls.forward(self, *inputs[:num_args], **dict(zip(keys, inputs[num_args:])))
+            if isinstance(outputs, torch.Tensor):
+                return outputs
+            # checkpoint can't return None, e.g. the query stream output of XLNet layers
+            none_outputs[:] = [i for i, o in enumerate(outputs) if o is None]
+            return tuple(o for o in outputs if o is not None)
+
+        outputs = checkpoint(_run, *args, *[kwargs[k] for k in keys], **_CHECKPOINT_KWARGS)
+        if isinstance(outputs, torch.Tensor):
+            return outputs
+        outputs = list(outputs)
+        for i in none_outputs:
+            outputs.insert(i, None)
+        return tuple(outputs)
+
+    _CHECKPOINTED_CLASSES[cls] = type(
+        cls.__name__, (cls,), {"forward": forward, "_checkpoint_base_class": cls}
+    )
+    return _CHECKPOINTED_CLASSES[cls]
+
+
+def get_encoder_layers(model):
+    """
+    Returns the encoder layers of a transformer model, e.g. `model.bert.encoder.layer` for BERT
+    or `model.transformer.layer` for XLNet.
+
+    Args:
+        model (torch.nn.Module): A BERT, RoBERTa, XLNet or DistilBERT model.
+
+    Returns:
+        list: List of the encoder layer modules.
+    """
+    if hasattr(model, "module"):
+        model = model.module
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.ModuleList) and name.split(".")[-1] == "layer":
+            return list(module)
+    raise ValueError("No encoder layers found in model {}.".format(type(model).__name__))
+
+
+def enable_gradient_checkpointing(model):
+    """
+    Checkpoints the activations of each encoder layer during training. The activations inside
+    the layers are recomputed during the backward pass instead of being stored, which reduces
+    the memory needed for training at the cost of about one extra forward pass. The parameters
+    and state dict of the model are unchanged.
+
+    Args:
+        model (torch.nn.Module): A BERT, RoBERTa, XLNet or DistilBERT model.
+    """
+    for layer in get_encoder_layers(model):
+        if not hasattr(layer, "_checkpoint_base_class"):
+            layer.__class__ = _checkpointed_class(layer.__class__)
+
+
+def disable_gradient_checkpointing(model):
+    """Reverts :func:`enable_gradient_checkpointing`."""
+    for layer in get_encoder_layers(model):
+        if hasattr(layer, "_checkpoint_base_class"):
+            layer.__class__ = layer._checkpoint_base_class
+
+
+def is_gradient_checkpointing_enabled(model):
+    """Whether the encoder layers of a model are checkpointed."""
+    return all(hasattr(layer, "_checkpoint_base_class") for layer in get_encoder_layers(model))
+
+
+def compare_gradient_checkpointing(transformer, dataloader, get_inputs, device, num_steps=3):
+    """
+    Measures the peak memory and step time of training steps with and without gradient
+    checkpointing.
+
+    Args:
+        transformer (Transformer): Model to profile, e.g. an instance of
+            :class:`utils_nlp.models.transformers.question_answering.AnswerExtractor`.
+        dataloader (DataLoader): Training dataloader. The first `num_steps` batches are used.
+        get_inputs (function): Function converting a batch into model inputs, e.g.
+            :meth:`utils_nlp.models.transformers.question_answering.QAProcessor.get_inputs`.
+        device (torch.device): Device to run the training steps on.
+        num_steps (int, optional): Number of training steps to run in each mode. Defaults to 3.
+
+    Returns:
+        dict: Dictionary with keys "without_checkpointing" and "with_checkpointing", each a
+            dictionary with the "peak_memory" in bytes and the mean "step_time" in seconds.
+    """
+    model = transformer.model
+    model.to(device)
+    was_enabled = is_gradient_checkpointing_enabled(model)
+    batches = []
+    for batch in dataloader:
+        batches.append(tuple(t.to(device) for t in batch))
+        if len(batches) == num_steps:
+            break
+
+    results = {}
+    try:
+        for enabled in [False, True]:
+            if enabled:
+                enable_gradient_checkpointing(model)
+            else:
+                disable_gradient_checkpointing(model)
+            peak_memory = 0
+            step_times = []
+            for batch in batches:
+                inputs = get_inputs(batch, transformer.model_name)
+                with Timer() as t:
+                    peak = measure_peak_memory(model, inputs, device, train=True)
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+                peak_memory = max(peak_memory, peak)
+                step_times.append(t.interval)
+            key = "with_checkpointing" if enabled else "without_checkpointing"
+            results[key] = {
+                "peak_memory": peak_memory,
+                "step_time": sum(step_times) / len(step_times),
+            }
+            logger.info("{0}: {1}".format(key, results[key]))
+    finally:
+        if was_enabled:
+            enable_gradient_checkpointing(model)
+        else:
+            disable_gradient_checkpointing(model)
+    return results
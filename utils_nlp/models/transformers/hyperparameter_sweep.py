@@ -0,0 +1,329 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Concurrent hyperparameter sweeps with successive halving over the transformer models' fit."""
+
+import itertools
+import logging
+import os
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+
+from utils_nlp.common.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+# fit arguments a trial can't override, they are set by the sweep
+_RESERVED_ARGS = {
+    "train_dataloader",
+    "val_dataloader",
+    "val_metric",
+    "validation_steps",
+    "validation_callback",
+    "num_gpus",
+    "local_rank",
+}
+
+# state of a sweep worker process, set by _init_worker
+_WORKER = {}
+
+
+def tensorize_dataset(dataset):
+    """
+    Converts a dataset into a :class:`torch.utils.data.TensorDataset` by running its transform on
+    every sample once, e.g. to tokenize the texts of a
+    :class:`utils_nlp.models.transformers.datasets.SCDataSet` a single time for all trials of a
+    sweep. The tensors are moved to shared memory, so worker processes don't copy them.
+
+    Args:
+        dataset (Dataset): Dataset whose samples are tuples of tensors of the same shapes.
+
+    Returns:
+        TensorDataset: Dataset with the stacked samples.
+    """
+    if isinstance(dataset, TensorDataset):
+        tensors = dataset.tensors
+    else:
+        samples = [dataset[i] for i in range(len(dataset))]
+        tensors = [torch.stack(field) for field in zip(*samples)]
+    return TensorDataset(*[t.share_memory_() for t in tensors])
+
+
+def expand_param_grid(param_grid):
+    """
+    Expands a hyperparameter grid into a list of trial configurations.
+
+    Args:
+        param_grid (dict or list): Dictionary mapping `fit` arguments, or "batch_size", to lists
+            of values, whose Cartesian product is expanded, or a list of such dictionaries, or a
+            list of configurations.
+
+    Returns:
+        list: List of dictionaries of hyperparameter values.
+    """
+    if isinstance(param_grid, dict):
+        param_grid = [param_grid]
+    configs = []
+    for grid in param_grid:
+        if all(isinstance(v, (list, tuple)) for v in grid.values()):
+            keys = sorted(grid)
+            configs.extend(dict(zip(keys, v)) for v in itertools.product(*(grid[k] for k in keys)))
+        else:
+            configs.append(dict(grid))
+    return configs
+
+
+def get_rungs(max_epochs, min_epochs=1, reduction_factor=3):
+    """Returns the epochs after which trials are compared, e.g. [1, 3, 9] for 10 max_epochs."""
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= reduction_factor
+    return rungs
+
+
+def _init_worker(train_dataset, val_dataset, devices, num_threads, rung_scores, lock):
+    device = devices.get()
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    else:
+        torch.set_num_threads(num_threads)
+    _WORKER.update(
+        {
+            "train_dataset": train_dataset,
+            "val_dataset": val_dataset,
+            "device": device,
+            "rung_scores": rung_scores,
+            "lock": lock,
+        }
+    )
+
+
+def _should_prune(rung, score, reduction_factor):
+    """Records a score at a rung and returns whether it's not in the top scores of the rung."""
+    with _WORKER["lock"]:
+        scores = _WORKER["rung_scores"].get(rung, []) + [score]
+        _WORKER["rung_scores"][rung] = scores
+    num_promoted = max(1, len(scores) // reduction_factor)
+    return score < sorted(scores, reverse=True)[num_promoted - 1]
+
+
+def _run_trial(
+    trial_id,
+    params,
+    model_class,
+    model_args,
+    fit_args,
+    val_metric,
+    batch_size,
+    rungs,
+    reduction_factor,
+    seed,
+):
+    """Trains one configuration in a worker process and returns its results row."""
+    params = dict(params)
+    trial_batch_size = params.pop("batch_size", batch_size)
+    train_dataset = _WORKER["train_dataset"]
+    val_dataset = _WORKER["val_dataset"]
+    train_dataloader = DataLoader(
+        train_dataset, sampler=RandomSampler(train_dataset), batch_size=trial_batch_size
+    )
+    val_dataloader = DataLoader(
+        val_dataset, sampler=SequentialSampler(val_dataset), batch_size=trial_batch_size
+    )
+
+    num_validations = [0]
+    pruned_at = [None]
+
+    def _validation_callback(step, score):
+        num_validations[0] += 1
+        epoch = num_validations[0]
+        if epoch in rungs and _should_prune(epoch, score, reduction_factor):
+            pruned_at[0] = epoch
+            return True
+        return False
+
+    result = {"trial": trial_id}
+    result.update(params)
+    if "batch_size" not in result:
+        result["batch_size"] = trial_batch_size
+    model = None
+    try:
+        with Timer() as t:
+            model = model_class(**model_args)
+            model.fit(
+                train_dataloader=train_dataloader,
+                num_gpus=1 if _WORKER["device"].type == "cuda" else 0,
+                val_dataloader=val_dataloader,
+                val_metric=val_metric,
+                validation_callback=_validation_callback,
+                seed=seed,
+                **dict(fit_args, **params)
+            )
+        scores = [score for _, score in model.validation_history]
+        result.update(
+            {
+                "status": "pruned" if pruned_at[0] is not None else "completed",
+                "best_score": max(scores),
+                "last_score": scores[-1],
+                "epochs": num_validations[0],
+                "train_time": t.interval,
+            }
+        )
+    except Exception as e:
+        logger.exception("Trial {} failed.".format(trial_id))
+        result.update({"status": "failed", "error": repr(e)})
+    finally:
+        del model
+        if _WORKER["device"].type == "cuda":
+            torch.cuda.empty_cache()
+    logger.info("Trial {0}: {1}".format(trial_id, result))
+    return result
+
+
+def run_hyperparameter_sweep(
+    model_class,
+    model_args,
+    train_dataloader,
+    val_dataloader,
+    param_grid,
+    val_metric=None,
+    fit_args=None,
+    max_epochs=None,
+    min_epochs=1,
+    reduction_factor=3,
+    num_gpus=None,
+    num_cpus=None,
+    num_threads_per_trial=1,
+    seed=None,
+    results_file=None,
+):
+    """
+    Runs a hyperparameter sweep over the `fit` method of a transformer model.
+
+    The training and validation sets are tokenized once, into tensors in shared memory used by
+    all trials. Trials run concurrently in worker processes, one per GPU, or one per
+    `num_threads_per_trial` CPU cores when no GPU is used. The trials are evaluated on the
+    validation set after each epoch and pruned by asynchronous successive halving: after
+    `min_epochs`, `min_epochs * reduction_factor`, ... epochs, a trial continues only if its
+    score is in the top `1 / reduction_factor` of the scores of all trials that reached that
+    epoch so far.
+
+    Args:
+        model_class (type): Model class, `SequenceClassifier` from
+            :mod:`utils_nlp.models.transformers.sequence_classification` or `TokenClassifier`
+            from :mod:`utils_nlp.models.transformers.named_entity_recognition`.
+        model_args (dict): Arguments of the model constructor, e.g. {"model_name":
+            "bert-base-uncased", "num_labels": 2, "cache_dir": "."}.
+        train_dataloader (DataLoader): Training dataloader. Its dataset is tokenized once and
+            its batch size is used by the trials without a "batch_size" hyperparameter.
+        val_dataloader (DataLoader): Labeled validation dataloader used for pruning and ranking.
+        param_grid (dict or list): Hyperparameters to try, see :func:`expand_param_grid`. Keys
+            are `fit` arguments, e.g. "learning_rate", "warmup_steps" and "num_epochs", or
+            "batch_size".
+        val_metric (function, optional): Function taking the true and predicted labels and
+            returning a score to maximize, e.g. `sklearn.metrics.accuracy_score`. It must be
+            picklable. Defaults to None, the negative validation loss is used.
+        fit_args (dict, optional): Fixed `fit` arguments of all trials. Defaults to None.
+        max_epochs (int, optional): Largest number of epochs of the trials, used to compute the
+            pruning rungs. Defaults to None, the largest "num_epochs" of the configurations.
+        min_epochs (int, optional): Number of epochs before the first pruning. Defaults to 1.
+        reduction_factor (int, optional): Fraction of trials pruned at each rung is
+            `1 - 1 / reduction_factor`. Defaults to 3.
+        num_gpus (int, optional): Number of GPUs, and of concurrent trials, to use. Defaults to
+            None, all available GPUs. If 0 or no GPU is available, the trials run on CPU.
+        num_cpus (int, optional): Number of CPU cores to use when running on CPU. Defaults to
+            None, all cores.
+        num_threads_per_trial (int, optional): Number of threads of each CPU trial. Defaults to
+            1.
+        seed (int, optional): Random seed of all trials. Defaults to None.
+        results_file (str, optional): CSV file to write the results table to. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: One row per trial with its hyperparameters, "status" ("completed",
+            "pruned" or "failed"), "best_score", "last_score", "epochs" and "train_time" in
+            seconds, sorted by decreasing best score.
+    """
+    configs = expand_param_grid(param_grid)
+    fit_args = dict(fit_args or {})
+    reserved = _RESERVED_ARGS.intersection(set(fit_args).union(*configs))
+    if reserved:
+        raise ValueError("Arguments {} are set by the sweep.".format(sorted(reserved)))
+    if max_epochs is None:
+        max_epochs = max(c.get("num_epochs", fit_args.get("num_epochs", 1)) for c in configs)
+    rungs = get_rungs(max_epochs, min_epochs, reduction_factor)
+
+    if num_gpus is None:
+        num_gpus = torch.cuda.device_count()
+    num_gpus = min(num_gpus, torch.cuda.device_count())
+    if num_gpus > 0:
+        devices = [torch.device("cuda", i) for i in range(num_gpus)]
+    else:
+        num_cpus = num_cpus or os.cpu_count()
+        devices = [torch.device("cpu")] * max(1, num_cpus // num_threads_per_trial)
+    num_workers = min(len(devices), len(configs))
+
+    with Timer() as t:
+        train_dataset = tensorize_dataset(train_dataloader.dataset)
+        val_dataset = tensorize_dataset(val_dataloader.dataset)
+    logger.info("Tokenized the training and validation sets in {:.2f} s".format(t.interval))
+    logger.info(
+        "Running {0} trials on {1} workers, pruning after epochs {2}".format(
+            len(configs), num_workers, rungs
+        )
+    )
+
+    ctx = mp.get_context("spawn")
+    manager = ctx.Manager()
+    device_queue = manager.Queue()
+    for device in devices[:num_workers]:
+        device_queue.put(device)
+    pool = ctx.Pool(
+        num_workers,
+        initializer=_init_worker,
+        initargs=(
+            train_dataset,
+            val_dataset,
+            device_queue,
+            num_threads_per_trial,
+            manager.dict(),
+            manager.Lock(),
+        ),
+    )
+    try:
+        results = pool.starmap(
+            _run_trial,
+            [
+                (
+                    i,
+                    config,
+                    model_class,
+                    model_args,
+                    fit_args,
+                    val_metric,
+                    train_dataloader.batch_size,
+                    rungs,
+                    reduction_factor,
+                    seed,
+                )
+                for i, config in enumerate(configs)
+            ],
+            chunksize=1,
+        )
+    finally:
+        pool.close()
+        pool.join()
+        manager.shutdown()
+
+    results = pd.DataFrame(results)
+    if "best_score" in results:
+        results = results.sort_values("best_score", ascending=False, na_position="last")
+    results = results.reset_index(drop=True)
+    if results_file is not None:
+        results.to_csv(results_file, index=False)
+        logger.info("Sweep results saved to {}".format(results_file))
+    return results
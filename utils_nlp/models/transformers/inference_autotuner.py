@@ -0,0 +1,243 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Autotuning of the number of threads, processes and the batch size for CPU inference."""
+
+import contextlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import time
+from queue import Empty
+
+import torch
+from torch.utils.data import DataLoader, SequentialSampler, Subset
+
+from utils_nlp.common.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+
+def _benchmark_worker(model, model_name, dataset, get_inputs, num_threads, batch_size, queue):
+    """Runs inference on `dataset` with the given settings and reports the elapsed time."""
+    torch.set_num_threads(num_threads)
+    model.eval()
+    dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+    with torch.no_grad():
+        # warm up
+        model(**get_inputs(next(iter(dataloader)), model_name, train_mode=False))
+        with Timer() as t:
+            for batch in dataloader:
+                model(**get_inputs(batch, model_name, train_mode=False))
+    queue.put(t.interval)
+
+
+def _benchmark(transformer, dataset, get_inputs, num_threads, num_processes, batch_size, timeout):
+    """
+    Returns the throughput, in samples per second, of an inference configuration, or None if a
+    worker fails or doesn't finish within `timeout` seconds.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    shard_size = len(dataset) // num_processes
+    workers = [
+        ctx.Process(
+            target=_benchmark_worker,
+            args=(
+                transformer.model,
+                transformer.model_name,
+                Subset(dataset, range(i * shard_size, (i + 1) * shard_size)),
+                get_inputs,
+                num_threads,
+                batch_size,
+                queue,
+            ),
+        )
+        for i in range(num_processes)
+    ]
+    for w in workers:
+        w.start()
+    elapsed = []
+    deadline = time.time() + timeout
+    while len(elapsed) < num_processes:
+        try:
+            elapsed.append(queue.get(timeout=1))
+        except Empty:
+            # a worker killed, e.g. out of memory, never reports its time
+            exitcodes = [w.exitcode for w in workers if w.exitcode not in (None, 0)]
+            if exitcodes or time.time() > deadline:
+                logger.warning(
+                    "Benchmark workers {}, skipping the configuration.".format(
+                        "exited with codes {}".format(exitcodes) if exitcodes else "timed out"
+                    )
+                )
+                for w in workers:
+                    w.terminate()
+                    w.join()
+                return None
+    for w in workers:
+        w.join()
+    # the processes run concurrently, the slowest one determines the throughput
+    return shard_size * num_processes / max(elapsed)
+
+
+def autotune_cpu_inference(
+    transformer,
+    dataset,
+    get_inputs,
+    thread_counts=None,
+    process_counts=None,
+    batch_sizes=(1, 8, 16, 32, 64),
+    num_samples=256,
+    output_file=None,
+    timeout=600,
+):
+    """
+    Benchmarks CPU inference throughput over a grid of thread counts, process counts and batch
+    sizes and returns the fastest configuration.
+
+    Configurations using more threads in total than there are cores on the host are skipped,
+    because oversubscribed cores slow all workers down. Each process runs on its own shard of
+    the samples, so the throughput of several processes models several inference workers
+    running side by side.
+
+    Args:
+        transformer (Transformer): Model to benchmark, e.g. an instance of
+            :class:`utils_nlp.models.transformers.sequence_classification.SequenceClassifier`.
+            It's moved to CPU.
+        dataset (Dataset): Dataset of samples tokenized to the `max_len` used in production,
+            e.g. the `dataset` attribute of a dataloader created by the
+            `create_dataloader_from_df` method of
+            :class:`utils_nlp.models.transformers.sequence_classification.Processor`.
+        get_inputs (function): Function converting a batch into model inputs, e.g.
+            :meth:`utils_nlp.models.transformers.sequence_classification.Processor.get_inputs`.
+        thread_counts (list, optional): Numbers of threads per process to try. Defaults to None,
+            powers of 2 up to the number of cores.
+        process_counts (list, optional): Numbers of processes to try. Defaults to None, powers
+            of 2 up to the number of cores.
+        batch_sizes (list, optional): Batch sizes to try. Defaults to (1, 8, 16, 32, 64).
+        num_samples (int, optional): Number of samples used for each configuration. Defaults to
+            256.
+        output_file (str, optional): JSON file to save the best configuration to, which can be
+            passed to the `inference_config` argument of `predict`. Defaults to None.
+        timeout (float, optional): Number of seconds after which the benchmark of a
+            configuration is abandoned and the configuration skipped, like configurations whose
+            workers crash. Defaults to 600.
+
+    Returns:
+        dict: The best configuration, with keys "num_threads", "num_processes", "batch_size" and
+            "throughput" (samples per second), and the "model_name", "max_len", "host" and
+            "cpu_count" it was measured for. The throughput of all configurations is listed under
+            "results".
+    """
+    cpu_count = os.cpu_count()
+    powers_of_2 = [2 ** i for i in range(cpu_count.bit_length()) if 2 ** i <= cpu_count]
+    thread_counts = thread_counts or powers_of_2
+    process_counts = process_counts or powers_of_2
+
+    transformer.model.to(torch.device("cpu"))
+    dataset = Subset(dataset, range(min(num_samples, len(dataset))))
+
+    results = []
+    for num_threads, num_processes, batch_size in itertools.product(
+        thread_counts, process_counts, batch_sizes
+    ):
+        if num_threads * num_processes > cpu_count:
+            continue
+        if len(dataset) // num_processes < batch_size:
+            continue
+        throughput = _benchmark(
+            transformer, dataset, get_inputs, num_threads, num_processes, batch_size, timeout
+        )
+        if throughput is None:
+            continue
+        logger.info(
+            "threads: {0}, processes: {1}, batch size: {2}, {3:.2f} samples/s".format(
+                num_threads, num_processes, batch_size, throughput
+            )
+        )
+        results.append(
+            {
+                "num_threads": num_threads,
+                "num_processes": num_processes,
+                "batch_size": batch_size,
+                "throughput": throughput,
+            }
+        )
+    if not results:
+        raise ValueError("No configuration fits the number of cores and samples, or completed.")
+
+    config = dict(max(results, key=lambda r: r["throughput"]))
+    config.update(
+        {
+            "model_name": transformer.model_name,
+            "max_len": dataset[0][0].size(0),
+            "host": platform.node(),
+            "cpu_count": cpu_count,
+            "results": results,
+        }
+    )
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump(config, f, indent=4)
+        logger.info("Inference configuration saved to {}".format(output_file))
+    return config
+
+
+def load_inference_config(inference_config):
+    """
+    Loads an inference configuration saved by :func:`autotune_cpu_inference`.
+
+    Args:
+        inference_config (str or dict): Path of the JSON file, or the configuration itself.
+
+    Returns:
+        dict: The inference configuration.
+    """
+    if isinstance(inference_config, dict):
+        return inference_config
+    with open(inference_config) as f:
+        config = json.load(f)
+    if config.get("host") != platform.node():
+        logger.warning(
+            "The inference configuration was tuned on host {0}, not on {1}.".format(
+                config.get("host"), platform.node()
+            )
+        )
+    return config
+
+
+@contextlib.contextmanager
+def apply_inference_config(inference_config, dataloader):
+    """
+    Context manager setting the number of threads of an inference configuration and rebatching
+    a dataloader with its batch size. The previous number of threads is restored on exit. The
+    number of processes is not applied, it's the recommended number of inference workers to run
+    on the host, each with this configuration.
+
+    Args:
+        inference_config (str or dict): Path of the JSON file saved by
+            :func:`autotune_cpu_inference`, or the configuration itself.
+        dataloader (DataLoader): Evaluation dataloader.
+
+    Yields:
+        DataLoader: Sequential dataloader over the same dataset with the tuned batch size, and
+            the collate function, workers and memory pinning of `dataloader`.
+    """
+    config = load_inference_config(inference_config)
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(config["num_threads"])
+    try:
+        yield DataLoader(
+            dataloader.dataset,
+            sampler=SequentialSampler(dataloader.dataset),
+            batch_size=config["batch_size"],
+            collate_fn=dataloader.collate_fn,
+            num_workers=dataloader.num_workers,
+            pin_memory=dataloader.pin_memory,
+        )
+    finally:
+        torch.set_num_threads(num_threads)
@@ -0,0 +1,395 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Token length profiling to choose max_len, doc_stride and batch sizes from the data."""
+
+import logging
+import math
+
+import numpy as np
+import pandas as pd
+
+from utils_nlp.models.transformers.common import MAX_SEQ_LEN
+from utils_nlp.models.transformers.datasets import QAInput
+from utils_nlp.models.transformers.flops import forward_flops, get_model_dims
+from utils_nlp.models.transformers.question_answering import _create_qa_example
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_LENS = (64, 128, 192, 256, 320, 384, 448, 512)
+DEFAULT_DOC_STRIDES = (64, 128, 192, 256)
+PERCENTILES = (50, 90, 95, 99, 100)
+# default max_len, doc_stride and batch size of the processors, the baseline of the costs
+DEFAULT_DOC_STRIDE = 128
+DEFAULT_BATCH_SIZE = 32
+
+# dimensions of bert-base, used to project costs when no model configuration is given
+_BERT_BASE_DIMS = {
+    "num_layers": 12,
+    "hidden_size": 768,
+    "intermediate_size": 3072,
+    "relative_attention": False,
+}
+
+
+def count_doc_spans(doc_len, max_tokens_for_doc, doc_stride):
+    """
+    Returns the number of document spans of the sliding window of
+    :meth:`utils_nlp.models.transformers.question_answering.QAProcessor.preprocess`.
+
+    Args:
+        doc_len (int): Number of tokens of the document.
+        max_tokens_for_doc (int): Maximum number of document tokens per span.
+        doc_stride (int): Number of tokens the window moves between spans.
+
+    Returns:
+        int: Number of spans.
+    """
+    if doc_len == 0:
+        return 0
+    if doc_len <= max_tokens_for_doc:
+        return 1
+    step = min(max_tokens_for_doc, doc_stride)
+    return 1 + int(math.ceil((doc_len - max_tokens_for_doc) / step))
+
+
+def recommend_batch_size(max_len, tokens_per_batch=DEFAULT_BATCH_SIZE * MAX_SEQ_LEN):
+    """
+    Returns the largest power of two batch size with at most `tokens_per_batch` padded tokens,
+    which keeps the activation memory of a batch about constant across max_len values. Use
+    :func:`utils_nlp.models.transformers.batch_size_finder.find_max_batch_size` to measure the
+    largest batch size fitting in memory instead.
+    """
+    batch_size = 1
+    while batch_size * 2 * max_len <= tokens_per_batch:
+        batch_size *= 2
+    return batch_size
+
+
+def _sample_indices(num_items, sample_size, seed):
+    if sample_size is None or num_items <= sample_size:
+        return np.arange(num_items)
+    return np.sort(np.random.RandomState(seed).choice(num_items, sample_size, replace=False))
+
+
+def _get_dims(config):
+    return _BERT_BASE_DIMS if config is None else get_model_dims(config)
+
+
+def _padded_cost(dims, num_sequences, max_len):
+    """FLOPs of the forward passes of `num_sequences` sequences padded to `max_len`."""
+    return forward_flops(dims, num_sequences * max_len, num_sequences * max_len * max_len)
+
+
+def _log_report(report):
+    logger.info(
+        "{0}: {1} of {2} samples profiled, token length percentiles {3}".format(
+            report["task"], report["num_samples"], report["total_samples"], report["percentiles"]
+        )
+    )
+    logger.info("Recommended setting: {}".format(report["recommended"]))
+
+
+def _profile_sequences(
+    task, lengths, total_samples, max_lens, max_truncation_rate, tokens_per_batch, config
+):
+    lengths = np.asarray(lengths)
+    dims = _get_dims(config)
+    baseline_cost = _padded_cost(dims, total_samples, MAX_SEQ_LEN)
+    rows = []
+    for max_len in max_lens:
+        cost = _padded_cost(dims, total_samples, max_len)
+        rows.append(
+            {
+                "max_len": max_len,
+                "truncation_rate": float(np.mean(lengths > max_len)),
+                "batch_size": recommend_batch_size(max_len, tokens_per_batch),
+                "flops": cost,
+                "relative_cost": cost / baseline_cost,
+            }
+        )
+    candidates = pd.DataFrame(rows)
+
+    valid = candidates[candidates["truncation_rate"] <= max_truncation_rate]
+    best = valid.iloc[0] if len(valid) else candidates.iloc[-1]
+    report = {
+        "task": task,
+        "num_samples": len(lengths),
+        "total_samples": total_samples,
+        "percentiles": {p: int(np.percentile(lengths, p)) for p in PERCENTILES},
+        "candidates": candidates,
+        "recommended": {
+            "max_len": int(best["max_len"]),
+            "batch_size": int(best["batch_size"]),
+            "truncation_rate": float(best["truncation_rate"]),
+            "relative_cost": float(best["relative_cost"]),
+        },
+    }
+    _log_report(report)
+    return report
+
+
+def profile_sequence_classification(
+    processor,
+    df,
+    text_col,
+    text2_col=None,
+    sample_size=10000,
+    seed=42,
+    max_lens=DEFAULT_MAX_LENS,
+    max_truncation_rate=0.01,
+    tokens_per_batch=DEFAULT_BATCH_SIZE * MAX_SEQ_LEN,
+    config=None,
+):
+    """
+    Profiles the token lengths of a sample of a sequence or sequence pair classification data
+    frame and recommends the shortest max_len truncating few samples.
+
+    Args:
+        processor (Processor): Processor of
+            :mod:`utils_nlp.models.transformers.sequence_classification`, whose tokenizer is used.
+        df (pandas.DataFrame): Input data frame.
+        text_col (str or int): Column containing the texts.
+        text2_col (str or int, optional): Column containing the second texts of sequence
+            pairs. Defaults to None.
+        sample_size (int, optional): Number of rows to tokenize. Defaults to 10000, None
+            tokenizes all rows.
+        seed (int, optional): Random seed of the sample. Defaults to 42.
+        max_lens (list, optional): Candidate max_len values, in increasing order. Defaults to
+            DEFAULT_MAX_LENS.
+        max_truncation_rate (float, optional): Largest fraction of truncated samples of the
+            recommended max_len. Defaults to 0.01.
+        tokens_per_batch (int, optional): Number of padded tokens per batch of the recommended
+            batch sizes. Defaults to 32 * MAX_SEQ_LEN, the default batch size of the processor at
+            the maximum length.
+        config (PretrainedConfig, optional): Model configuration used to project the FLOPs.
+            Defaults to None, the dimensions of bert-base.
+
+    Returns:
+        dict: Dictionary with the "task", the number of profiled samples "num_samples", the
+            "total_samples", the "percentiles" of the token lengths, including the special
+            tokens, the "candidates" data frame with the "truncation_rate", "batch_size",
+            projected "flops" of one pass over the data frame and "relative_cost", compared to
+            MAX_SEQ_LEN, of each max_len, and the "recommended" max_len and batch_size.
+    """
+    indices = _sample_indices(len(df), sample_size, seed)
+    tokenize = processor.tokenizer.tokenize
+    lengths = []
+    for idx in indices:
+        row = df.iloc[idx]
+        num_tokens = len(tokenize(row[text_col]))
+        if text2_col is None:
+            # [CLS] text [SEP]
+            lengths.append(num_tokens + 2)
+        else:
+            num_tokens_2 = len(tokenize(row[text2_col]))
+            # [CLS] text [SEP] text2 [SEP]
+            lengths.append(num_tokens + num_tokens_2 + (3 if num_tokens_2 else 2))
+    task = "sequence classification" if text2_col is None else "sequence pair classification"
+    return _profile_sequences(
+        task, lengths, len(df), max_lens, max_truncation_rate, tokens_per_batch, config
+    )
+
+
+def profile_token_classification(
+    processor,
+    text,
+    sample_size=10000,
+    seed=42,
+    max_lens=DEFAULT_MAX_LENS,
+    max_truncation_rate=0.01,
+    tokens_per_batch=DEFAULT_BATCH_SIZE * MAX_SEQ_LEN,
+    config=None,
+):
+    """
+    Profiles the token lengths of a sample of token classification sentences and recommends the
+    shortest max_len truncating few sentences.
+
+    Args:
+        processor (TokenClassificationProcessor): Processor of
+            :mod:`utils_nlp.models.transformers.named_entity_recognition`, whose tokenizer is
+            used.
+        text (list): List of lists of words, as passed to
+            :meth:`TokenClassificationProcessor.preprocess_for_bert`.
+        sample_size (int, optional): Number of sentences to tokenize. Defaults to 10000, None
+            tokenizes all sentences.
+        seed (int, optional): Random seed of the sample. Defaults to 42.
+        max_lens (list, optional): Candidate max_len values, in increasing order. Defaults to
+            DEFAULT_MAX_LENS.
+        max_truncation_rate (float, optional): Largest fraction of truncated sentences of the
+            recommended max_len. Defaults to 0.01.
+        tokens_per_batch (int, optional): Number of padded tokens per batch of the recommended
+            batch sizes. Defaults to 32 * MAX_SEQ_LEN.
+        config (PretrainedConfig, optional): Model configuration used to project the FLOPs.
+            Defaults to None, the dimensions of bert-base.
+
+    Returns:
+        dict: Report as returned by :func:`profile_sequence_classification`.
+    """
+    indices = _sample_indices(len(text), sample_size, seed)
+    tokenize = processor.tokenizer.tokenize
+    # word pieces of the words, without special tokens
+    lengths = [sum(len(tokenize(word)) for word in text[idx]) for idx in indices]
+    return _profile_sequences(
+        "token classification",
+        lengths,
+        len(text),
+        max_lens,
+        max_truncation_rate,
+        tokens_per_batch,
+        config,
+    )
+
+
+def profile_question_answering(
+    processor,
+    df,
+    doc_text_col,
+    question_text_col,
+    max_question_length=64,
+    sample_size=10000,
+    seed=42,
+    max_lens=DEFAULT_MAX_LENS,
+    doc_strides=DEFAULT_DOC_STRIDES,
+    min_doc_overlap=128,
+    max_truncation_rate=0.01,
+    tokens_per_batch=DEFAULT_BATCH_SIZE * MAX_SEQ_LEN,
+    config=None,
+):
+    """
+    Profiles the token lengths of a sample of a question answering data frame, the number of
+    features of the sliding window for each max_len and doc_stride, and recommends a max_len,
+    doc_stride and batch size.
+
+    The recommended max_len is the shortest fitting the question and document of few examples
+    in one span, or the cheapest if none does. The recommended doc_stride is the largest
+    candidate keeping `min_doc_overlap` tokens of overlap between consecutive spans, for the
+    median question length.
+
+    Args:
+        processor (QAProcessor): Processor of
+            :mod:`utils_nlp.models.transformers.question_answering`, whose tokenizer, or custom
+            tokenizer, is used.
+        df (pandas.DataFrame): Input data frame.
+        doc_text_col (str): Column containing the document texts.
+        question_text_col (str): Column containing the question texts.
+        max_question_length (int, optional): Maximum number of question tokens, as passed to
+            :meth:`QAProcessor.preprocess`. Defaults to 64.
+        sample_size (int, optional): Number of rows to tokenize. Defaults to 10000, None
+            tokenizes all rows.
+        seed (int, optional): Random seed of the sample. Defaults to 42.
+        max_lens (list, optional): Candidate max_len values, in increasing order. Defaults to
+            DEFAULT_MAX_LENS.
+        doc_strides (list, optional): Candidate doc_stride values, in increasing order. Defaults
+            to DEFAULT_DOC_STRIDES.
+        min_doc_overlap (int, optional): Minimum number of document tokens shared by
+            consecutive spans of the recommended doc_stride. Defaults to 128.
+        max_truncation_rate (float, optional): Largest fraction of examples split into several
+            spans of the recommended max_len. Defaults to 0.01.
+        tokens_per_batch (int, optional): Number of padded tokens per batch of the recommended
+            batch sizes. Defaults to 32 * MAX_SEQ_LEN.
+        config (PretrainedConfig, optional): Model configuration used to project the FLOPs.
+            Defaults to None, the dimensions of bert-base.
+
+    Returns:
+        dict: Dictionary with the "task", "num_samples", "total_samples", the "percentiles" of
+            the lengths of the question, document and special tokens, the "candidates" data
+            frame with, for each max_len and doc_stride, the fraction of examples split into
+            several spans "truncation_rate", the "features_per_example", "batch_size",
+            projected "flops" of one pass over the data frame and "relative_cost", compared to
+            MAX_SEQ_LEN and a doc_stride of 128, and the "recommended" max_len, doc_stride and
+            batch_size.
+    """
+    indices = _sample_indices(len(df), sample_size, seed)
+    tokenize = processor.custom_tokenize or processor.tokenizer.tokenize
+    question_lengths = []
+    doc_lengths = []
+    # documents are often shared by several questions
+    doc_length_cache = {}
+    for idx in indices:
+        row = df.iloc[idx]
+        doc_text = row[doc_text_col]
+        question_lengths.append(min(len(tokenize(row[question_text_col])), max_question_length))
+        if doc_text not in doc_length_cache:
+            qa_input = QAInput(
+                doc_text=doc_text,
+                question_text="",
+                qa_id=0,
+                is_impossible=False,
+                answer_start=-1,
+                answer_text="",
+            )
+            doc_tokens = _create_qa_example(qa_input, is_training=False).doc_tokens
+            doc_length_cache[doc_text] = sum(len(tokenize(token)) for token in doc_tokens)
+        doc_lengths.append(doc_length_cache[doc_text])
+    question_lengths = np.asarray(question_lengths)
+    doc_lengths = np.asarray(doc_lengths)
+    # [CLS] question [SEP] document [SEP]
+    lengths = question_lengths + doc_lengths + 3
+    scale = len(df) / max(1, len(indices))
+    dims = _get_dims(config)
+
+    def _num_features(max_len, doc_stride):
+        max_tokens_for_doc = max_len - question_lengths - 3
+        if (max_tokens_for_doc <= 0).any():
+            return None
+        return sum(
+            count_doc_spans(n, m, doc_stride) for n, m in zip(doc_lengths, max_tokens_for_doc)
+        )
+
+    baseline_features = _num_features(MAX_SEQ_LEN, DEFAULT_DOC_STRIDE) * scale
+    baseline_cost = _padded_cost(dims, baseline_features, MAX_SEQ_LEN)
+    median_question_length = int(np.median(question_lengths))
+
+    rows = []
+    recommended_strides = {}
+    for max_len in max_lens:
+        truncation_rate = float(np.mean(lengths > max_len))
+        for doc_stride in doc_strides:
+            num_features = _num_features(max_len, doc_stride)
+            if num_features is None:
+                # the window doesn't fit the longest questions
+                continue
+            num_features *= scale
+            cost = _padded_cost(dims, num_features, max_len)
+            rows.append(
+                {
+                    "max_len": max_len,
+                    "doc_stride": doc_stride,
+                    "truncation_rate": truncation_rate,
+                    "features_per_example": num_features / len(df),
+                    "batch_size": recommend_batch_size(max_len, tokens_per_batch),
+                    "flops": cost,
+                    "relative_cost": cost / baseline_cost,
+                }
+            )
+        max_stride = max_len - median_question_length - 3 - min_doc_overlap
+        strides = [s for s in doc_strides if s <= max_stride]
+        recommended_strides[max_len] = strides[-1] if strides else doc_strides[0]
+    candidates = pd.DataFrame(rows)
+
+    recommended = candidates[
+        candidates["doc_stride"] == candidates["max_len"].map(recommended_strides)
+    ]
+    valid = recommended[recommended["truncation_rate"] <= max_truncation_rate]
+    if len(valid):
+        best = valid.iloc[0]
+    else:
+        best = recommended.loc[recommended["relative_cost"].idxmin()]
+    report = {
+        "task": "question answering",
+        "num_samples": len(indices),
+        "total_samples": len(df),
+        "percentiles": {p: int(np.percentile(lengths, p)) for p in PERCENTILES},
+        "candidates": candidates,
+        "recommended": {
+            "max_len": int(best["max_len"]),
+            "doc_stride": int(best["doc_stride"]),
+            "batch_size": int(best["batch_size"]),
+            "truncation_rate": float(best["truncation_rate"]),
+            "features_per_example": float(best["features_per_example"]),
+            "relative_cost": float(best["relative_cost"]),
+        },
+    }
+    _log_report(report)
+    return report
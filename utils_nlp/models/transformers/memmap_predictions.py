@@ -0,0 +1,105 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Writing of model predictions to memory-mapped arrays, for outputs larger than memory."""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# outputs that can be written, see write_predictions_to_memmap
+OUTPUT_TYPES = ["logits", "preds", "top_k"]
+
+
+def get_label_dtype(num_labels):
+    """Returns the smallest unsigned integer dtype holding label ids below `num_labels`."""
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if num_labels - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def _softmax(logits):
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def write_predictions_to_memmap(
+    batches, num_samples, output_prefix, outputs=("logits",), top_k=5, logits_dtype=np.float32
+):
+    """
+    Writes batches of logits to memory-mapped .npy files, one batch at a time.
+
+    The files are preallocated when the first batch is received, so that only one batch is in
+    memory at any time. They can be reopened with `numpy.load(path, mmap_mode="r")`.
+
+    Args:
+        batches (iterable): Batches of logits of shape (batch_size, ..., num_labels), e.g. the
+            generator returned by :meth:`utils_nlp.models.transformers.common.Transformer.predict`.
+        num_samples (int): Total number of samples of the batches.
+        output_prefix (str): Path prefix of the output files.
+        outputs (list, optional): Outputs to write, among "logits", the logits in
+            `logits_dtype`, written to "<output_prefix>.logits.npy", "preds", the argmax labels in
+            the smallest integer dtype fitting the labels, written to
+            "<output_prefix>.preds.npy", and "top_k", the `top_k` most probable labels and their
+            float16 probabilities in decreasing order, written to
+            "<output_prefix>.top_k_labels.npy" and "<output_prefix>.top_k_probs.npy". Defaults to
+            ("logits",).
+        top_k (int, optional): Number of labels of the "top_k" output. Defaults to 5.
+        logits_dtype (dtype, optional): Dtype of the "logits" output, e.g. numpy.float16 to halve
+            its size. Defaults to numpy.float32.
+
+    Returns:
+        dict: Dictionary mapping "logits", "preds", "top_k_labels" and "top_k_probs" to the
+            requested memory-mapped arrays.
+    """
+    unknown = set(outputs) - set(OUTPUT_TYPES)
+    if unknown:
+        raise ValueError("Unknown outputs {0}, choose from {1}.".format(unknown, OUTPUT_TYPES))
+
+    arrays = {}
+    offset = 0
+    for logits in batches:
+        if not arrays:
+            sample_shape = logits.shape[1:-1]
+            num_labels = logits.shape[-1]
+            k = min(top_k, num_labels)
+            label_dtype = get_label_dtype(num_labels)
+            specs = {
+                "logits": ((num_samples,) + logits.shape[1:], logits_dtype),
+                "preds": ((num_samples,) + sample_shape, label_dtype),
+                "top_k_labels": ((num_samples,) + sample_shape + (k,), label_dtype),
+                "top_k_probs": ((num_samples,) + sample_shape + (k,), np.float16),
+            }
+            if "top_k" in outputs:
+                outputs = list(outputs) + ["top_k_labels", "top_k_probs"]
+            for name in [n for n in specs if n in outputs]:
+                path = "{0}.{1}.npy".format(output_prefix, name)
+                shape, dtype = specs[name]
+                arrays[name] = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+                logger.info(
+                    "Writing {0} {1} {2} to {3}".format(name, np.dtype(dtype).name, shape, path)
+                )
+
+        end = offset + logits.shape[0]
+        if "logits" in arrays:
+            arrays["logits"][offset:end] = logits
+        if "preds" in arrays:
+            arrays["preds"][offset:end] = np.argmax(logits, axis=-1)
+        if "top_k_labels" in arrays:
+            probs = _softmax(logits.astype(np.float32))
+            # unordered top k, then sorted by decreasing probability
+            labels = np.argpartition(-probs, k - 1, axis=-1)[..., :k]
+            top_probs = np.take_along_axis(probs, labels, axis=-1)
+            order = np.argsort(-top_probs, axis=-1)
+            arrays["top_k_labels"][offset:end] = np.take_along_axis(labels, order, axis=-1)
+            arrays["top_k_probs"][offset:end] = np.take_along_axis(top_probs, order, axis=-1)
+        offset = end
+
+    if offset != num_samples:
+        raise ValueError("Received {0} samples, expected {1}.".format(offset, num_samples))
+    for array in arrays.values():
+        array.flush()
+    return arrays
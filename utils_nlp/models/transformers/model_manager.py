@@ -0,0 +1,268 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Utilities for hosting several fine-tuned transformer models in one process."""
+
+import collections
+import logging
+import threading
+
+import torch
+
+from utils_nlp.common.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+
+def get_model_size(model):
+    """
+    Computes the number of bytes held by the parameters and buffers of a model.
+
+    Args:
+        model (torch.nn.Module or Transformer): A PyTorch module, or a wrapper such as
+            :class:`utils_nlp.models.transformers.common.Transformer` exposing a `model`
+            attribute.
+
+    Returns:
+        int: Number of bytes used by the parameters and buffers of the model.
+    """
+    if not isinstance(model, torch.nn.Module):
+        model = model.model
+    num_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    num_bytes += sum(b.numel() * b.element_size() for b in model.buffers())
+    return num_bytes
+
+
+class _ModelEntry:
+    """Bookkeeping record of a model registered in :class:`ModelManager`."""
+
+    def __init__(self, name, loader, pinned):
+        self.name = name
+        self.loader = loader
+        self.pinned = pinned
+        self.model = None
+        self.size = 0
+        self.lock = threading.Lock()
+        self.load_times = []
+
+
+class ModelManager:
+    """
+    Loads fine-tuned transformer models on demand and keeps the most recently used ones in
+    memory within a memory budget.
+
+    Models are registered by name together with the class used to load them, e.g.
+    :class:`utils_nlp.models.transformers.sequence_classification.SequenceClassifier`,
+    :class:`utils_nlp.models.transformers.named_entity_recognition.TokenClassifier` or
+    :class:`utils_nlp.models.transformers.question_answering.AnswerExtractor`, and the
+    `load_model_from_dir` directory to load them from. When a model is requested and not
+    resident, it is loaded and the least recently used unpinned models are evicted until the
+    total parameter bytes fit in the budget. All methods are thread safe.
+
+    Args:
+        memory_budget (int, optional): Maximum number of bytes of model parameters and buffers
+            kept in memory. Pinned models count towards the budget but are never evicted.
+            Defaults to None, no limit.
+        device (torch.device, optional): Device the models are moved to after loading.
+            Defaults to None, the models are left on the device they are loaded on.
+
+    Examples:
+        >>> manager = ModelManager(memory_budget=2 * 1024 ** 3)
+        >>> manager.register(
+        ...     "sentiment",
+        ...     SequenceClassifier,
+        ...     model_name="bert-base-cased",
+        ...     load_model_from_dir="./sentiment/fine_tuned",
+        ...     num_labels=3,
+        ... )
+        >>> classifier = manager.get("sentiment")
+    """
+
+    def __init__(self, memory_budget=None, device=None):
+        self.memory_budget = memory_budget
+        self.device = device
+        self._entries = {}
+        # resident models in least recently used order
+        self._resident = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def register(
+        self, name, model_class, model_name, load_model_from_dir=None, pin=False, **kwargs
+    ):
+        """
+        Registers a model without loading it.
+
+        Args:
+            name (str): Name used to retrieve the model.
+            model_class (type): Class used to load the model, e.g.
+                :class:`utils_nlp.models.transformers.sequence_classification.SequenceClassifier`.
+            model_name (str): Name of the pre-trained model, e.g. "bert-base-cased".
+            load_model_from_dir (str, optional): Directory containing the fine-tuned model.
+                Defaults to None, which loads the pre-trained model.
+            pin (bool, optional): Whether the model is exempt from eviction. Defaults to False.
+            **kwargs: Additional keyword arguments passed to `model_class`, e.g. `num_labels`.
+        """
+
+        def _loader():
+            return model_class(
+                model_name=model_name, load_model_from_dir=load_model_from_dir, **kwargs
+            )
+
+        self.register_loader(name, _loader, pin=pin)
+
+    def register_loader(self, name, loader, pin=False):
+        """
+        Registers a model with a custom loading function.
+
+        Args:
+            name (str): Name used to retrieve the model.
+            loader (function): Function with no arguments returning the loaded model.
+            pin (bool, optional): Whether the model is exempt from eviction. Defaults to False.
+        """
+        with self._lock:
+            if name in self._entries:
+                raise ValueError("A model named {} is already registered.".format(name))
+            self._entries[name] = _ModelEntry(name, loader, pin)
+
+    def unregister(self, name):
+        """Evicts a model, if resident, and removes it from the manager."""
+        with self._lock:
+            self.evict(name)
+            del self._entries[name]
+
+    def get(self, name):
+        """
+        Returns a registered model, loading it if it's not resident.
+
+        Args:
+            name (str): Name of the model.
+
+        Returns:
+            object: The loaded model, an instance of the registered `model_class`.
+        """
+        entry = self._get_entry(name)
+        with self._lock:
+            if entry.model is not None:
+                self.hits += 1
+                self._resident.move_to_end(name)
+                return entry.model
+            self.misses += 1
+
+        # load outside the manager lock so that resident models can still be served, the entry
+        # lock makes concurrent requests for the same model wait for a single load
+        with entry.lock:
+            with self._lock:
+                if entry.model is not None:
+                    self._resident.move_to_end(name)
+                    return entry.model
+
+            with Timer() as t:
+                model = entry.loader()
+                if self.device is not None:
+                    model.model.to(self.device)
+            size = get_model_size(model)
+            logger.info("Loaded model {0} ({1} bytes) in {2} s".format(name, size, t))
+
+            with self._lock:
+                self._make_room(size, exclude=name)
+                entry.model = model
+                entry.size = size
+                entry.load_times.append(t.interval)
+                self._resident[name] = entry
+            return model
+
+    def pin(self, name):
+        """Exempts a model from eviction."""
+        with self._lock:
+            self._get_entry(name).pinned = True
+
+    def unpin(self, name):
+        """Makes a pinned model evictable again."""
+        with self._lock:
+            self._get_entry(name).pinned = False
+            self._make_room(0)
+
+    def evict(self, name):
+        """
+        Releases a resident model. Pinned models are also released.
+
+        Args:
+            name (str): Name of the model.
+
+        Returns:
+            bool: Whether the model was resident.
+        """
+        with self._lock:
+            entry = self._get_entry(name)
+            if entry.model is None:
+                return False
+            del self._resident[name]
+            entry.model = None
+            entry.size = 0
+            self.evictions += 1
+            logger.info("Evicted model {}".format(name))
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return True
+
+    def is_resident(self, name):
+        """Whether a model is currently loaded."""
+        with self._lock:
+            return self._get_entry(name).model is not None
+
+    @property
+    def resident_models(self):
+        """list: Names of the resident models, from least to most recently used."""
+        with self._lock:
+            return list(self._resident)
+
+    @property
+    def resident_bytes(self):
+        """int: Number of bytes of parameters and buffers of all resident models."""
+        with self._lock:
+            return sum(e.size for e in self._resident.values())
+
+    def stats(self):
+        """
+        Returns usage statistics of the manager.
+
+        Returns:
+            dict: Dictionary with the number of cache `hits`, `misses` and `evictions`, the
+                `resident_bytes`, and for each model in `load_times` the list of load latencies in
+                seconds.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident_bytes": self.resident_bytes,
+                "load_times": {k: list(e.load_times) for k, e in self._entries.items()},
+            }
+
+    def _get_entry(self, name):
+        try:
+            return self._entries[name]
+        except KeyError:
+            raise KeyError("Model {} is not registered.".format(name))
+
+    def _make_room(self, size, exclude=None):
+        """Evicts least recently used unpinned models until `size` more bytes fit the budget."""
+        if self.memory_budget is None:
+            return
+        for name in list(self._resident):
+            if self.resident_bytes + size <= self.memory_budget:
+                break
+            if name == exclude or self._entries[name].pinned:
+                continue
+            self.evict(name)
+        if self.resident_bytes + size > self.memory_budget:
+            logger.warning(
+                "Resident models use {0} bytes, which exceeds the memory budget of {1} bytes. "
+                "Unpin some models or increase the budget.".format(
+                    self.resident_bytes + size, self.memory_budget
+                )
+            )
@@ -0,0 +1,403 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Multi-task models sharing one transformer encoder between several classification heads."""
+
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from tqdm import tqdm
+from transformers.modeling_bert import BERT_PRETRAINED_MODEL_ARCHIVE_MAP, BertModel
+from transformers.modeling_distilbert import (
+    DISTILBERT_PRETRAINED_MODEL_ARCHIVE_MAP,
+    DistilBertModel,
+)
+from transformers.modeling_roberta import ROBERTA_PRETRAINED_MODEL_ARCHIVE_MAP, RobertaModel
+from transformers.modeling_xlnet import XLNET_PRETRAINED_MODEL_ARCHIVE_MAP, XLNetModel
+
+from utils_nlp.common.pytorch_utils import get_device
+from utils_nlp.models.transformers.common import Transformer
+from utils_nlp.models.transformers.hyperparameter_sweep import tensorize_dataset
+
+ENCODER_CLASS = {}
+ENCODER_CLASS.update({k: BertModel for k in BERT_PRETRAINED_MODEL_ARCHIVE_MAP})
+ENCODER_CLASS.update({k: RobertaModel for k in ROBERTA_PRETRAINED_MODEL_ARCHIVE_MAP})
+ENCODER_CLASS.update({k: XLNetModel for k in XLNET_PRETRAINED_MODEL_ARCHIVE_MAP})
+ENCODER_CLASS.update({k: DistilBertModel for k in DISTILBERT_PRETRAINED_MODEL_ARCHIVE_MAP})
+
+# head types: one label per sequence or one label per token
+SEQUENCE = "sequence"
+TOKEN = "token"
+
+TASKS_FILE = "tasks.json"
+WEIGHTS_FILE = "pytorch_model.bin"
+
+logger = logging.getLogger(__name__)
+
+
+class MultiTaskModel(nn.Module):
+    """
+    Transformer encoder shared by several named classification heads.
+
+    A forward pass encodes the inputs once and runs all heads, or the requested ones, on the
+    encoder outputs. Sequence heads classify the hidden state of the classification token, which
+    the processors put first for all models, XLNet included, and token heads classify each
+    token.
+
+    Args:
+        encoder (nn.Module): Encoder, e.g. a :class:`transformers.BertModel`.
+        model_name (str): Name of the pre-trained model of the encoder.
+        tasks (dict): Dictionary mapping task names to (head type, number of labels) tuples,
+            where the head type is "sequence" or "token".
+    """
+
+    def __init__(self, encoder, model_name, tasks):
+        super().__init__()
+        self.encoder = encoder
+        self.model_name = model_name
+        self.model_type = model_name.split("-")[0]
+        self.tasks = {name: tuple(task) for name, task in tasks.items()}
+        config = encoder.config
+        # DistilBERT names the hidden size and the dropout differently
+        hidden_size = getattr(config, "hidden_size", getattr(config, "dim", None))
+        dropout = getattr(config, "hidden_dropout_prob", getattr(config, "dropout", 0.1))
+        self.dropout = nn.Dropout(dropout)
+        self.heads = nn.ModuleDict()
+        for name, (head_type, num_labels) in self.tasks.items():
+            if head_type == SEQUENCE:
+                self.heads[name] = nn.Sequential(
+                    nn.Linear(hidden_size, hidden_size),
+                    nn.Tanh(),
+                    nn.Dropout(dropout),
+                    nn.Linear(hidden_size, num_labels),
+                )
+            elif head_type == TOKEN:
+                self.heads[name] = nn.Linear(hidden_size, num_labels)
+            else:
+                raise ValueError(
+                    "Head type of task {0} must be '{1}' or '{2}', not {3}.".format(
+                        name, SEQUENCE, TOKEN, head_type
+                    )
+                )
+
+    @property
+    def task_names(self):
+        return list(self.tasks)
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None, labels=None, tasks=None):
+        """
+        Encodes the inputs once and runs the heads.
+
+        Args:
+            input_ids (torch.Tensor): Token ids.
+            attention_mask (torch.Tensor, optional): Attention mask. Defaults to None.
+            token_type_ids (torch.Tensor, optional): Segment ids, ignored by DistilBERT.
+                Defaults to None.
+            labels (dict, optional): Dictionary mapping task names to label tensors. Labels equal
+                to -100 are ignored, e.g. for samples not annotated for a task. Defaults to None.
+            tasks (list, optional): Names of the heads to run. Defaults to None, the tasks in
+                `labels` if provided, otherwise all tasks.
+
+        Returns:
+            tuple: (loss, logits) if `labels` is provided, otherwise (logits,), where `logits` is
+                a dictionary mapping task names to logits and `loss` is the sum of the
+                cross-entropy losses of the tasks in `labels`.
+        """
+        if tasks is None:
+            tasks = list(labels) if labels is not None else self.task_names
+        if self.model_type == "distilbert":
+            encoder_outputs = self.encoder(input_ids=input_ids, attention_mask=attention_mask)
+        else:
+            encoder_outputs = self.encoder(
+                input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+            )
+        hidden_states = self.dropout(encoder_outputs[0])
+        # the processors prepend the classification token and pad on the right for all models
+        cls_states = hidden_states[:, 0]
+
+        logits = {}
+        for name in tasks:
+            head_type, _ = self.tasks[name]
+            logits[name] = self.heads[name](cls_states if head_type == SEQUENCE else hidden_states)
+        if labels is None:
+            return (logits,)
+
+        loss_fct = nn.CrossEntropyLoss()
+        # zero loss connected to the graph, for batches without labels for any task
+        loss = cls_states.sum() * 0
+        for name, task_labels in labels.items():
+            task_logits = logits[name]
+            if self.tasks[name][0] == TOKEN and attention_mask is not None:
+                # only the non-padded tokens count in the loss
+                task_labels = task_labels.masked_fill(attention_mask == 0, -100)
+            if (task_labels != -100).any():
+                loss = loss + loss_fct(
+                    task_logits.view(-1, task_logits.size(-1)), task_labels.view(-1)
+                )
+        return (loss, logits)
+
+    def save_pretrained(self, save_directory):
+        """Saves the encoder configuration, the tasks and the weights of the model."""
+        os.makedirs(save_directory, exist_ok=True)
+        self.encoder.config.save_pretrained(save_directory)
+        with open(os.path.join(save_directory, TASKS_FILE), "w") as f:
+            json.dump({"model_name": self.model_name, "tasks": self.tasks}, f, indent=4)
+        torch.save(self.state_dict(), os.path.join(save_directory, WEIGHTS_FILE))
+
+    @classmethod
+    def from_pretrained(cls, model_name, tasks=None, cache_dir=".", load_model_from_dir=None):
+        """
+        Creates a model with a pre-trained encoder and new heads, or loads a model saved by
+        :meth:`save_pretrained`.
+
+        Args:
+            model_name (str): Name of the pre-trained model.
+            tasks (dict, optional): Tasks of the new heads, see :class:`MultiTaskModel`. Required
+                if `load_model_from_dir` is None. Defaults to None.
+            cache_dir (str, optional): Directory to cache the pre-trained encoder. Defaults to ".".
+            load_model_from_dir (str, optional): Directory of a saved model. Defaults to None.
+
+        Returns:
+            MultiTaskModel: The model.
+        """
+        encoder_class = ENCODER_CLASS[model_name]
+        if load_model_from_dir is None:
+            if not tasks:
+                raise ValueError("At least one task must be provided.")
+            encoder = encoder_class.from_pretrained(model_name, cache_dir=cache_dir)
+            return cls(encoder, model_name, tasks)
+
+        logger.info("Loading cached model from {}".format(load_model_from_dir))
+        with open(os.path.join(load_model_from_dir, TASKS_FILE)) as f:
+            saved_tasks = json.load(f)["tasks"]
+        config = encoder_class.config_class.from_pretrained(load_model_from_dir)
+        model = cls(encoder_class(config), model_name, saved_tasks)
+        model.load_state_dict(
+            torch.load(os.path.join(load_model_from_dir, WEIGHTS_FILE), map_location="cpu")
+        )
+        return model
+
+
+def create_multi_task_dataloader(dataloader, labels, batch_size=32, shuffle=False):
+    """
+    Creates a multi-task dataloader from the dataloader of a processor and the labels of each
+    task.
+
+    Args:
+        dataloader (DataLoader): Dataloader whose samples start with the token ids, attention
+            mask and segment ids, e.g. created by the `create_dataloader_from_df` method of
+            :class:`utils_nlp.models.transformers.sequence_classification.Processor`. It's
+            tokenized once.
+        labels (dict): Dictionary mapping task names to label arrays of shape (num_samples,)
+            for sequence tasks or (num_samples, max_len) for token tasks, with -100 for missing
+            labels. The order of the tasks is the order of the label tensors in the batches.
+        batch_size (int, optional): Batch size. Defaults to 32.
+        shuffle (bool, optional): Whether to shuffle the data. Defaults to False.
+
+    Returns:
+        DataLoader: Dataloader of (input_ids, attention_mask, token_type_ids, *labels) batches.
+    """
+    tensors = tensorize_dataset(dataloader.dataset).tensors[:3]
+    label_tensors = [torch.as_tensor(np.asarray(v), dtype=torch.long) for v in labels.values()]
+    dataset = TensorDataset(*tensors, *label_tensors)
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=sampler, batch_size=batch_size)
+
+
+class MultiTaskClassifier(Transformer):
+    """
+    Classifier with several sequence or token classification heads on one shared encoder.
+
+    All heads run in a single encoder pass at inference. The heads can be trained jointly, on
+    batches labeled for several tasks, or one by one, optionally with the encoder frozen.
+
+    Args:
+        model_name (str, optional): Name of the pre-trained model. Defaults to "bert-base-cased".
+        tasks (dict, optional): Dictionary mapping task names to (head type, number of labels)
+            tuples, where the head type is "sequence" or "token", e.g.
+            {"sentiment": ("sequence", 3), "ner": ("token", 9)}. Required if
+            `load_model_from_dir` is None. Defaults to None.
+        cache_dir (str, optional): Directory to cache the pre-trained model. Defaults to ".".
+        load_model_from_dir (str, optional): Directory of a model saved by :meth:`save_model`.
+            Defaults to None.
+    """
+
+    def __init__(
+        self, model_name="bert-base-cased", tasks=None, cache_dir=".", load_model_from_dir=None
+    ):
+        self._tasks = tasks
+        super().__init__(
+            model_class=ENCODER_CLASS,
+            model_name=model_name,
+            cache_dir=cache_dir,
+            load_model_from_dir=load_model_from_dir,
+        )
+
+    def _create_model(self, model_class, num_labels):
+        return MultiTaskModel.from_pretrained(
+            self.model_name,
+            tasks=self._tasks,
+            cache_dir=self.cache_dir,
+            load_model_from_dir=self.load_model_from_dir,
+        )
+
+    @staticmethod
+    def list_supported_models():
+        return list(ENCODER_CLASS)
+
+    @property
+    def task_names(self):
+        return self.model.task_names
+
+    def get_inputs(self, tasks=None):
+        """
+        Returns a function converting multi-task batches into model inputs, to pass to
+        `fine_tune` or `predict`.
+
+        Args:
+            tasks (list, optional): Names of the tasks whose labels are used for training.
+                Defaults to None, all tasks.
+
+        Returns:
+            function: Function taking a batch, the model name and `train_mode`.
+        """
+        task_names = self.task_names
+        tasks = task_names if tasks is None else tasks
+
+        def _get_inputs(batch, model_name, train_mode=True):
+            inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
+            if model_name.split("-")[0] != "distilbert":
+                inputs["token_type_ids"] = batch[2]
+            if train_mode:
+                inputs["labels"] = {t: batch[3 + task_names.index(t)] for t in tasks}
+            else:
+                inputs["tasks"] = tasks
+            return inputs
+
+        return _get_inputs
+
+    def fit(
+        self,
+        train_dataloader,
+        tasks=None,
+        freeze_encoder=False,
+        num_epochs=1,
+        num_gpus=None,
+        local_rank=-1,
+        weight_decay=0.0,
+        learning_rate=5e-5,
+        adam_epsilon=1e-8,
+        warmup_steps=0,
+        verbose=True,
+        seed=None,
+        val_dataloader=None,
+        validation_steps=None,
+        early_stopping_patience=None,
+        best_model_dir=None,
+    ):
+        """
+        Fine-tunes the heads of some or all tasks.
+
+        Args:
+            train_dataloader (DataLoader): Dataloader created by
+                :func:`create_multi_task_dataloader`.
+            tasks (list, optional): Names of the tasks to train. Defaults to None, all tasks are
+                trained jointly and their losses summed.
+            freeze_encoder (bool, optional): Whether to only train the heads of `tasks`, keeping
+                the shared encoder unchanged, e.g. to add a task without changing the outputs of
+                the other heads. Defaults to False.
+            num_epochs (int, optional): Number of training epochs. Defaults to 1.
+            num_gpus (int, optional): The number of GPUs to use. If None, all available GPUs will
+                be used. Defaults to None.
+            local_rank (int, optional): Local rank for distributed training. Defaults to -1, no
+                distributed training.
+            weight_decay (float, optional): Weight decay rate. Defaults to 0.
+            learning_rate (float, optional): Learning rate. Defaults to 5e-5.
+            adam_epsilon (float, optional): Epsilon of the AdamW optimizer. Defaults to 1e-8.
+            warmup_steps (int, optional): Number of warmup steps. Defaults to 0.
+            verbose (bool, optional): Whether to print the training log. Defaults to True.
+            seed (int, optional): Random seed. Defaults to None.
+            val_dataloader (DataLoader, optional): Validation dataloader. If provided, the weights
+                with the lowest validation loss are restored at the end. Defaults to None.
+            validation_steps (int, optional): Number of optimization steps between evaluations.
+                Defaults to None, the model is evaluated at the end of each epoch.
+            early_stopping_patience (int, optional): Number of evaluations without improvement
+                after which training stops. Defaults to None, no early stopping.
+            best_model_dir (str, optional): Directory to save the best model to. Defaults to
+                None, the best weights are kept in CPU memory.
+        """
+        device, num_gpus = get_device(num_gpus=num_gpus, local_rank=local_rank)
+        self.model.to(device)
+
+        frozen = []
+        if freeze_encoder:
+            frozen = [p for p in self.model.encoder.parameters() if p.requires_grad]
+            for p in frozen:
+                p.requires_grad = False
+        try:
+            super().fine_tune(
+                train_dataloader=train_dataloader,
+                get_inputs=self.get_inputs(tasks),
+                device=device,
+                n_gpu=num_gpus,
+                num_train_epochs=num_epochs,
+                weight_decay=weight_decay,
+                learning_rate=learning_rate,
+                adam_epsilon=adam_epsilon,
+                warmup_steps=warmup_steps,
+                local_rank=local_rank,
+                verbose=verbose,
+                seed=seed,
+                val_dataloader=val_dataloader,
+                validation_steps=validation_steps,
+                early_stopping_patience=early_stopping_patience,
+                best_model_dir=best_model_dir,
+            )
+        finally:
+            for p in frozen:
+                p.requires_grad = True
+            if hasattr(self.model, "module"):
+                self.model = self.model.module
+
+    def predict(
+        self, eval_dataloader, tasks=None, num_gpus=None, verbose=True, return_logits=False
+    ):
+        """
+        Runs all heads, or the heads of `tasks`, with one encoder pass per batch.
+
+        Args:
+            eval_dataloader (DataLoader): Dataloader created by
+                :func:`create_multi_task_dataloader`, with or without labels.
+            tasks (list, optional): Names of the tasks to predict. Defaults to None, all tasks.
+            num_gpus (int, optional): The number of GPUs to use. Defaults to None, all available
+                GPUs.
+            verbose (bool, optional): Whether to show a progress bar. Defaults to True.
+            return_logits (bool, optional): Whether to return the logits instead of the predicted
+                labels. Defaults to False.
+
+        Returns:
+            dict: Dictionary mapping task names to predicted labels, of shape (num_samples,) for
+                sequence tasks and (num_samples, max_len) for token tasks, or to logits.
+        """
+        device, num_gpus = get_device(num_gpus=num_gpus, local_rank=-1)
+        self.model.to(device)
+        get_inputs = self.get_inputs(tasks)
+
+        logits = {}
+        self.model.eval()
+        for batch in tqdm(eval_dataloader, desc="Evaluating", disable=not verbose):
+            batch = tuple(t.to(device) for t in batch)
+            with torch.no_grad():
+                outputs = self.model(**get_inputs(batch, self.model_name, train_mode=False))
+            for name, task_logits in outputs[0].items():
+                logits.setdefault(name, []).append(task_logits.detach().cpu().numpy())
+
+        logits = {name: np.concatenate(v) for name, v in logits.items()}
+        if return_logits:
+            return logits
+        return {name: np.argmax(v, axis=-1) for name, v in logits.items()}
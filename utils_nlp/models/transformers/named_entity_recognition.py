@@ -11,6 +11,7 @@ from torch.utils.data import TensorDataset
 from transformers.modeling_bert import BERT_PRETRAINED_MODEL_ARCHIVE_MAP, BertForTokenClassification
 from utils_nlp.common.pytorch_utils import get_device
 from utils_nlp.models.transformers.common import MAX_SEQ_LEN, TOKENIZER_CLASS, Transformer
+from utils_nlp.models.transformers.memmap_predictions import write_predictions_to_memmap
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 
@@ -277,14 +278,20 @@ class TokenClassifier(Transformer):
             Defaults to 2.
         cache_dir (str, optional): The default folder for saving cache files.
             Defaults to ".".
+        load_model_from_dir (str, optional): Directory to load the model from. The directory must
+            contain a model file "pytorch_model.bin" and a configuration file "config.json".
+            Defaults to None.
     """
 
-    def __init__(self, model_name="bert-base-cased", num_labels=2, cache_dir="."):
+    def __init__(
+        self, model_name="bert-base-cased", num_labels=2, cache_dir=".", load_model_from_dir=None
+    ):
         super().__init__(
             model_class=TC_MODEL_CLASS,
             model_name=model_name,
             num_labels=num_labels,
             cache_dir=cache_dir,
+            load_model_from_dir=load_model_from_dir,
         )
 
     @staticmethod
@@ -303,6 +310,14 @@ class TokenClassifier(Transformer):
         warmup_steps=0,
         verbose=True,
         seed=None,
+        val_dataloader=None,
+        val_metric=None,
+        validation_steps=None,
+        early_stopping_patience=None,
+        best_model_dir=None,
+        bf16=False,
+        shard_optimizer_state=False,
+        validation_callback=None,
     ):
         """
         Fit the TokenClassifier model using the given training dataset.
@@ -328,6 +343,27 @@ class TokenClassifier(Transformer):
                 Defaults to False.
             seed (int, optional): The seed for the transformers.
                 Defaults to None, use the default seed.
+            val_dataloader (DataLoader, optional): DataLoader instance for labeled validation
+                data. If provided, the model is evaluated during training and the weights with
+                the best validation score are restored at the end. Defaults to None.
+            val_metric (function, optional): Function taking the true and predicted label ids of
+                the non-padded tokens and returning a score to maximize, e.g.
+                `sklearn.metrics.accuracy_score`. Defaults to None, the negative validation loss
+                is used.
+            validation_steps (int, optional): Number of optimization steps between evaluations.
+                Defaults to None, evaluate at the end of each epoch.
+            early_stopping_patience (int, optional): Number of evaluations without improvement
+                after which training stops. Defaults to None, no early stopping.
+            best_model_dir (str, optional): Directory to save the best model to.
+                Defaults to None, the best weights are kept in CPU memory.
+            bf16 (bool, optional): Whether to run the forward passes with bfloat16 autocast on
+                CPU. The loss and the optimizer stay in float32. Defaults to False.
+            shard_optimizer_state (bool, optional): Whether to divide the AdamW state across the
+                processes of distributed training, each process updating its shard of the
+                parameters. Requires `local_rank` != -1. Defaults to False.
+            validation_callback (function, optional): Function called with the step and the
+                score after each evaluation on `val_dataloader`. Training stops if it returns
+                True, e.g. to prune a hyperparameter trial. Defaults to None.
         """
 
         device, num_gpus = get_device(num_gpus=num_gpus, local_rank=local_rank)
@@ -348,13 +384,26 @@ class TokenClassifier(Transformer):
             warmup_steps=warmup_steps,
             verbose=verbose,
             seed=seed,
+            val_dataloader=val_dataloader,
+            val_metric=val_metric,
+            validation_steps=validation_steps,
+            early_stopping_patience=early_stopping_patience,
+            best_model_dir=best_model_dir,
+            bf16=bf16,
+            shard_optimizer_state=shard_optimizer_state,
+            validation_callback=validation_callback,
         )
 
     def predict(
         self,
         eval_dataloader,
         num_gpus=None,
-        verbose=True
+        verbose=True,
+        bf16=False,
+        output_prefix=None,
+        outputs=("logits",),
+        top_k=5,
+        logits_dtype=np.float32,
     ):
         """
         Test on an evaluation dataset and get the token label predictions.
@@ -366,12 +415,25 @@ class TokenClassifier(Transformer):
                 be used. Defaults to None.
             verbose (bool, optional): Verbose model.
                 Defaults to False.
+            bf16 (bool, optional): Whether to run the model with bfloat16 autocast on CPU.
+                The predictions are returned in float32. Defaults to False.
+            output_prefix (str, optional): Path prefix of memory-mapped output files. If
+                provided, the outputs are written batch by batch instead of being concatenated
+                in memory, see the `write_predictions_to_memmap` function of
+                :mod:`utils_nlp.models.transformers.memmap_predictions`. Defaults to None.
+            outputs (list, optional): Outputs written to the memory-mapped files, among "logits",
+                "preds", the argmax label ids, and "top_k", the most probable label ids and their
+                probabilities. Defaults to ("logits",).
+            top_k (int, optional): Number of labels of the "top_k" output. Defaults to 5.
+            logits_dtype (dtype, optional): Dtype of the "logits" output, e.g. numpy.float16.
+                Defaults to numpy.float32.
 
         Returns:
             ndarray: Numpy ndarray of raw predictions. The shape of the ndarray is
             [number_of_examples, sequence_length, number_of_labels]. Each
             value in the ndarray is not normalized. Post-process will be needed
             to get the probability for each class label.
+            If `output_prefix` is provided, a dictionary of memory-mapped arrays is returned.
         """
 
         device, num_gpus = get_device(num_gpus=num_gpus, local_rank=-1)
@@ -380,15 +442,23 @@ class TokenClassifier(Transformer):
         else:
             self.model.to(device)
         
-        preds = list(
-            super().predict(
-                eval_dataloader=eval_dataloader,
-                get_inputs=TokenClassificationProcessor.get_inputs,
-                device=device,
-                verbose=verbose
-            )
+        batches = super().predict(
+            eval_dataloader=eval_dataloader,
+            get_inputs=TokenClassificationProcessor.get_inputs,
+            device=device,
+            verbose=verbose,
+            bf16=bf16,
         )
-        preds_np = np.concatenate(preds)
+        if output_prefix is not None:
+            return write_predictions_to_memmap(
+                batches,
+                len(eval_dataloader.dataset),
+                output_prefix,
+                outputs=outputs,
+                top_k=top_k,
+                logits_dtype=logits_dtype,
+            )
+        preds_np = np.concatenate(list(batches))
         return preds_np
 
     def get_predicted_token_labels(self, predictions, label_map, dataset):
@@ -0,0 +1,141 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""Sharding of optimizer state across data-parallel processes (ZeRO stage 1)."""
+
+import logging
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from torch.optim import Optimizer
+
+logger = logging.getLogger(__name__)
+
+
+def partition_parameters(params, world_size):
+    """
+    Assigns parameters to processes, balancing the number of elements per process.
+
+    The assignment only depends on the order and shapes of the parameters, so it's the same on
+    all processes.
+
+    Args:
+        params (list): List of parameters.
+        world_size (int): Number of processes.
+
+    Returns:
+        list: List of the ranks owning each parameter.
+    """
+    sizes = [0] * world_size
+    owners = []
+    for p in params:
+        rank = sizes.index(min(sizes))
+        owners.append(rank)
+        sizes[rank] += p.numel()
+    return owners
+
+
+class ShardedOptimizer(Optimizer):
+    """
+    Optimizer wrapper keeping the optimizer state of only a shard of the parameters on each
+    data-parallel process.
+
+    The gradients are expected to be synchronized across processes, e.g. by
+    DistributedDataParallel. Each process updates the parameters it owns with its local optimizer
+    and broadcasts them to the other processes, so that the parameters stay identical while
+    optimizer state, e.g. the two moment buffers of AdamW, is divided by the number of processes.
+    It works with any backend supporting broadcast, including gloo.
+
+    The parameter groups of the wrapper are the ones of the local optimizer, so learning rate
+    schedulers can be used as usual. :meth:`state_dict` returns the state of the local shard.
+
+    Args:
+        optimizer_class (type): Optimizer class, e.g. :class:`transformers.AdamW`.
+        params (list): Parameters or list of parameter group dictionaries, as passed to
+            `optimizer_class`.
+        process_group (ProcessGroup, optional): Process group of the data-parallel processes.
+            Defaults to None, the default process group.
+        **defaults: Keyword arguments of `optimizer_class`, e.g. `lr`.
+    """
+
+    def __init__(self, optimizer_class, params, process_group=None, **defaults):
+        if not dist.is_available() or not dist.is_initialized():
+            raise RuntimeError("ShardedOptimizer requires an initialized process group.")
+
+        param_groups = list(params)
+        if not isinstance(param_groups[0], dict):
+            param_groups = [{"params": param_groups}]
+        param_groups = [dict(g, params=list(g["params"])) for g in param_groups]
+
+        self.process_group = process_group if process_group is not None else dist.group.WORLD
+        self.rank = dist.get_rank(self.process_group)
+        self.world_size = dist.get_world_size(self.process_group)
+
+        self.all_params = [p for g in param_groups for p in g["params"]]
+        self.owners = partition_parameters(self.all_params, self.world_size)
+        owner = dict(zip(map(id, self.all_params), self.owners))
+        self.rank_params = [
+            [p for p, r in zip(self.all_params, self.owners) if r == rank]
+            for rank in range(self.world_size)
+        ]
+
+        # keep empty groups so that the groups match the unsharded optimizer's groups
+        local_groups = [
+            dict(g, params=[p for p in g["params"] if owner[id(p)] == self.rank])
+            for g in param_groups
+        ]
+        self.optimizer = optimizer_class(local_groups, **defaults)
+        self.defaults = self.optimizer.defaults
+        logger.info(
+            "Rank {0} holds the optimizer state of {1} of {2} parameter elements.".format(
+                self.rank,
+                sum(p.numel() for p in self.rank_params[self.rank]),
+                sum(p.numel() for p in self.all_params),
+            )
+        )
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    def zero_grad(self):
+        for p in self.all_params:
+            if p.grad is not None:
+                p.grad.detach_()
+                p.grad.zero_()
+
+    def step(self, closure=None):
+        loss = self.optimizer.step(closure)
+        self._broadcast_params()
+        return loss
+
+    @torch.no_grad()
+    def _broadcast_params(self):
+        """Broadcasts the parameters of each shard from the process owning it."""
+        for rank, params in enumerate(self.rank_params):
+            if not params:
+                continue
+            global_rank = rank
+            if self.process_group is not dist.group.WORLD:
+                global_rank = dist.distributed_c10d._get_global_rank(self.process_group, rank)
+            # one broadcast per shard and dtype instead of one per parameter
+            for dtype in sorted({p.dtype for p in params}, key=str):
+                tensors = [p.data for p in params if p.dtype == dtype]
+                flat = _flatten_dense_tensors(tensors)
+                dist.broadcast(flat, src=global_rank, group=self.process_group)
+                if rank != self.rank:
+                    for t, synced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+                        t.copy_(synced)
+
+    def state_dict(self):
+        """Returns the state of the local optimizer, i.e. of the shard owned by this process."""
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        """Loads a state returned by :meth:`state_dict` on the process with the same rank."""
+        self.optimizer.load_state_dict(state_dict)
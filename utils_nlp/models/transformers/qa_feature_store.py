@@ -0,0 +1,324 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""
+Memory-mapped columnar storage of the question answering examples and features cached by
+:meth:`utils_nlp.models.transformers.question_answering.QAProcessor.preprocess`.
+
+A store is a directory of .npy arrays. Variable length fields, e.g. the tokens of the features,
+are flat arrays indexed by an array of offsets, and strings are utf-8 bytes indexed by offsets,
+so that a feature or an example is read by slicing, without decoding the whole store.
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+
+
+def _array_path(store_dir, name):
+    return os.path.join(store_dir, "{}.npy".format(name))
+
+
+def _save(store_dir, name, array):
+    np.save(_array_path(store_dir, name), array)
+
+
+def _load(store_dir, name):
+    return np.load(_array_path(store_dir, name), mmap_mode="r")
+
+
+def _get_offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _save_strings(store_dir, name, strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    _save(store_dir, name + "_offsets", _get_offsets([len(b) for b in encoded]))
+    _save(store_dir, name + "_bytes", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+
+class _StringColumn:
+    """Strings stored as utf-8 bytes and offsets."""
+
+    def __init__(self, store_dir, name):
+        self.offsets = _load(store_dir, name + "_offsets")
+        self.data = _load(store_dir, name + "_bytes")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.slice(index, index + 1)[0]
+
+    def slice(self, start, end):
+        """Returns the strings from `start` to `end`, excluded."""
+        offsets = self.offsets[start : end + 1] - self.offsets[start]
+        data = self.data[self.offsets[start] : self.offsets[end]].tobytes()
+        return [data[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(end - start)]
+
+
+def _write_meta(store_dir, meta):
+    # written last, the store is complete when the meta file exists
+    with open(os.path.join(store_dir, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+
+def _read_meta(store_dir, store_type):
+    meta_file = os.path.join(store_dir, META_FILE)
+    if not os.path.exists(meta_file):
+        raise ValueError(
+            "{0} is not a QA {1} store, run QAProcessor.preprocess to create it.".format(
+                store_dir, store_type
+            )
+        )
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta["type"] != store_type:
+        raise ValueError("{0} is a QA {1} store.".format(store_dir, meta["type"]))
+    return meta
+
+
+def write_qa_examples(store_dir, qa_examples):
+    """
+    Writes examples to a store.
+
+    Args:
+        store_dir (str): Directory of the store, created if it doesn't exist.
+        qa_examples (list): List of dictionaries with the "qa_id" and the whitespace separated
+            "doc_tokens" of the examples.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    qa_ids = [e["qa_id"] for e in qa_examples]
+    qa_ids_are_int = all(isinstance(i, (int, np.integer)) for i in qa_ids)
+    _save_strings(store_dir, "qa_id", [str(i) for i in qa_ids])
+    _save(store_dir, "doc_offsets", _get_offsets([len(e["doc_tokens"]) for e in qa_examples]))
+    _save_strings(store_dir, "doc_token", [t for e in qa_examples for t in e["doc_tokens"]])
+    _write_meta(
+        store_dir,
+        {"type": "examples", "num_examples": len(qa_examples), "int_qa_ids": qa_ids_are_int},
+    )
+
+
+def write_qa_features(store_dir, features):
+    """
+    Writes features to a store.
+
+    Args:
+        store_dir (str): Directory of the store, created if it doesn't exist.
+        features (list): List of feature dictionaries, in increasing order of "unique_id" and
+            "example_index", the index of the example of the feature in the examples store. The
+            "token_to_orig_map" and "token_is_max_context" dictionaries map the consecutive
+            indices of the document tokens in the "tokens" of the features to the indices of the
+            whitespace separated tokens of the documents and to whether the feature is the span
+            with the maximum context of the tokens.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    vocab = {}
+    token_ids = [vocab.setdefault(t, len(vocab)) for f in features for t in f["tokens"]]
+    doc_offsets = [min(f["token_to_orig_map"]) for f in features]
+    token_to_orig = []
+    token_is_max_context = []
+    for f, doc_offset in zip(features, doc_offsets):
+        for i in range(doc_offset, doc_offset + f["paragraph_len"]):
+            token_to_orig.append(f["token_to_orig_map"][i])
+            token_is_max_context.append(f["token_is_max_context"][i])
+
+    _save(store_dir, "unique_id", np.array([f["unique_id"] for f in features], dtype=np.int64))
+    _save(
+        store_dir,
+        "example_index",
+        np.array([f["example_index"] for f in features], dtype=np.int64),
+    )
+    _save(store_dir, "doc_offset", np.array(doc_offsets, dtype=np.int32))
+    _save(store_dir, "paragraph_len", np.array([f["paragraph_len"] for f in features], np.int32))
+    _save(store_dir, "token_offsets", _get_offsets([len(f["tokens"]) for f in features]))
+    _save(store_dir, "token_ids", np.array(token_ids, dtype=np.int32))
+    _save_strings(store_dir, "vocab", list(vocab))
+    _save(store_dir, "span_offsets", _get_offsets([f["paragraph_len"] for f in features]))
+    _save(store_dir, "token_to_orig", np.array(token_to_orig, dtype=np.int32))
+    _save(store_dir, "token_is_max_context", np.array(token_is_max_context, dtype=np.bool_))
+    _write_meta(store_dir, {"type": "features", "num_features": len(features)})
+
+
+class QAExampleStore:
+    """
+    Read access to a store written by :func:`write_qa_examples`.
+
+    Args:
+        store_dir (str): Directory of the store.
+    """
+
+    def __init__(self, store_dir):
+        meta = _read_meta(store_dir, "examples")
+        self.num_examples = meta["num_examples"]
+        self._int_qa_ids = meta["int_qa_ids"]
+        self._qa_ids = _StringColumn(store_dir, "qa_id")
+        self._doc_offsets = _load(store_dir, "doc_offsets")
+        self._doc_tokens = _StringColumn(store_dir, "doc_token")
+
+    def __len__(self):
+        return self.num_examples
+
+    def qa_id(self, index):
+        """Returns the qa_id of an example."""
+        qa_id = self._qa_ids[index]
+        return int(qa_id) if self._int_qa_ids else qa_id
+
+    def doc_tokens(self, index, start=0, end=None):
+        """
+        Returns the whitespace separated tokens of the document of an example, from `start` to
+        `end`, excluded, or to the last token.
+        """
+        doc_start = self._doc_offsets[index]
+        doc_end = self._doc_offsets[index + 1]
+        end = doc_end if end is None else min(doc_start + end, doc_end)
+        return self._doc_tokens.slice(doc_start + start, end)
+
+
+class QAFeature:
+    """
+    View of a feature of a :class:`QAFeatureStore`.
+
+    The indices of the methods are positions in the tokens of the feature.
+    """
+
+    __slots__ = [
+        "unique_id",
+        "example_index",
+        "doc_offset",
+        "paragraph_len",
+        "num_tokens",
+        "token_to_orig",
+        "token_is_max_context",
+        "_store",
+        "_index",
+    ]
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+        self.unique_id = int(store.unique_ids[index])
+        self.example_index = int(store.example_indices[index])
+        self.doc_offset = int(store.doc_offsets[index])
+        self.paragraph_len = int(store.paragraph_lens[index])
+        self.num_tokens = int(store.token_offsets[index + 1] - store.token_offsets[index])
+        span_start = store.span_offsets[index]
+        span_end = store.span_offsets[index + 1]
+        self.token_to_orig = store.token_to_orig[span_start:span_end]
+        self.token_is_max_context = store.token_is_max_context[span_start:span_end]
+
+    def is_doc_token(self, index):
+        """Returns whether a token belongs to the document span."""
+        return self.doc_offset <= index < self.doc_offset + self.paragraph_len
+
+    def is_max_context(self, index):
+        """Returns whether the feature is the span with the maximum context of a token."""
+        return self.is_doc_token(index) and bool(
+            self.token_is_max_context[index - self.doc_offset]
+        )
+
+    def orig_index(self, index):
+        """Returns the index of a document token in the whitespace separated document tokens."""
+        return int(self.token_to_orig[index - self.doc_offset])
+
+    def tokens(self, start=0, end=None):
+        """Returns the tokens from `start` to `end`, excluded, or to the last token."""
+        end = self.num_tokens if end is None else min(end, self.num_tokens)
+        token_start = self._store.token_offsets[self._index]
+        token_ids = self._store.token_ids[token_start + start : token_start + end]
+        return [self._store.vocab[i] for i in token_ids]
+
+
+class QAFeatureStore:
+    """
+    Read access to a store written by :func:`write_qa_features`.
+
+    Args:
+        store_dir (str): Directory of the store.
+    """
+
+    def __init__(self, store_dir):
+        meta = _read_meta(store_dir, "features")
+        self.num_features = meta["num_features"]
+        self.unique_ids = _load(store_dir, "unique_id")
+        self.example_indices = _load(store_dir, "example_index")
+        self.doc_offsets = _load(store_dir, "doc_offset")
+        self.paragraph_lens = _load(store_dir, "paragraph_len")
+        self.token_offsets = _load(store_dir, "token_offsets")
+        self.token_ids = _load(store_dir, "token_ids")
+        vocab = _StringColumn(store_dir, "vocab")
+        # the vocabulary is at most the tokenizer vocabulary
+        self.vocab = vocab.slice(0, len(vocab))
+        self.span_offsets = _load(store_dir, "span_offsets")
+        self.token_to_orig = _load(store_dir, "token_to_orig")
+        self.token_is_max_context = _load(store_dir, "token_is_max_context")
+
+    def __len__(self):
+        return self.num_features
+
+    def __getitem__(self, index):
+        return QAFeature(self, index)
+
+    def index_of(self, unique_id):
+        """Returns the index of the feature with a unique id."""
+        index = int(np.searchsorted(self.unique_ids, unique_id))
+        if index == self.num_features or self.unique_ids[index] != unique_id:
+            raise KeyError(unique_id)
+        return index
+
+    def _doc_positions(self, start, end, positions):
+        # positions relative to the document spans of the features, and whether they're in them
+        shape = (end - start,) + (1,) * (positions.ndim - 1)
+        doc_positions = positions - self.doc_offsets[start:end].reshape(shape)
+        is_doc_token = (doc_positions >= 0) & (
+            doc_positions < self.paragraph_lens[start:end].reshape(shape)
+        )
+        return doc_positions, is_doc_token, shape
+
+    def doc_token_mask(self, start, end, positions):
+        """
+        Returns whether tokens belong to the document spans of consecutive features.
+
+        Args:
+            start (int): Index of the first feature.
+            end (int): Index of the last feature, excluded.
+            positions (numpy.ndarray): Integer array of shape (end - start, ...), the positions
+                in the tokens of feature start + i are in row i.
+
+        Returns:
+            numpy.ndarray: Boolean array of the shape of `positions`.
+        """
+        return self._doc_positions(start, end, positions)[1]
+
+    def max_context_mask(self, start, end, positions):
+        """
+        Returns whether consecutive features are the spans with the maximum context of tokens,
+        see :meth:`doc_token_mask`.
+        """
+        doc_positions, is_doc_token, shape = self._doc_positions(start, end, positions)
+        # the document spans have at least one token
+        span_indices = self.span_offsets[start:end].reshape(shape) + np.where(
+            is_doc_token, doc_positions, 0
+        )
+        return is_doc_token & self.token_is_max_context[span_indices]
+
+    def example_features(self, num_examples):
+        """
+        Returns the ranges of the indices of the features of each example.
+
+        Args:
+            num_examples (int): Number of examples.
+
+        Returns:
+            numpy.ndarray: Array of shape (num_examples + 1,), the indices of the features of
+                example i are from result[i] to result[i + 1], excluded.
+        """
+        return np.searchsorted(self.example_indices, np.arange(num_examples + 1))
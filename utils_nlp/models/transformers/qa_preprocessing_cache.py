@@ -0,0 +1,133 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""
+Content-addressed cache of the question answering preprocessing, so that
+:meth:`utils_nlp.models.transformers.question_answering.QAProcessor.preprocess` only processes
+the documents and questions it hasn't seen before.
+"""
+
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# fields of the features which depend on the position of the question in the data, and are
+# set when the features are read from the cache
+_POSITIONAL_FIELDS = ["unique_id", "qa_id", "example_index"]
+
+
+def _hash(*values):
+    return hashlib.sha1(json.dumps(values, default=str).encode("utf-8")).hexdigest()
+
+
+def get_tokenizer_id(model_name, do_lower_case, custom_tokenize=None):
+    """Returns a string identifying the tokenization of a QAProcessor."""
+    if custom_tokenize is None:
+        custom_tokenize_name = None
+    else:
+        custom_tokenize_name = "{0}.{1}".format(
+            getattr(custom_tokenize, "__module__", None),
+            getattr(custom_tokenize, "__qualname__", repr(custom_tokenize)),
+        )
+    return _hash(model_name, do_lower_case, custom_tokenize_name)
+
+
+class QAPreprocessingCache:
+    """
+    SQLite cache of the tokenization of the documents and of the features of the questions.
+
+    The documents are keyed by the hash of their text and the tokenizer, and are shared by all
+    sequence lengths. The features of a question are keyed by the hash of its document, its
+    text and answer, the tokenizer, the model type and the preprocessing parameters. Entries are
+    pickled, only open cache files created by trusted code.
+
+    Args:
+        cache_file (str): Path of the SQLite database, created if it doesn't exist.
+        tokenizer_id (str): Identifier of the tokenizer returned by :func:`get_tokenizer_id`.
+        model_type (str): Model type, e.g. "bert" or "xlnet".
+        is_training (bool): Whether the features are training features.
+        max_question_length (int): Maximum number of tokens of the questions.
+        max_seq_length (int): Maximum number of tokens of the features.
+        doc_stride (int): Stride of the sliding window over the documents.
+    """
+
+    def __init__(
+        self,
+        cache_file,
+        tokenizer_id,
+        model_type,
+        is_training,
+        max_question_length,
+        max_seq_length,
+        doc_stride,
+    ):
+        self.cache_file = cache_file
+        self._connection = sqlite3.connect(cache_file)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, value BLOB)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS features (key TEXT PRIMARY KEY, value BLOB)"
+        )
+        self._tokenizer_id = tokenizer_id
+        self._features_id = _hash(
+            tokenizer_id, model_type, is_training, max_question_length, max_seq_length, doc_stride
+        )
+
+    def _document_key(self, doc_text):
+        return _hash(self._tokenizer_id, hashlib.sha1(doc_text.encode("utf-8")).hexdigest())
+
+    def _features_key(self, qa_input):
+        return _hash(
+            self._features_id,
+            hashlib.sha1(qa_input.doc_text.encode("utf-8")).hexdigest(),
+            qa_input.question_text,
+            qa_input.is_impossible,
+            qa_input.answer_start,
+            qa_input.answer_text,
+        )
+
+    def _get(self, table, key):
+        row = self._connection.execute(
+            "SELECT value FROM {} WHERE key = ?".format(table), (key,)
+        ).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def _put(self, table, key, value):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(table),
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)),
+        )
+
+    def get_document(self, doc_text):
+        """Returns the cached tokenization of a document, or None."""
+        return self._get("documents", self._document_key(doc_text))
+
+    def put_document(self, doc_text, document):
+        """Caches the tokenization of a document."""
+        self._put("documents", self._document_key(doc_text), document)
+
+    def get_features(self, qa_input):
+        """
+        Returns the cached features of a QAInput, as a list of dictionaries without the
+        "unique_id", "qa_id" and "example_index" fields, or None.
+        """
+        return self._get("features", self._features_key(qa_input))
+
+    def put_features(self, qa_input, features):
+        """Caches the features of a QAInput, a list of feature dictionaries."""
+        features = [
+            {k: v for k, v in f.items() if k not in _POSITIONAL_FIELDS} for f in features
+        ]
+        self._put("features", self._features_key(qa_input), features)
+
+    def commit(self):
+        """Writes the added entries to the cache file."""
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
@@ -21,10 +21,13 @@ import os
 import logging
 from tqdm import tqdm
 import collections
+import functools
 import json
 import math
-import jsonlines
+import multiprocessing as mp
+import tempfile
 
+import numpy as np
 import torch
 from torch.utils.data import TensorDataset, SequentialSampler, DataLoader, RandomSampler
 from torch.utils.data.distributed import DistributedSampler
@@ -41,6 +44,19 @@ from transformers.modeling_distilbert import (
 )
 
 from utils_nlp.common.pytorch_utils import get_device
+from utils_nlp.common.timer import Timer
+from utils_nlp.models.transformers.flops import FlopCounter, get_model_config, log_flops_report
+from utils_nlp.models.transformers.memmap_predictions import get_label_dtype
+from utils_nlp.models.transformers.qa_feature_store import (
+    QAExampleStore,
+    QAFeatureStore,
+    write_qa_examples,
+    write_qa_features,
+)
+from utils_nlp.models.transformers.qa_preprocessing_cache import (
+    QAPreprocessingCache,
+    get_tokenizer_id,
+)
 from utils_nlp.models.transformers.common import MAX_SEQ_LEN, TOKENIZER_CLASS, Transformer
 
 MODEL_CLASS = {}
@@ -50,16 +66,28 @@ MODEL_CLASS.update(
     {k: DistilBertForQuestionAnswering for k in DISTILBERT_PRETRAINED_MODEL_ARCHIVE_MAP}
 )
 
-# cached files during preprocessing
+# stores of examples and features cached during preprocessing, see qa_feature_store
 # these are used in postprocessing to generate the final answer texts
-CACHED_EXAMPLES_TRAIN_FILE = "cached_examples_train.jsonl"
-CACHED_FEATURES_TRAIN_FILE = "cached_features_train.jsonl"
+CACHED_EXAMPLES_TRAIN_FILE = "cached_examples_train"
+CACHED_FEATURES_TRAIN_FILE = "cached_features_train"
 
-CACHED_EXAMPLES_TEST_FILE = "cached_examples_test.jsonl"
-CACHED_FEATURES_TEST_FILE = "cached_features_test.jsonl"
+CACHED_EXAMPLES_TEST_FILE = "cached_examples_test"
+CACHED_FEATURES_TEST_FILE = "cached_features_test"
+
+# unique_id of the features is incremented from this value
+UNIQUE_ID_START = 1000000000
+# number of chunks per worker of the parallel preprocessing, to balance the load
+_CHUNKS_PER_WORKER = 4
+# number of examples whose candidate answers are searched at once in postprocessing
+_POSTPROCESSING_BLOCK_SIZE = 1024
+# number of original answer texts whose basic tokenization is cached in postprocessing
+_BASIC_TOKENIZE_CACHE_SIZE = 4096
 
 logger = logging.getLogger(__name__)
 
+# state of the preprocessing and postprocessing worker processes
+_WORKER = {}
+
 
 def _list_supported_models():
     return list(MODEL_CLASS)
@@ -150,6 +178,8 @@ class QAProcessor:
         max_seq_length=MAX_SEQ_LEN,
         doc_stride=128,
         feature_cache_dir="./cached_qa_features",
+        num_workers=1,
+        preprocessing_cache_file=None,
     ):
         """
         Preprocesses raw question answering data and generates train/test features.
@@ -171,12 +201,23 @@ class QAProcessor:
                 to 128.
             feature_cache_dir (int, optional): Directory to save some intermediate preprocessing
                 results.
-                If `is_training` is True, CACHED_EXAMPLES_TRAIN_FILE and
-                CACHED_FEATURES_TRAIN_FILE are saved to this directory. Otherwise,
-                CACHED_EXAMPLES_TEST_FILE and CACHED_FEATURES_TEST_FILE are saved to this
-                directory. These files are required during postprocessing to generate the final
-                answer texts from predicted answer start and answer end indices. Defaults to
-                "./cached_qa_features".
+                If `is_training` is True, the CACHED_EXAMPLES_TRAIN_FILE and
+                CACHED_FEATURES_TRAIN_FILE stores are saved to this directory. Otherwise, the
+                CACHED_EXAMPLES_TEST_FILE and CACHED_FEATURES_TEST_FILE stores are saved to this
+                directory. These memory-mapped stores, see
+                :mod:`utils_nlp.models.transformers.qa_feature_store`, are required during
+                postprocessing to generate the final answer texts from predicted answer start and
+                answer end indices. Defaults to "./cached_qa_features".
+            num_workers (int, optional): Number of processes creating the examples and features.
+                The rows are split into chunks whose features are merged in order, with the same
+                unique ids, files and tensors as with one process. The custom tokenizer, if any,
+                must be picklable. Defaults to 1, no worker processes.
+            preprocessing_cache_file (str, optional): Path of a
+                :class:`utils_nlp.models.transformers.qa_preprocessing_cache.QAPreprocessingCache`
+                SQLite file, created if it doesn't exist. The tokenization of the documents and
+                the features of the questions found in the cache are reused, and only the new
+                documents and questions are processed and added to the cache. The outputs are
+                the same as without the cache. Defaults to None, no cache.
         """
 
         if not os.path.exists(feature_cache_dir):
@@ -192,70 +233,58 @@ class QAProcessor:
             examples_file = os.path.join(feature_cache_dir, CACHED_EXAMPLES_TEST_FILE)
             features_file = os.path.join(feature_cache_dir, CACHED_FEATURES_TEST_FILE)
 
-        with jsonlines.open(examples_file, "w") as examples_writer, jsonlines.open(
-            features_file, "w"
-        ) as features_writer:
-
-            unique_id_all = []
-            unique_id_cur = 1000000000
-
-            features = []
-            qa_examples = []
-            qa_examples_json = []
-            features_json = []
-
-            for qa_input in qa_dataset:
-                qa_example_cur = _create_qa_example(qa_input, is_training=is_training)
-
-                qa_examples.append(qa_example_cur)
-
-                qa_examples_json.append(
-                    {"qa_id": qa_example_cur.qa_id, "doc_tokens": qa_example_cur.doc_tokens}
-                )
-
-                features_cur = _create_qa_features(
-                    qa_example_cur,
-                    model_type=self.model_type,
-                    tokenizer=self.tokenizer,
-                    unique_id=unique_id_cur,
-                    is_training=is_training,
-                    max_question_length=max_question_length,
-                    max_seq_length=max_seq_length,
-                    doc_stride=doc_stride,
-                    custom_tokenize=self.custom_tokenize,
+        featurize_args = {
+            "model_type": self.model_type,
+            "tokenizer": self.tokenizer,
+            "is_training": is_training,
+            "max_question_length": max_question_length,
+            "max_seq_length": max_seq_length,
+            "doc_stride": doc_stride,
+            "custom_tokenize": self.custom_tokenize,
+        }
+
+        if preprocessing_cache_file is not None:
+            cache = QAPreprocessingCache(
+                preprocessing_cache_file,
+                tokenizer_id=get_tokenizer_id(
+                    self.model_name, self.do_lower_case, self.custom_tokenize
+                ),
+                model_type=self.model_type,
+                is_training=is_training,
+                max_question_length=max_question_length,
+                max_seq_length=max_seq_length,
+                doc_stride=doc_stride,
+            )
+            try:
+                qa_examples, features = _featurize_with_cache(
+                    qa_dataset, featurize_args, num_workers, cache
                 )
-                features += features_cur
-
-                for f in features_cur:
-                    features_json.append(
-                        {
-                            "qa_id": f.qa_id,
-                            "unique_id": f.unique_id,
-                            "tokens": f.tokens,
-                            "token_to_orig_map": f.token_to_orig_map,
-                            "token_is_max_context": f.token_is_max_context,
-                            "paragraph_len": f.paragraph_len,
-                        }
-                    )
-                    unique_id_cur = f.unique_id
-                    unique_id_all.append(unique_id_cur)
+            finally:
+                cache.close()
+        elif num_workers > 1 and len(qa_dataset) > 1:
+            qa_examples, features = _featurize_parallel(qa_dataset, featurize_args, num_workers)
+        else:
+            qa_examples, features = _featurize_chunk(qa_dataset, **featurize_args)
+        unique_id_all = [f["unique_id"] for f in features]
 
-            examples_writer.write_all(qa_examples_json)
-            features_writer.write_all(features_json)
+        write_qa_examples(examples_file, qa_examples)
+        write_qa_features(features_file, features)
 
-            logger.info("QA examples are saved to {}".format(examples_file))
-            logger.info("QA features are saved to {}".format(features_file))
+        logger.info("QA examples are saved to {}".format(examples_file))
+        logger.info("QA features are saved to {}".format(features_file))
 
         # TODO: maybe generalize the following code
-        input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-        cls_index = torch.tensor([f.cls_index for f in features], dtype=torch.long)
-        p_mask = torch.tensor([f.p_mask for f in features], dtype=torch.float)
+        input_ids = torch.tensor([f["input_ids"] for f in features], dtype=torch.long)
+        input_mask = torch.tensor([f["input_mask"] for f in features], dtype=torch.long)
+        segment_ids = torch.tensor([f["segment_ids"] for f in features], dtype=torch.long)
+        cls_index = torch.tensor([f["cls_index"] for f in features], dtype=torch.long)
+        p_mask = torch.tensor([f["p_mask"] for f in features], dtype=torch.float)
 
         if is_training:
-            start_positions = torch.tensor([f.start_position for f in features], dtype=torch.long)
-            end_positions = torch.tensor([f.end_position for f in features], dtype=torch.long)
+            start_positions = torch.tensor(
+                [f["start_position"] for f in features], dtype=torch.long
+            )
+            end_positions = torch.tensor([f["end_position"] for f in features], dtype=torch.long)
             qa_dataset = TensorDataset(
                 input_ids,
                 input_mask,
@@ -295,17 +324,19 @@ class QAProcessor:
         output_null_log_odds_file="./null_odds.json",
         null_score_diff_threshold=0.0,
         verbose_logging=False,
+        num_workers=1,
     ):
 
         """
         Postprocesses start and end logits generated by :meth:`AnswerExtractor.fit`.
 
         Args:
-            results (list): List of :class:`QAResultExtended`.
-            examples_file (str): One of the files cached by :meth:`QAProcessor.preprocess`. This
+            results (QAPredictions or list): Predictions of :meth:`AnswerExtractor.predict`, or
+                list of :class:`QAResult` or :class:`QAResultExtended`.
+            examples_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`. This
                 file contains the original document tokens that are used to generate the final
                 answers from the predicted start and end positions.
-            features_file (str): One of the files cached by :meth:`QAProcessor.preprocess`. This
+            features_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`. This
                 file contains the mapping from indices in the processed token list to the original
                 document tokens that are used to generate the final predicted answers.
             n_best_size (int, optional): The number of candidates to choose from each QAResult to
@@ -336,6 +367,9 @@ class QAProcessor:
                 answer is empty. Defaults to 0.0.
             verbose_logging (bool, optional): Whether to log details of answer postprocessing.
                 Defaults to False.
+            num_workers (int, optional): Number of processes postprocessing the examples. The
+                examples are split into chunks whose answers are merged in order, with the same
+                outputs as with one process. Defaults to 1, no worker processes.
 
         Returns:
             tuple: (OrderedDict, OrderedDict, OrderedDict)
@@ -363,6 +397,7 @@ class QAProcessor:
                 output_nbest_file=output_nbest_file,
                 output_null_log_odds_file=output_null_log_odds_file,
                 verbose_logging=verbose_logging,
+                num_workers=num_workers,
             )
         else:
             final_answers, answer_probs, nbest_answers = postprocess_bert_answer(
@@ -378,9 +413,82 @@ class QAProcessor:
                 output_null_log_odds_file=output_null_log_odds_file,
                 null_score_diff_threshold=null_score_diff_threshold,
                 verbose_logging=verbose_logging,
+                num_workers=num_workers,
             )
         return final_answers, answer_probs, nbest_answers
 
+    def postprocess_stream(
+        self,
+        result_batches,
+        examples_file,
+        features_file,
+        n_best_size=20,
+        n_top_start=5,
+        n_top_end=5,
+        max_answer_length=30,
+        unanswerable_exists=False,
+        null_score_diff_threshold=0.0,
+        verbose_logging=False,
+    ):
+        """
+        Postprocesses batches of start and end logits as they are predicted by
+        :meth:`AnswerExtractor.predict_stream`, see :meth:`postprocess`.
+
+        The answer of a question is yielded as soon as the results of all its features are
+        available, so that the first answers are available before the prediction ends and only
+        the results of the questions not yet answered are kept in memory.
+
+        Args:
+            result_batches (iterable): Iterable of :class:`QAPredictions` or of lists of
+                :class:`QAResult` or :class:`QAResultExtended`.
+            examples_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`.
+            features_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`.
+            n_best_size (int, optional): The number of candidates to choose from each QAResult
+                and the maximum number of n-best answers of each question. Defaults to 20.
+            n_top_start (int, optional): For XLNet only. Beam size for span start. Defaults to 5.
+            n_top_end (int, optional): For XLNet only. Beam size for span end. Defaults to 5.
+            max_answer_length (int, optional): Maximum length of the answer. Defaults to 30.
+            unanswerable_exists (bool, optional): For BERT models only. Whether there are
+                unanswerable questions in the data. Defaults to False.
+            null_score_diff_threshold (float, optional): For BERT models only.
+                If unanswerable_exists=True and the score difference between empty prediction and
+                best non-empty prediction is higher than this threshold, the final predicted
+                answer is empty. Defaults to 0.0.
+            verbose_logging (bool, optional): Whether to log details of answer postprocessing.
+                Defaults to False.
+
+        Yields:
+            :class:`QAAnswer`: Answers of the questions, in the order of the examples.
+
+        Examples:
+            >>> results = extractor.predict_stream(test_dataloader)
+            >>> for answer in processor.postprocess_stream(results, examples_file, features_file):
+            ...     print(answer.qa_id, answer.text)
+        """
+        if self.model_type == "xlnet":
+            return postprocess_xlnet_answer_stream(
+                result_batches,
+                examples_file=examples_file,
+                features_file=features_file,
+                tokenizer=self.tokenizer,
+                n_best_size=n_best_size,
+                n_top_start=n_top_start,
+                n_top_end=n_top_end,
+                max_answer_length=max_answer_length,
+                verbose_logging=verbose_logging,
+            )
+        return postprocess_bert_answer_stream(
+            result_batches,
+            examples_file=examples_file,
+            features_file=features_file,
+            do_lower_case=self.do_lower_case,
+            unanswerable_exists=unanswerable_exists,
+            n_best_size=n_best_size,
+            max_answer_length=max_answer_length,
+            null_score_diff_threshold=null_score_diff_threshold,
+            verbose_logging=verbose_logging,
+        )
+
 
 QAResult_ = collections.namedtuple("QAResult", ["unique_id", "start_logits", "end_logits"])
 
@@ -388,7 +496,8 @@ QAResult_ = collections.namedtuple("QAResult", ["unique_id", "start_logits", "en
 # create a wrapper class so that we can add docstrings
 class QAResult(QAResult_):
     """
-    Question answering prediction result returned by AnswerExtractor.predict for BERT models.
+    Question answering prediction result of a feature for BERT models, yielded by the
+    :class:`QAPredictions` returned by AnswerExtractor.predict.
 
     Args:
         unique_id (int): An id identifying a unique document-question-answer triplet. During
@@ -420,7 +529,8 @@ QAResultExtended_ = collections.namedtuple(
 # create a wrapper class so that we can add docstrings
 class QAResultExtended(QAResultExtended_):
     """
-    Question answering prediction result returned by AnswerExtractor.predict for XLNet models.
+    Question answering prediction result of a feature for XLNet models, yielded by the
+    :class:`QAPredictions` returned by AnswerExtractor.predict.
 
     Args:
         unique_id (int): An id identifying a unique document-question-answer triplet. During
@@ -441,6 +551,177 @@ class QAResultExtended(QAResultExtended_):
     pass
 
 
+class QAPredictions:
+    """
+    Predictions of :meth:`AnswerExtractor.predict` stored in compact arrays, with one row per
+    feature, instead of lists of Python floats.
+
+    The postprocessing functions take the arrays directly. Iterating over the predictions yields
+    the :class:`QAResult` or :class:`QAResultExtended` of each feature.
+
+    Args:
+        unique_ids (numpy.ndarray): Unique ids of the features, of shape (num_features,).
+        **arrays: Arrays of the predictions of the features, with the fields of
+            :class:`QAResult` for BERT models, "start_logits" and "end_logits" of shape
+            (num_features, max_seq_length), or the fields of :class:`QAResultExtended` for XLNet
+            models, "start_top_log_probs" and "start_top_index" of shape
+            (num_features, n_top_start), "end_top_log_probs" and "end_top_index" of shape
+            (num_features, n_top_start * n_top_end) and "cls_logits" of shape (num_features,).
+    """
+
+    def __init__(self, unique_ids, **arrays):
+        self.unique_ids = np.asarray(unique_ids, dtype=np.int64)
+        self.arrays = arrays
+        self._sorter = None
+
+    @classmethod
+    def from_results(cls, results):
+        """
+        Creates predictions from a list of :class:`QAResult` or :class:`QAResultExtended`, or
+        returns `results` if they already are :class:`QAPredictions`.
+        """
+        if isinstance(results, QAPredictions):
+            return results
+        results = list(results)
+        unique_ids = [r.unique_id for r in results]
+        if results and isinstance(results[0], QAResultExtended_):
+            return cls(
+                unique_ids,
+                start_top_log_probs=_stack_rows([r.start_top_log_probs for r in results]),
+                start_top_index=_stack_rows(
+                    [r.start_top_index for r in results], fill_value=-1, dtype=np.int64
+                ),
+                end_top_log_probs=_stack_rows([r.end_top_log_probs for r in results]),
+                end_top_index=_stack_rows(
+                    [r.end_top_index for r in results], fill_value=-1, dtype=np.int64
+                ),
+                cls_logits=np.array([r.cls_logits for r in results], dtype=np.float64).reshape(
+                    len(results)
+                ),
+            )
+        return cls(
+            unique_ids,
+            start_logits=_stack_rows([r.start_logits for r in results]),
+            end_logits=_stack_rows([r.end_logits for r in results]),
+        )
+
+    @classmethod
+    def concatenate(cls, predictions):
+        """Concatenates a list of predictions with the same fields."""
+        return cls(
+            np.concatenate([p.unique_ids for p in predictions]),
+            **{
+                name: np.concatenate([p.arrays[name] for p in predictions])
+                for name in predictions[0].arrays
+            }
+        )
+
+    def __len__(self):
+        return len(self.unique_ids)
+
+    def __getitem__(self, index):
+        fields = {name: array[index].tolist() for name, array in self.arrays.items()}
+        if "cls_logits" in fields:
+            return QAResultExtended(unique_id=int(self.unique_ids[index]), **fields)
+        return QAResult(unique_id=int(self.unique_ids[index]), **fields)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def save(self, predictions_dir):
+        """
+        Saves the arrays of the predictions as .npy files of a directory, created if it doesn't
+        exist, see :meth:`load`.
+        """
+        os.makedirs(predictions_dir, exist_ok=True)
+        np.save(os.path.join(predictions_dir, "unique_ids.npy"), self.unique_ids)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(predictions_dir, "{}.npy".format(name)), array)
+
+    @classmethod
+    def load(cls, predictions_dir, mmap_mode="r"):
+        """
+        Loads predictions saved by :meth:`save`.
+
+        Args:
+            predictions_dir (str): Directory of the predictions.
+            mmap_mode (str, optional): Memory-map mode of the arrays, see :func:`numpy.load`.
+                Defaults to "r", the arrays are read from the files when accessed.
+
+        Returns:
+            :class:`QAPredictions`: The predictions.
+        """
+        arrays = {
+            os.path.splitext(name)[0]: np.load(
+                os.path.join(predictions_dir, name), mmap_mode=mmap_mode
+            )
+            for name in sorted(os.listdir(predictions_dir))
+            if name.endswith(".npy")
+        }
+        unique_ids = arrays.pop("unique_ids")
+        return cls(unique_ids, **arrays)
+
+    def take(self, rows):
+        """Returns the predictions of some rows."""
+        return QAPredictions(
+            self.unique_ids[rows], **{name: array[rows] for name, array in self.arrays.items()}
+        )
+
+    def index_of(self, unique_ids):
+        """
+        Returns the rows of the predictions of features.
+
+        Args:
+            unique_ids (list): Unique ids of the features.
+
+        Returns:
+            numpy.ndarray: Rows of the features.
+
+        Raises:
+            KeyError: If a feature has no prediction.
+        """
+        unique_ids = np.asarray(unique_ids, dtype=np.int64)
+        if len(unique_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if len(self) == 0:
+            raise KeyError(int(unique_ids[0]))
+        if self._sorter is None:
+            self._sorter = np.argsort(self.unique_ids, kind="stable")
+        positions = np.searchsorted(self.unique_ids, unique_ids, sorter=self._sorter)
+        rows = self._sorter[np.minimum(positions, len(self) - 1)]
+        missing = self.unique_ids[rows] != unique_ids
+        if missing.any():
+            raise KeyError(int(unique_ids[missing][0]))
+        return rows
+
+
+QAAnswer_ = collections.namedtuple(
+    "QAAnswer", ["qa_id", "text", "probability", "nbest", "null_odds"]
+)
+
+
+# create a wrapper class so that we can add docstrings
+class QAAnswer(QAAnswer_):
+    """
+    Final answer of a question yielded by :meth:`QAProcessor.postprocess_stream`.
+
+    Args:
+        qa_id (int or str): The `qa_id` of the question in the original
+            :class:`utils_nlp.dataset.pytorch.QADataset`.
+        text (str): Predicted answer text.
+        probability (float): Softmax probability of the predicted answer.
+        nbest (list): The n-best answers of the question, as dictionaries of their "text",
+            "probability", "start_logit" and "end_logit".
+        null_odds (float): Score difference between the empty prediction and the best non-empty
+            prediction for BERT models, the log probability of the answer being empty for XLNet
+            models. None for BERT models if there are no unanswerable questions.
+
+    """
+
+    pass
+
+
 class AnswerExtractor(Transformer):
     """
     Answer extractor based on pre-trained transformers models.
@@ -486,10 +767,17 @@ class AnswerExtractor(Transformer):
         adam_epsilon=1e-8,
         fp16=False,
         fp16_opt_level="O1",
+        bf16=False,
         local_rank=-1,
         verbose=True,
         seed=None,
         cache_model=True,
+        val_dataloader=None,
+        validation_steps=None,
+        early_stopping_patience=None,
+        best_model_dir=None,
+        gradient_checkpointing=False,
+        shard_optimizer_state=False,
     ):
         """
         Fine-tune pre-trained transofmer models for question answering.
@@ -518,6 +806,9 @@ class AnswerExtractor(Transformer):
             fp16_opt_level (str, optional): For fp16: Apex AMP optimization level selected in
                 ['O0', 'O1', 'O2', and 'O3']. See details at https://nvidia.github.io/apex/amp.html.
                 Defaults to "O1",
+            bf16 (bool, optional): Whether to run the forward passes with bfloat16 autocast on
+                CPU, while the loss and the optimizer stay in float32. Can't be combined with
+                `fp16`. Defaults to False.
             local_rank (int, optional): Local_rank for distributed training on GPUs. Defaults to
                 -1, which means non-distributed training.
             verbose (bool, optional): Whether to print out the training log. Defaults to True.
@@ -525,6 +816,29 @@ class AnswerExtractor(Transformer):
             cache_model (bool, optional): Whether to save the fine-tuned model. If True,
                 the fine-tuned model is saved to a `fine_tuned` folder under of the `cache_dir`
                 of AnswerExtractor. Defaults to True.
+            val_dataloader (Dataloader, optional): Dataloader for validation data with answer
+                start and end positions, e.g. created by :meth:`QAProcessor.preprocess` with
+                `is_training=True`. If provided, the model is evaluated on the validation loss
+                during training and the weights with the lowest loss are restored at the end.
+                Defaults to None.
+            validation_steps (int, optional): Number of optimization steps between evaluations.
+                Defaults to None, which means evaluating at the end of each epoch.
+            early_stopping_patience (int, optional): Number of evaluations without improvement
+                after which training stops. Defaults to None, which means no early stopping.
+            best_model_dir (str, optional): Directory to save the best model to. Defaults to
+                None, which means keeping the best weights in CPU memory.
+            gradient_checkpointing (bool, optional): Whether to recompute the activations of the
+                encoder layers during the backward pass instead of storing them. This reduces
+                the training memory, e.g. to use larger batches with large models and long
+                sequences, at the cost of about one extra forward pass per step. See the
+                `compare_gradient_checkpointing` function of
+                :mod:`utils_nlp.models.transformers.gradient_checkpointing` to measure the
+                trade-off. With distributed training, it requires torch 1.11 or later. Defaults
+                to False.
+            shard_optimizer_state (bool, optional): Whether to divide the AdamW state across the
+                processes of distributed training, each process updating its shard of the
+                parameters. Requires `local_rank` != -1 and can't be combined with `fp16`.
+                Defaults to False.
 
         """
 
@@ -546,14 +860,31 @@ class AnswerExtractor(Transformer):
             warmup_steps=warmup_steps,
             fp16=fp16,
             fp16_opt_level=fp16_opt_level,
+            bf16=bf16,
             local_rank=local_rank,
             verbose=verbose,
             seed=seed,
+            val_dataloader=val_dataloader,
+            validation_steps=validation_steps,
+            early_stopping_patience=early_stopping_patience,
+            best_model_dir=best_model_dir,
+            gradient_checkpointing=gradient_checkpointing,
+            shard_optimizer_state=shard_optimizer_state,
         )
         if cache_model:
             self.save_model()
 
-    def predict(self, test_dataloader, num_gpus=None, local_rank=-1, verbose=True):
+    def predict(
+        self,
+        test_dataloader,
+        num_gpus=None,
+        local_rank=-1,
+        verbose=True,
+        bf16=False,
+        logits_dtype=np.float32,
+        n_top_start=None,
+        n_top_end=None,
+    ):
 
         """
         Predicts answer start and end logits.
@@ -566,51 +897,140 @@ class AnswerExtractor(Transformer):
             local_rank (int, optional): Local_rank for distributed training on GPUs. Defaults to
                 -1, which means non-distributed.
             verbose (bool, optional): Whether to print out the predicting log. Defaults to True.
+            bf16 (bool, optional): Whether to run the model with bfloat16 autocast on CPU. The
+                logits are converted to float32 before being stored. Defaults to False.
+            logits_dtype (dtype, optional): Dtype of the stored logits and log probabilities,
+                e.g. numpy.float16 to halve their size. Defaults to numpy.float32.
+            n_top_start (int, optional): For XLNet only. Number of the top start positions of the
+                beam search to store, at most the start_n_top of the model configuration. None
+                stores all of them. Defaults to None.
+            n_top_end (int, optional): For XLNet only. Number of the top end positions of each
+                start position to store, at most the end_n_top of the model configuration. None
+                stores all of them. Defaults to None.
 
         Returns:
-            list: List of :class:`QAResult` or :class:`QAResultExtended`.
+            :class:`QAPredictions`: Predictions of the features, in arrays preallocated for all
+                the features of `test_dataloader`.
+        """
+        predictions = None
+        num_predictions = 0
+        for batch_predictions in self.predict_stream(
+            test_dataloader,
+            num_gpus=num_gpus,
+            local_rank=local_rank,
+            verbose=verbose,
+            bf16=bf16,
+            logits_dtype=logits_dtype,
+            n_top_start=n_top_start,
+            n_top_end=n_top_end,
+        ):
+            if predictions is None:
+                num_features = len(test_dataloader.dataset)
+                predictions = QAPredictions(
+                    np.zeros(num_features, dtype=np.int64),
+                    **{
+                        name: np.zeros((num_features,) + array.shape[1:], dtype=array.dtype)
+                        for name, array in batch_predictions.arrays.items()
+                    }
+                )
+            end = num_predictions + len(batch_predictions)
+            predictions.unique_ids[num_predictions:end] = batch_predictions.unique_ids
+            for name, array in batch_predictions.arrays.items():
+                predictions.arrays[name][num_predictions:end] = array
+            num_predictions = end
+
+        if predictions is None:
+            return QAPredictions.from_results([])
+        if num_predictions < len(predictions):
+            # a distributed sampler only predicts a part of the features
+            predictions = predictions.take(slice(0, num_predictions))
+        return predictions
+
+    def predict_stream(
+        self,
+        test_dataloader,
+        num_gpus=None,
+        local_rank=-1,
+        verbose=True,
+        bf16=False,
+        logits_dtype=np.float32,
+        n_top_start=None,
+        n_top_end=None,
+    ):
         """
+        Predicts answer start and end logits batch by batch, see :meth:`predict`.
 
-        def _to_list(tensor):
-            return tensor.detach().cpu().tolist()
+        The predictions of a batch are yielded as soon as they are computed, so that they can be
+        postprocessed by :meth:`QAProcessor.postprocess_stream` while the next batches are
+        predicted. `flops_report` is set once all the batches are predicted, the time spent by
+        the caller between two batches isn't counted.
+
+        Yields:
+            :class:`QAPredictions`: Predictions of the features of a batch.
+        """
+
+        def _to_numpy(tensor, dtype):
+            if tensor.is_floating_point():
+                tensor = tensor.float()
+            return tensor.detach().cpu().numpy().astype(dtype)
 
         device, num_gpus = get_device(num_gpus=num_gpus, local_rank=local_rank)
+        Transformer._check_bf16(bf16, device)
 
         self.model.to(device)
 
         # score
         self.model.eval()
 
-        all_results = []
+        flop_counter = FlopCounter(get_model_config(self.model), train=False)
+        predict_time = 0
         for batch in tqdm(test_dataloader, desc="Evaluating", disable=not verbose):
+            predict_timer = Timer()
+            predict_timer.start()
             batch = tuple(t.to(device) for t in batch)
             with torch.no_grad():
                 inputs = QAProcessor.get_inputs(batch, self.model_name, train_mode=False)
-
-                outputs = self.model(**inputs)
-
-                unique_id_tensor = batch[5]
-
-            for i, u_id in enumerate(unique_id_tensor):
-                if self.model_type in ["xlnet"]:
-                    result = QAResultExtended(
-                        unique_id=u_id.item(),
-                        start_top_log_probs=_to_list(outputs[0][i]),
-                        start_top_index=_to_list(outputs[1][i]),
-                        end_top_log_probs=_to_list(outputs[2][i]),
-                        end_top_index=_to_list(outputs[3][i]),
-                        cls_logits=_to_list(outputs[4][i]),
-                    )
-                else:
-                    result = QAResult(
-                        unique_id=u_id.item(),
-                        start_logits=_to_list(outputs[0][i]),
-                        end_logits=_to_list(outputs[1][i]),
-                    )
-                all_results.append(result)
+                flop_counter.update(inputs)
+
+                outputs = self._forward(inputs, device, bf16)
+
+                unique_ids = batch[5].cpu().numpy()
+
+            # the positions fit in the smallest integer type holding the sequence length
+            index_dtype = get_label_dtype(batch[0].shape[1])
+            if self.model_type in ["xlnet"]:
+                batch_size, model_n_top_start = outputs[0].shape
+                # the end positions are ordered by start position
+                end_shape = (batch_size, model_n_top_start, -1)
+                start_slice = slice(0, n_top_start)
+                end_slice = (slice(None), start_slice, slice(0, n_top_end))
+                predictions = QAPredictions(
+                    unique_ids,
+                    start_top_log_probs=_to_numpy(outputs[0][:, start_slice], logits_dtype),
+                    start_top_index=_to_numpy(outputs[1][:, start_slice], index_dtype),
+                    end_top_log_probs=_to_numpy(
+                        outputs[2].reshape(end_shape)[end_slice].reshape(batch_size, -1),
+                        logits_dtype,
+                    ),
+                    end_top_index=_to_numpy(
+                        outputs[3].reshape(end_shape)[end_slice].reshape(batch_size, -1),
+                        index_dtype,
+                    ),
+                    cls_logits=_to_numpy(outputs[4].reshape(batch_size), logits_dtype),
+                )
+            else:
+                predictions = QAPredictions(
+                    unique_ids,
+                    start_logits=_to_numpy(outputs[0], logits_dtype),
+                    end_logits=_to_numpy(outputs[1], logits_dtype),
+                )
             torch.cuda.empty_cache()
+            predict_timer.stop()
+            predict_time += predict_timer.interval
+            yield predictions
 
-        return all_results
+        self.flops_report = flop_counter.report(predict_time, self.peak_flops)
+        log_flops_report(self.flops_report, prefix="Prediction: ")
 
 
 def postprocess_bert_answer(
@@ -626,16 +1046,18 @@ def postprocess_bert_answer(
     output_null_log_odds_file="./null_odds.json",
     null_score_diff_threshold=0.0,
     verbose_logging=False,
+    num_workers=1,
 ):
     """
     Postprocesses start and end logits generated by :meth:`AnswerExtractor.fit` for BERT.
 
     Args:
-        results (list): List of :class:`QAResult`.
-        examples_file (str): One of the files cached by :meth:`QAProcessor.preprocess`. This file
+        results (QAPredictions or list): Predictions of :meth:`AnswerExtractor.predict`, or list
+            of :class:`QAResult`.
+        examples_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`. This file
             contains the original document tokens that are used to generate the final answers
             from the predicted start and end positions.
-        features_file (str): One of the files cached by :meth:`QAProcessor.preprocess`. This file
+        features_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`. This file
             contains the mapping from indices in the processed token list to the original
             document tokens that are used to generate the final predicted answers.
         do_lower_case (bool): Whether an uncased tokenizer was used during data preprocessing.
@@ -664,6 +1086,9 @@ def postprocess_bert_answer(
             threshold, the final predicted answer is empty. Defaults to 0.0.
         verbose_logging (bool, optional): Whether to log details of answer postprocessing.
             Defaults to False.
+        num_workers (int, optional): Number of processes postprocessing the examples. The
+            examples are split into chunks whose answers are merged in order, with the same
+            outputs as with one process. Defaults to 1, no worker processes.
 
     Returns:
         tuple: (OrderedDict, OrderedDict, OrderedDict)
@@ -677,201 +1102,282 @@ def postprocess_bert_answer(
             unqualified answers, e.g. answers that are too long, are removed.
 
     """
-    with jsonlines.open(examples_file) as reader:
-        examples_all = list(reader.iter())
+    block_args = {
+        "do_lower_case": do_lower_case,
+        "unanswerable_exists": unanswerable_exists,
+        "n_best_size": n_best_size,
+        "max_answer_length": max_answer_length,
+        "null_score_diff_threshold": null_score_diff_threshold,
+        "verbose_logging": verbose_logging,
+    }
+    if num_workers > 1:
+        answers = _postprocess_parallel(
+            _postprocess_bert_block,
+            results,
+            examples_file,
+            features_file,
+            num_workers,
+            **block_args
+        )
+    else:
+        answers = postprocess_bert_answer_stream(
+            [results], examples_file=examples_file, features_file=features_file, **block_args
+        )
+    return _write_answers(
+        answers,
+        unanswerable_exists,
+        output_prediction_file,
+        output_nbest_file,
+        output_null_log_odds_file,
+    )
+
+
+def postprocess_bert_answer_stream(
+    result_batches,
+    examples_file,
+    features_file,
+    do_lower_case,
+    unanswerable_exists=False,
+    n_best_size=20,
+    max_answer_length=30,
+    null_score_diff_threshold=0.0,
+    verbose_logging=False,
+):
+    """
+    Postprocesses batches of start and end logits for BERT as they are predicted, see
+    :func:`postprocess_bert_answer`.
 
-    with jsonlines.open(features_file) as reader:
-        features_all = list(reader.iter())
+    The answer of a question is yielded as soon as the results of all its features are
+    available, and only the results of the questions not yet answered are kept in memory.
+
+    Args:
+        result_batches (iterable): Iterable of :class:`QAPredictions` or of lists of
+            :class:`QAResult`, e.g. the batches yielded by :meth:`AnswerExtractor.predict_stream`.
+        examples_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`.
+        features_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`.
+        do_lower_case (bool): Whether an uncased tokenizer was used during data preprocessing.
+        unanswerable_exists (bool, optional): Whether there are unanswerable questions in the
+            data. Defaults to False.
+        n_best_size (int, optional): The number of candidates to choose from each QAResult and
+            the maximum number of n-best answers of each question. Defaults to 20.
+        max_answer_length (int, optional): Maximum length of the answer. Defaults to 30.
+        null_score_diff_threshold (float, optional): If unanswerable_exists=True and the score
+            difference between empty prediction and best non-empty prediction is higher than this
+            threshold, the final predicted answer is empty. Defaults to 0.0.
+        verbose_logging (bool, optional): Whether to log details of answer postprocessing.
+            Defaults to False.
+
+    Yields:
+        :class:`QAAnswer`: Answers of the questions, in the order of the examples.
+    """
+    examples_all = QAExampleStore(examples_file)
+    features_all = QAFeatureStore(features_file)
 
-    qa_id_to_features = collections.defaultdict(list)
     # Map unique features to the original doc-question-answer triplet
     # Each doc-question-answer triplet can have multiple features because the doc
     # could be split into multiple spans
-    for f in features_all:
-        qa_id_to_features[f["qa_id"]].append(f)
+    example_features = features_all.example_features(len(examples_all))
 
-    unique_id_to_result = {}
-    for r in results:
-        unique_id_to_result[r.unique_id] = r
+    for example_start, example_end, block_predictions in _iter_result_blocks(
+        result_batches, features_all, example_features
+    ):
+        for answer in _postprocess_bert_block(
+            examples_all,
+            features_all,
+            example_features,
+            example_start,
+            example_end,
+            block_predictions,
+            do_lower_case=do_lower_case,
+            unanswerable_exists=unanswerable_exists,
+            n_best_size=n_best_size,
+            max_answer_length=max_answer_length,
+            null_score_diff_threshold=null_score_diff_threshold,
+            verbose_logging=verbose_logging,
+        ):
+            yield answer
 
-    all_predictions = collections.OrderedDict()
-    all_probs = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
 
-    for example in examples_all:
-        # get all the features belonging to the same example,
-        # i.e. paragaraph/question pair.
-        features = qa_id_to_features[example["qa_id"]]
+def postprocess_xlnet_answer(
+    results,
+    examples_file,
+    features_file,
+    tokenizer,
+    n_best_size=20,
+    n_top_start=5,
+    n_top_end=5,
+    max_answer_length=30,
+    unanswerable_exists=False,
+    output_prediction_file="./qa_predictions.json",
+    output_nbest_file="./nbest_predictions.json",
+    output_null_log_odds_file="./null_odds.json",
+    verbose_logging=False,
+    num_workers=1,
+):
+    """
+    Postprocesses start and end logits generated by :meth:`AnswerExtractor.fit` for XLNet.
 
-        prelim_predictions = []
-        # keep track of the minimum score of null start+end of position 0
-        score_null = 1000000  # large and positive
+    Args:
+        results (QAPredictions or list): Predictions of :meth:`AnswerExtractor.predict`, or list
+            of :class:`QAResultExtended`.
+        examples_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`. This file
+            contains the original document tokens that are used to generate the final answers
+            from the predicted start and end positions.
+        features_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`. This file
+            contains the mapping from indices in the processed token list to the original
+            document tokens that are used to generate the final predicted answers.
+        tokenizer (XLNetTokenizer): Tokenizer used during data preprocessing.
+        n_best_size (int, optional): The number of candidates to choose from each QAResult to
+            generate the final prediction. It's also the maximum number of n-best answers to
+            output for each question. Note that the number of n-best answers can be smaller than
+            `n_best_size` because some unqualified answers, e.g. answer that are too long,
+            are removed.
+        n_top_start (int, optional): Beam size for span start. Note that this needs to be
+            consistent with the XLNet model configuration. Defaults to 5.
+        n_top_end (int, optional): Beam size for span end. Note that this needs to be
+            consistent with the XLNet model configuration. Defaults to 5.
+        max_answer_length (int, optional): Maximum length of the answer. Defaults to 30.
+        unanswerable_exists (bool, optional): Whether there are unanswerable questions in the
+            data. If True, the start and end logits of the [CLS] token, which indicate the
+            probability of the answer being empty, are included in the candidate answer list.
+            Defaults to False.
+        output_prediction_file (str, optional): Path of the file to save the predicted answers.
+            Defaults to "./qa_predictions.json".
+        output_nbest_file (str, optional): Path of the file to save the n-best answers. Defaults
+            to "./nbest_predictions.json".
+        output_null_log_odds_file (str, optional): If unanswerable_exists is True, the score
+            difference between empty prediction and best non-empty prediction are saved to this
+            file. These scores can be used to find the best threshold for predicting an empty
+            answer. Defaults to "./null_odds.json".
+        verbose_logging (bool, optional): Whether to log details of answer postprocessing.
+            Defaults to False.
+        num_workers (int, optional): Number of processes postprocessing the examples. The
+            examples are split into chunks whose answers are merged in order, with the same
+            outputs as with one process. Defaults to 1, no worker processes.
 
-        min_null_feature_index = 0  # the paragraph slice with min null score
-        null_start_logit = 0  # the start logit at the slice with min null score
-        null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, f) in enumerate(features):
-            result = unique_id_to_result[f["unique_id"]]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            # if we could have irrelevant answers, get the min score of irrelevant
-            if unanswerable_exists:
-                # The first element of the start end end logits is the
-                # probability of predicting the [CLS] token as the start and
-                # end positions of the answer, which means the answer is
-                # empty.
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
-                if feature_null_score < score_null:
-                    score_null = feature_null_score
-                    min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(f["tokens"]):
-                        continue
-                    if end_index >= len(f["tokens"]):
-                        continue
-                    if str(start_index) not in f["token_to_orig_map"]:
-                        continue
-                    if str(end_index) not in f["token_to_orig_map"]:
-                        continue
-                    if not f["token_is_max_context"].get(str(start_index), False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                        )
-                    )
-        if unanswerable_exists:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit,
-                )
-            )
+    Returns:
+        tuple: (OrderedDict, OrderedDict, OrderedDict)
+            The keys of the dictionaries are the `qa_id` in the original
+            :class:`utils_nlp.dataset.pytorch.QADataset`
+            The values of the first dictionary are the predicted answer texts in string type.
+            The values of the second dictionary are the softmax probabilities of the predicted
+            answers.
+            The values of the third dictionary are the n-best answers for each qa_id. Note that
+            the number of n-best answers can be smaller than `n_best_size` because some
+            unqualified answers, e.g. answers that are too long, are removed.
 
-        # Sort by the sum of the start and end logits in ascending order,
-        # so that the first element is the most probable answer
-        prelim_predictions = sorted(
-            prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True
+    """
+    block_args = {
+        "tokenizer": tokenizer,
+        "n_best_size": n_best_size,
+        "n_top_start": n_top_start,
+        "n_top_end": n_top_end,
+        "max_answer_length": max_answer_length,
+        "verbose_logging": verbose_logging,
+    }
+    if num_workers > 1:
+        answers = _postprocess_parallel(
+            _postprocess_xlnet_block,
+            results,
+            examples_file,
+            features_file,
+            num_workers,
+            **block_args
+        )
+    else:
+        answers = postprocess_xlnet_answer_stream(
+            [results], examples_file=examples_file, features_file=features_file, **block_args
         )
+    return _write_answers(
+        answers,
+        unanswerable_exists,
+        output_prediction_file,
+        output_nbest_file,
+        output_null_log_odds_file,
+    )
 
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            f = features[pred.feature_index]
-            if pred.start_index > 0:  # this is a non-null prediction
-                tok_tokens = f["tokens"][pred.start_index : (pred.end_index + 1)]
-                orig_doc_start = f["token_to_orig_map"][str(pred.start_index)]
-                orig_doc_end = f["token_to_orig_map"][str(pred.end_index)]
-                orig_tokens = example["doc_tokens"][orig_doc_start : (orig_doc_end + 1)]
-                tok_text = " ".join(tok_tokens)
 
-                # De-tokenize WordPieces that have been split off.
-                tok_text = tok_text.replace(" ##", "")
-                tok_text = tok_text.replace("##", "")
+def postprocess_xlnet_answer_stream(
+    result_batches,
+    examples_file,
+    features_file,
+    tokenizer,
+    n_best_size=20,
+    n_top_start=5,
+    n_top_end=5,
+    max_answer_length=30,
+    verbose_logging=False,
+):
+    """
+    Postprocesses batches of start and end logits for XLNet as they are predicted, see
+    :func:`postprocess_xlnet_answer`.
 
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-
-                final_text = _get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
-                if final_text in seen_predictions:
-                    continue
-
-                seen_predictions[final_text] = True
-            else:
-                final_text = ""
-                seen_predictions[final_text] = True
-
-            nbest.append(
-                _NbestPrediction(
-                    text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit
-                )
-            )
-        # if we didn't include the empty option in the n-best, include it
-        if unanswerable_exists:
-            if "" not in seen_predictions:
-                nbest.append(
-                    _NbestPrediction(
-                        text="", start_logit=null_start_logit, end_logit=null_end_logit
-                    )
-                )
+    The answer of a question is yielded as soon as the results of all its features are
+    available, and only the results of the questions not yet answered are kept in memory.
 
-            # In very rare edge cases we could only have single null prediction.
-            # So we just create a nonce prediction in this case to avoid failure.
-            if len(nbest) == 1:
-                nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-
-        assert len(nbest) >= 1
-
-        total_scores = []
-        best_non_null_entry = None
-        for ie, entry in enumerate(nbest):
-            total_scores.append(entry.start_logit + entry.end_logit)
-            if not best_non_null_entry:
-                if entry.text:
-                    best_non_null_entry = entry
-                    best_non_null_entry_index = ie
-
-        probs = _compute_softmax(total_scores)
-
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            nbest_json.append(output)
+    Args:
+        result_batches (iterable): Iterable of :class:`QAPredictions` or of lists of
+            :class:`QAResultExtended`, e.g. the batches yielded by
+            :meth:`AnswerExtractor.predict_stream`.
+        examples_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`.
+        features_file (str): One of the stores cached by :meth:`QAProcessor.preprocess`.
+        tokenizer (XLNetTokenizer): Tokenizer used during data preprocessing.
+        n_best_size (int, optional): The maximum number of n-best answers of each question.
+            Defaults to 20.
+        n_top_start (int, optional): Beam size for span start. Defaults to 5.
+        n_top_end (int, optional): Beam size for span end. Defaults to 5.
+        max_answer_length (int, optional): Maximum length of the answer. Defaults to 30.
+        verbose_logging (bool, optional): Whether to log details of answer postprocessing.
+            Defaults to False.
 
-            if entry.text == "":
-                null_prediction_index = i
+    Yields:
+        :class:`QAAnswer`: Answers of the questions, in the order of the examples.
+    """
+    examples_all = QAExampleStore(examples_file)
+    features_all = QAFeatureStore(features_file)
 
-        assert len(nbest_json) >= 1
+    # Map unique features to the original doc-question-answer triplet
+    # Each doc-question-answer triplet can have multiple features because the doc
+    # could be split into multiple spans
+    example_features = features_all.example_features(len(examples_all))
 
-        if not unanswerable_exists:
-            all_predictions[example["qa_id"]] = nbest_json[0]["text"]
-            all_probs[example["qa_id"]] = nbest_json[0]["probability"]
-        else:
-            # predict "" iff the null score - the score of best non-null > threshold
-            score_diff = (
-                score_null - best_non_null_entry.start_logit - (best_non_null_entry.end_logit)
-            )
-            scores_diff_json[example["qa_id"]] = score_diff
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example["qa_id"]] = ""
-                ## TODO: double check this
-                all_probs[example["qa_id"]] = probs[null_prediction_index]
-            else:
-                all_predictions[example["qa_id"]] = best_non_null_entry.text
-                all_probs[example["qa_id"]] = probs[best_non_null_entry_index]
-        all_nbest_json[example["qa_id"]] = nbest_json
+    for example_start, example_end, block_predictions in _iter_result_blocks(
+        result_batches, features_all, example_features
+    ):
+        for answer in _postprocess_xlnet_block(
+            examples_all,
+            features_all,
+            example_features,
+            example_start,
+            example_end,
+            block_predictions,
+            tokenizer=tokenizer,
+            n_best_size=n_best_size,
+            n_top_start=n_top_start,
+            n_top_end=n_top_end,
+            max_answer_length=max_answer_length,
+            verbose_logging=verbose_logging,
+        ):
+            yield answer
+
+
+def _write_answers(
+    answers,
+    unanswerable_exists,
+    output_prediction_file,
+    output_nbest_file,
+    output_null_log_odds_file,
+):
+    """Collects a stream of :class:`QAAnswer` and writes them to the output files."""
+    all_predictions = collections.OrderedDict()
+    all_probs = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    scores_diff_json = collections.OrderedDict()
+    for answer in answers:
+        all_predictions[answer.qa_id] = answer.text
+        all_probs[answer.qa_id] = answer.probability
+        all_nbest_json[answer.qa_id] = answer.nbest
+        scores_diff_json[answer.qa_id] = answer.null_odds
 
     """Write final predictions to the json file and log-odds of null if needed."""
     logger.info("Writing predictions to: %s" % (output_prediction_file))
@@ -891,255 +1397,231 @@ def postprocess_bert_answer(
     return all_predictions, all_probs, all_nbest_json
 
 
-def postprocess_xlnet_answer(
-    results,
-    examples_file,
-    features_file,
-    tokenizer,
-    n_best_size=20,
-    n_top_start=5,
-    n_top_end=5,
-    max_answer_length=30,
-    unanswerable_exists=False,
-    output_prediction_file="./qa_predictions.json",
-    output_nbest_file="./nbest_predictions.json",
-    output_null_log_odds_file="./null_odds.json",
-    verbose_logging=False,
-):
+def _iter_result_blocks(result_batches, features_all, example_features):
     """
-    Postprocesses start and end logits generated by :meth:`AnswerExtractor.fit` for XLNet.
+    Groups batches of results into blocks of consecutive examples whose features all have a
+    result, as soon as the results are available.
 
     Args:
-        results (list): List of :class:`QAResultExtended`.
-        examples_file (str): One of the files cached by :meth:`QAProcessor.preprocess`. This file
-            contains the original document tokens that are used to generate the final answers
-            from the predicted start and end positions.
-        features_file (str): One of the files cached by :meth:`QAProcessor.preprocess`. This file
-            contains the mapping from indices in the processed token list to the original
-            document tokens that are used to generate the final predicted answers.
-        tokenizer (XLNetTokenizer): Tokenizer used during data preprocessing.
-        n_best_size (int, optional): The number of candidates to choose from each QAResult to
-            generate the final prediction. It's also the maximum number of n-best answers to
-            output for each question. Note that the number of n-best answers can be smaller than
-            `n_best_size` because some unqualified answers, e.g. answer that are too long,
-            are removed.
-        n_top_start (int, optional): Beam size for span start. Note that this needs to be
-            consistent with the XLNet model configuration. Defaults to 5.
-        n_top_end (int, optional): Beam size for span end. Note that this needs to be
-            consistent with the XLNet model configuration. Defaults to 5.
-        max_answer_length (int, optional): Maximum length of the answer. Defaults to 30.
-        unanswerable_exists (bool, optional): Whether there are unanswerable questions in the
-            data. If True, the start and end logits of the [CLS] token, which indicate the
-            probability of the answer being empty, are included in the candidate answer list.
-            Defaults to False.
-        output_prediction_file (str, optional): Path of the file to save the predicted answers.
-            Defaults to "./qa_predictions.json".
-        output_nbest_file (str, optional): Path of the file to save the n-best answers. Defaults
-            to "./nbest_predictions.json".
-        output_null_log_odds_file (str, optional): If unanswerable_exists is True, the score
-            difference between empty prediction and best non-empty prediction are saved to this
-            file. These scores can be used to find the best threshold for predicting an empty
-            answer. Defaults to "./null_odds.json".
-        verbose_logging (bool, optional): Whether to log details of answer postprocessing.
-            Defaults to False.
-
-    Returns:
-        tuple: (OrderedDict, OrderedDict, OrderedDict)
-            The keys of the dictionaries are the `qa_id` in the original
-            :class:`utils_nlp.dataset.pytorch.QADataset`
-            The values of the first dictionary are the predicted answer texts in string type.
-            The values of the second dictionary are the softmax probabilities of the predicted
-            answers.
-            The values of the third dictionary are the n-best answers for each qa_id. Note that
-            the number of n-best answers can be smaller than `n_best_size` because some
-            unqualified answers, e.g. answers that are too long, are removed.
-
+        result_batches (iterable): Iterable of :class:`QAPredictions` or of lists of
+            :class:`QAResult` or :class:`QAResultExtended`, in any order.
+        features_all (QAFeatureStore): Store of the features.
+        example_features (numpy.ndarray): Ranges of the features of each example, as returned
+            by :meth:`QAFeatureStore.example_features`.
+
+    Yields:
+        tuple: (example_start, example_end, predictions), the range of the examples of a block
+            and the :class:`QAPredictions` of their features, in the order of the features.
     """
-    with jsonlines.open(examples_file) as reader:
-        examples_all = list(reader.iter())
-
-    with jsonlines.open(features_file) as reader:
-        features_all = list(reader.iter())
-
-    qa_id_to_features = collections.defaultdict(list)
-    # Map unique features to the original doc-question-answer triplet
-    # Each doc-question-answer triplet can have multiple features because the doc
-    # could be split into multiple spans
-    for f in features_all:
-        qa_id_to_features[f["qa_id"]].append(f)
-
-    unique_id_to_result = {}
-    for r in results:
-        unique_id_to_result[r.unique_id] = r
-
-    all_predictions = collections.OrderedDict()
-    all_probs = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
-
-    for example in examples_all:
-        features = qa_id_to_features[example["qa_id"]]
-
-        prelim_predictions = []
-        # keep track of the minimum score of null start+end of position 0
-        score_null = 1000000  # large and positive
-
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature["unique_id"]]
-
-            cur_null_score = result.cls_logits
-
-            # if we could have irrelevant answers, get the min score of irrelevant
-            score_null = min(score_null, cur_null_score)
-
-            for i in range(n_top_start):
-                for j in range(n_top_end):
-                    start_log_prob = result.start_top_log_probs[i]
-                    start_index = result.start_top_index[i]
-
-                    j_index = i * n_top_end + j
-
-                    end_log_prob = result.end_top_log_probs[j_index]
-                    end_index = result.end_top_index[j_index]
-
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= feature["paragraph_len"] - 1:
-                        continue
-                    if end_index >= feature["paragraph_len"] - 1:
-                        continue
-
-                    if not feature["token_is_max_context"].get(str(start_index), False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=start_log_prob,
-                            end_logit=end_log_prob,
-                        )
-                    )
-
-        prelim_predictions = sorted(
-            prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True
+    num_examples = len(example_features) - 1
+    pending = None
+    next_example = 0
+    for results in result_batches:
+        results = QAPredictions.from_results(results)
+        pending = results if pending is None else QAPredictions.concatenate([pending, results])
+        pending_ids = set(pending.unique_ids.tolist())
+
+        consumed_rows = []
+        while next_example < num_examples:
+            example_end = next_example
+            while (
+                example_end < num_examples
+                and example_end - next_example < _POSTPROCESSING_BLOCK_SIZE
+                and all(
+                    unique_id in pending_ids
+                    for unique_id in features_all.unique_ids[
+                        example_features[example_end] : example_features[example_end + 1]
+                    ].tolist()
+                )
+            ):
+                example_end += 1
+            if example_end == next_example:
+                break
+            rows = pending.index_of(
+                features_all.unique_ids[
+                    example_features[next_example] : example_features[example_end]
+                ]
+            )
+            consumed_rows.append(rows)
+            yield next_example, example_end, pending.take(rows)
+            next_example = example_end
+
+        # only the results of the examples not yet answered are kept
+        if consumed_rows:
+            is_pending = np.ones(len(pending), dtype=bool)
+            is_pending[np.concatenate(consumed_rows)] = False
+            pending = pending.take(np.nonzero(is_pending)[0])
+
+    if next_example < num_examples:
+        raise ValueError(
+            "Missing results for the features of {} examples.".format(num_examples - next_example)
         )
 
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            feature = features[pred.feature_index]
 
-            # XLNet un-tokenizer
-            # Let's keep it simple for now and see if we need all this later.
-            #
-            # tok_start_to_orig_index = feature.tok_start_to_orig_index
-            # tok_end_to_orig_index = feature.tok_end_to_orig_index
-            # start_orig_pos = tok_start_to_orig_index[pred.start_index]
-            # end_orig_pos = tok_end_to_orig_index[pred.end_index]
-            # paragraph_text = example.paragraph_text
-            # final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
-
-            # Previously used Bert untokenizer
-            tok_tokens = feature["tokens"][pred.start_index : (pred.end_index + 1)]
-            orig_doc_start = feature["token_to_orig_map"][str(pred.start_index)]
-            orig_doc_end = feature["token_to_orig_map"][str(pred.end_index)]
-            orig_tokens = example["doc_tokens"][orig_doc_start : (orig_doc_end + 1)]
-            tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
+def _init_postprocess_worker(
+    postprocess_block, predictions_dir, examples_file, features_file, block_args
+):
+    examples_all = QAExampleStore(examples_file)
+    features_all = QAFeatureStore(features_file)
+    _WORKER.update(
+        {
+            "postprocess_block": postprocess_block,
+            "predictions": QAPredictions.load(predictions_dir),
+            "examples_all": examples_all,
+            "features_all": features_all,
+            "example_features": features_all.example_features(len(examples_all)),
+            "block_args": block_args,
+        }
+    )
 
-            # Clean whitespace
-            tok_text = tok_text.strip()
-            tok_text = " ".join(tok_text.split())
-            orig_text = " ".join(orig_tokens)
 
-            final_text = _get_final_text(
-                tok_text, orig_text, tokenizer.do_lower_case, verbose_logging
-            )
+def _postprocess_chunk_worker(bounds):
+    features_all = _WORKER["features_all"]
+    example_features = _WORKER["example_features"]
+    predictions = _WORKER["predictions"]
+    answers = []
+    for block_start in range(bounds[0], bounds[1], _POSTPROCESSING_BLOCK_SIZE):
+        block_end = min(block_start + _POSTPROCESSING_BLOCK_SIZE, bounds[1])
+        rows = predictions.index_of(
+            features_all.unique_ids[example_features[block_start] : example_features[block_end]]
+        )
+        answers += _WORKER["postprocess_block"](
+            _WORKER["examples_all"],
+            features_all,
+            example_features,
+            block_start,
+            block_end,
+            predictions.take(rows),
+            **_WORKER["block_args"]
+        )
+    return answers
 
-            if final_text in seen_predictions:
-                continue
 
-            seen_predictions[final_text] = True
+def _postprocess_parallel(
+    postprocess_block, results, examples_file, features_file, num_workers, **block_args
+):
+    """
+    Postprocesses chunks of consecutive examples in worker processes with `postprocess_block`,
+    e.g. :func:`_postprocess_bert_block`, and yields their :class:`QAAnswer`.
 
-            nbest.append(
-                _NbestPrediction(
-                    text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit
-                )
-            )
+    The predictions are saved to memory-mapped arrays which the workers share, as they share the
+    stores of the examples and features, and the answers of the chunks are merged in the order
+    of the examples, so that they don't depend on the number of workers.
+    """
+    num_examples = len(QAExampleStore(examples_file))
+    chunk_size = max(1, int(math.ceil(num_examples / (num_workers * _CHUNKS_PER_WORKER))))
+    chunks = [
+        (start, min(start + chunk_size, num_examples))
+        for start in range(0, num_examples, chunk_size)
+    ]
+    logger.info(
+        "Postprocessing {0} examples in {1} chunks with {2} workers".format(
+            num_examples, len(chunks), num_workers
+        )
+    )
 
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(_NbestPrediction(text="", start_logit=-1e6, end_logit=-1e6))
+    with tempfile.TemporaryDirectory() as predictions_dir:
+        QAPredictions.from_results(results).save(predictions_dir)
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(
+            min(num_workers, max(len(chunks), 1)),
+            initializer=_init_postprocess_worker,
+            initargs=(postprocess_block, predictions_dir, examples_file, features_file, block_args),
+        ) as pool:
+            for answers in pool.imap(_postprocess_chunk_worker, chunks):
+                for answer in answers:
+                    yield answer
 
-        total_scores = []
-        best_non_null_entry = None
-        for ie, entry in enumerate(nbest):
-            total_scores.append(entry.start_logit + entry.end_logit)
-            if not best_non_null_entry:
-                best_non_null_entry = entry
-                best_non_null_entry_index = ie
 
-        probs = _compute_softmax(total_scores)
+# -------------------------------------------------------------------------------------------------
+# Preprocessing helper functions
+def _is_iterable_but_not_string(obj):
+    """Check whether obj is a non-string Iterable."""
+    return isinstance(obj, collections.Iterable) and not isinstance(obj, str)
 
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            nbest_json.append(output)
 
-        assert len(nbest_json) >= 1
-        assert best_non_null_entry is not None
+# _QADocument is the tokenization of a document, shared by its questions.
+# Args:
+#     doc_tokens (list): White-space tokenized tokens of the document text.
+#     char_to_word_offset (list): Index in doc_tokens of each character of the document text.
+#     all_doc_tokens (list): Tokens of the document after tokenization of doc_tokens.
+#     tok_to_orig_index (list): Index in doc_tokens of each token of all_doc_tokens.
+#     orig_to_tok_index (list): Index in all_doc_tokens of the first token of each doc_tokens.
+_QADocument = collections.namedtuple(
+    "_QADocument",
+    [
+        "doc_tokens",
+        "char_to_word_offset",
+        "all_doc_tokens",
+        "tok_to_orig_index",
+        "orig_to_tok_index",
+    ],
+)
 
-        score_diff = score_null
-        scores_diff_json[example["qa_id"]] = score_diff
-        # note(zhiliny): always predict best_non_null_entry
-        # and the evaluation script will search for the best threshold
-        all_predictions[example["qa_id"]] = best_non_null_entry.text
 
-        all_probs[example["qa_id"]] = probs[best_non_null_entry_index]
+_DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
 
-        all_nbest_json[example["qa_id"]] = nbest_json
 
-    """Write final predictions to the json file and log-odds of null if needed."""
-    logger.info("Writing predictions to: %s" % (output_prediction_file))
-    logger.info("Writing nbest to: %s" % (output_nbest_file))
+def _split_doc_text(d_text):
+    """Splits a document text on white spaces and maps its characters to the tokens."""
 
-    with open(output_prediction_file, "w") as writer:
-        writer.write(json.dumps(all_predictions, indent=4) + "\n")
+    def _is_whitespace(c):
+        if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
+            return True
+        return False
 
-    with open(output_nbest_file, "w") as writer:
-        writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
+    d_tokens = []
+    char_to_word_offset = []
+    prev_is_whitespace = True
+    for c in d_text:
+        if _is_whitespace(c):
+            prev_is_whitespace = True
+        else:
+            if prev_is_whitespace:
+                d_tokens.append(c)
+            else:
+                d_tokens[-1] += c
+            prev_is_whitespace = False
+        char_to_word_offset.append(len(d_tokens) - 1)
+    return d_tokens, char_to_word_offset
 
-    if unanswerable_exists:
-        logger.info("Writing null odds to: %s" % (output_null_log_odds_file))
-        with open(output_null_log_odds_file, "w") as writer:
-            writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
 
-    return all_predictions, all_probs, all_nbest_json
+def _tokenize_doc_tokens(doc_tokens, tokenize_func):
+    """Tokenizes white-space tokenized document tokens and maps the tokens to each other."""
+    # map word-piece tokens to original tokens
+    tok_to_orig_index = []
+    # map original tokens to corresponding word-piece tokens
+    orig_to_tok_index = []
+    all_doc_tokens = []
+    for (i, token) in enumerate(doc_tokens):
+        orig_to_tok_index.append(len(all_doc_tokens))
+        sub_tokens = tokenize_func(token)
+        for sub_token in sub_tokens:
+            tok_to_orig_index.append(i)
+            all_doc_tokens.append(sub_token)
+    return all_doc_tokens, tok_to_orig_index, orig_to_tok_index
 
 
-# -------------------------------------------------------------------------------------------------
-# Preprocessing helper functions
-def _is_iterable_but_not_string(obj):
-    """Check whether obj is a non-string Iterable."""
-    return isinstance(obj, collections.Iterable) and not isinstance(obj, str)
+def _create_qa_document(doc_text, tokenize_func):
+    """Tokenizes a document once for all its questions."""
+    doc_tokens, char_to_word_offset = _split_doc_text(doc_text)
+    all_doc_tokens, tok_to_orig_index, orig_to_tok_index = _tokenize_doc_tokens(
+        doc_tokens, tokenize_func
+    )
+    return _QADocument(
+        doc_tokens=doc_tokens,
+        char_to_word_offset=char_to_word_offset,
+        all_doc_tokens=all_doc_tokens,
+        tok_to_orig_index=tok_to_orig_index,
+        orig_to_tok_index=orig_to_tok_index,
+    )
 
 
-def _create_qa_example(qa_input, is_training):
-    """ Initial preprocessing to create _QAExample for feature extraction. """
+def _create_qa_example(qa_input, is_training, document=None):
+    """
+    Initial preprocessing to create _QAExample for feature extraction. The white-space
+    tokenization of `document`, a _QADocument of the document text, is used if provided.
+    """
 
     # _QAExample is a data structure representing an unique document-question-answer triplet.
     # Args:
@@ -1171,11 +1653,6 @@ def _create_qa_example(qa_input, is_training):
         ],
     )
 
-    def _is_whitespace(c):
-        if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
-            return True
-        return False
-
     d_text = qa_input.doc_text
     q_text = qa_input.question_text
     a_start = qa_input.answer_start
@@ -1183,19 +1660,11 @@ def _create_qa_example(qa_input, is_training):
     q_id = qa_input.qa_id
     impossible = qa_input.is_impossible
 
-    d_tokens = []
-    char_to_word_offset = []
-    prev_is_whitespace = True
-    for c in d_text:
-        if _is_whitespace(c):
-            prev_is_whitespace = True
-        else:
-            if prev_is_whitespace:
-                d_tokens.append(c)
-            else:
-                d_tokens[-1] += c
-            prev_is_whitespace = False
-        char_to_word_offset.append(len(d_tokens) - 1)
+    if document is None:
+        d_tokens, char_to_word_offset = _split_doc_text(d_text)
+    else:
+        d_tokens = document.doc_tokens
+        char_to_word_offset = document.char_to_word_offset
 
     if _is_iterable_but_not_string(a_start):
         if not _is_iterable_but_not_string(a_text):
@@ -1250,8 +1719,15 @@ def _create_qa_features(
     max_seq_length,
     doc_stride,
     custom_tokenize=None,
+    document=None,
+    doc_spans_cache=None,
 ):
-    """Extracts features for model training and scoring from document-question-answer triplet."""
+    """
+    Extracts features for model training and scoring from document-question-answer triplet.
+    The tokenization of `document`, a _QADocument of the document text, is used if provided.
+    `doc_spans_cache` is an optional dictionary in which the span windows of the document and
+    their maximum context flags are kept for the other questions of the document.
+    """
 
     # _QAFeatures is data structure representing features of an unique document
     # span-question-answer triplet.
@@ -1417,17 +1893,14 @@ def _create_qa_features(
 
     if len(query_tokens) > max_question_length:
         query_tokens = query_tokens[0:max_question_length]
-    # map word-piece tokens to original tokens
-    tok_to_orig_index = []
-    # map original tokens to corresponding word-piece tokens
-    orig_to_tok_index = []
-    all_doc_tokens = []
-    for (i, token) in enumerate(example.doc_tokens):
-        orig_to_tok_index.append(len(all_doc_tokens))
-        sub_tokens = tokenize_func(token)
-        for sub_token in sub_tokens:
-            tok_to_orig_index.append(i)
-            all_doc_tokens.append(sub_token)
+    if document is None:
+        all_doc_tokens, tok_to_orig_index, orig_to_tok_index = _tokenize_doc_tokens(
+            example.doc_tokens, tokenize_func
+        )
+    else:
+        all_doc_tokens = document.all_doc_tokens
+        tok_to_orig_index = document.tok_to_orig_index
+        orig_to_tok_index = document.orig_to_tok_index
 
     tok_start_position = None
     tok_end_position = None
@@ -1455,17 +1928,24 @@ def _create_qa_features(
     # We can have documents that are longer than the maximum sequence length.
     # To deal with this we do a sliding window approach, where we take chunks
     # of the up to our max length with a stride of `doc_stride`.
-    _DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
-    doc_spans = []
-    start_offset = 0
-    while start_offset < len(all_doc_tokens):
-        length = len(all_doc_tokens) - start_offset
-        if length > max_tokens_for_doc:
-            length = max_tokens_for_doc
-        doc_spans.append(_DocSpan(start=start_offset, length=length))
-        if start_offset + length == len(all_doc_tokens):
-            break
-        start_offset += min(length, doc_stride)
+    # The windows only depend on the question through its length, questions of the same
+    # length share the windows and the max context flags of their document.
+    if doc_spans_cache is None:
+        doc_spans_cache = {}
+    if max_tokens_for_doc not in doc_spans_cache:
+        doc_spans = []
+        start_offset = 0
+        while start_offset < len(all_doc_tokens):
+            length = len(all_doc_tokens) - start_offset
+            if length > max_tokens_for_doc:
+                length = max_tokens_for_doc
+            doc_spans.append(_DocSpan(start=start_offset, length=length))
+            if start_offset + length == len(all_doc_tokens):
+                break
+            start_offset += min(length, doc_stride)
+        # max context flags of the tokens of each span, computed when the span is used
+        doc_spans_cache[max_tokens_for_doc] = (doc_spans, {})
+    doc_spans, span_is_max_context = doc_spans_cache[max_tokens_for_doc]
 
     for (doc_span_index, doc_span) in enumerate(doc_spans):
         if is_training:
@@ -1505,14 +1985,16 @@ def _create_qa_features(
             p_mask.append(1)
 
         # Paragraph
+        if doc_span_index not in span_is_max_context:
+            span_is_max_context[doc_span_index] = [
+                _check_is_max_context(doc_spans, doc_span_index, doc_span.start + i)
+                for i in range(doc_span.length)
+            ]
+        is_max_context = span_is_max_context[doc_span_index]
         for i in range(doc_span.length):
             split_token_index = doc_span.start + i
             token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
-
-            ## TODO: maybe this can be improved to compute
-            # is_max_context for each token only once.
-            is_max_context = _check_is_max_context(doc_spans, doc_span_index, split_token_index)
-            token_is_max_context[len(tokens)] = is_max_context
+            token_is_max_context[len(tokens)] = is_max_context[i]
             tokens.append(all_doc_tokens[split_token_index])
             if model_type == "xlnet":
                 segment_ids.append(sequence_a_segment_id)
@@ -1609,7 +2091,225 @@ def _create_qa_features(
             )
         )
 
-        return qa_features
+        return qa_features
+
+
+def _featurize_chunk(
+    qa_inputs, unique_id=UNIQUE_ID_START, documents=None, return_documents=False, **featurize_args
+):
+    """
+    Creates the examples, as saved to the examples store, and the features, as dictionaries
+    with the "example_index" of their example, of a sequence of QAInput. The unique ids of the
+    features follow `unique_id`, in the order of the inputs.
+
+    The questions are grouped by document, which is tokenized once, and the span windows of a
+    document are shared by its questions of the same length.
+
+    `documents` is an optional list of _QADocument of the inputs, or None for the documents to
+    tokenize. If `return_documents` is True, the _QADocument of all inputs are returned too.
+    """
+    if featurize_args["custom_tokenize"]:
+        tokenize_func = featurize_args["custom_tokenize"]
+    else:
+        tokenize_func = featurize_args["tokenizer"].tokenize
+    is_training = featurize_args["is_training"]
+
+    qa_inputs = list(qa_inputs)
+    # questions sharing a document are featurized together, with one tokenization of the
+    # document and one computation of its span windows
+    doc_questions = collections.OrderedDict()
+    for i, qa_input in enumerate(qa_inputs):
+        doc_questions.setdefault(qa_input.doc_text, []).append(i)
+
+    qa_examples = [None] * len(qa_inputs)
+    example_features = [None] * len(qa_inputs)
+    qa_documents = [None] * len(qa_inputs)
+    for doc_text, indices in doc_questions.items():
+        document = documents[indices[0]] if documents is not None else None
+        if document is None:
+            document = _create_qa_document(doc_text, tokenize_func)
+        doc_spans_cache = {}
+        for i in indices:
+            qa_example_cur = _create_qa_example(
+                qa_inputs[i], is_training=is_training, document=document
+            )
+            qa_examples[i] = {
+                "qa_id": qa_example_cur.qa_id,
+                "doc_tokens": qa_example_cur.doc_tokens,
+            }
+            example_features[i] = _create_qa_features(
+                qa_example_cur,
+                unique_id=UNIQUE_ID_START,
+                document=document,
+                doc_spans_cache=doc_spans_cache,
+                **featurize_args
+            )
+            if return_documents:
+                qa_documents[i] = document
+
+    # the unique ids are incremented for each feature in the order of the inputs
+    unique_id_step = 1 if is_training else 2
+    features = []
+    for example_index, features_cur in enumerate(example_features):
+        # the namedtuple of the features is local to _create_qa_features and can't be pickled
+        for f in features_cur:
+            features.append(
+                dict(
+                    f._asdict(),
+                    unique_id=unique_id + (len(features) + 1) * unique_id_step,
+                    example_index=example_index,
+                )
+            )
+    if return_documents:
+        return qa_examples, features, qa_documents
+    return qa_examples, features
+
+
+def _init_preprocess_worker(qa_dataset, featurize_args, documents, return_documents):
+    _WORKER.update(
+        {
+            "qa_dataset": qa_dataset,
+            "featurize_args": featurize_args,
+            "documents": documents,
+            "return_documents": return_documents,
+        }
+    )
+
+
+def _featurize_chunk_worker(bounds):
+    qa_dataset = _WORKER["qa_dataset"]
+    qa_inputs = [qa_dataset[i] for i in range(*bounds)]
+    documents = _WORKER["documents"]
+    return _featurize_chunk(
+        qa_inputs,
+        documents=documents[bounds[0] : bounds[1]] if documents is not None else None,
+        return_documents=_WORKER["return_documents"],
+        **_WORKER["featurize_args"]
+    )
+
+
+def _featurize_parallel(
+    qa_dataset, featurize_args, num_workers, documents=None, return_documents=False
+):
+    """
+    Creates the examples and features of chunks of `qa_dataset` in worker processes.
+
+    Each chunk numbers its features from UNIQUE_ID_START and its examples from 0, and the ids
+    and example indices are shifted when the chunks are merged in order, so that they continue
+    the ones of the previous chunks exactly as the serial loop does.
+    """
+    num_rows = len(qa_dataset)
+    chunk_size = int(math.ceil(num_rows / (num_workers * _CHUNKS_PER_WORKER)))
+    chunks = [
+        (start, min(start + chunk_size, num_rows)) for start in range(0, num_rows, chunk_size)
+    ]
+    logger.info(
+        "Preprocessing {0} rows in {1} chunks with {2} workers".format(
+            num_rows, len(chunks), num_workers
+        )
+    )
+
+    qa_examples = []
+    features = []
+    qa_documents = []
+    unique_id = UNIQUE_ID_START
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(
+        min(num_workers, len(chunks)),
+        initializer=_init_preprocess_worker,
+        initargs=(qa_dataset, featurize_args, documents, return_documents),
+    ) as pool:
+        for chunk_outputs in pool.imap(_featurize_chunk_worker, chunks):
+            chunk_examples, chunk_features = chunk_outputs[:2]
+            offset = unique_id - UNIQUE_ID_START
+            for f in chunk_features:
+                f["unique_id"] += offset
+                f["example_index"] += len(qa_examples)
+            if chunk_features:
+                unique_id = chunk_features[-1]["unique_id"]
+            qa_examples += chunk_examples
+            features += chunk_features
+            if return_documents:
+                qa_documents += chunk_outputs[2]
+    if return_documents:
+        return qa_examples, features, qa_documents
+    return qa_examples, features
+
+
+def _featurize_with_cache(qa_dataset, featurize_args, num_workers, cache):
+    """
+    Creates the examples and features of `qa_dataset` with a
+    :class:`utils_nlp.models.transformers.qa_preprocessing_cache.QAPreprocessingCache`.
+
+    The documents and questions found in the cache are not processed again, and the new ones
+    are featurized, with the cached document tokenization if available, and added to the cache.
+    The unique ids are the ones of the serial loop, which increments them for each feature.
+    """
+    qa_inputs = [qa_dataset[i] for i in range(len(qa_dataset))]
+    # decoded documents, shared by their questions
+    documents = {}
+    cached_features = []
+    for qa_input in qa_inputs:
+        if qa_input.doc_text not in documents:
+            documents[qa_input.doc_text] = cache.get_document(qa_input.doc_text)
+        if documents[qa_input.doc_text] is None:
+            cached_features.append(None)
+        else:
+            cached_features.append(cache.get_features(qa_input))
+
+    misses = [i for i, f in enumerate(cached_features) if f is None]
+    logger.info(
+        "{0} of {1} questions found in the preprocessing cache, {2} of {3} documents".format(
+            len(qa_inputs) - len(misses),
+            len(qa_inputs),
+            sum(d is not None for d in documents.values()),
+            len(documents),
+        )
+    )
+    if misses:
+        miss_inputs = [qa_inputs[i] for i in misses]
+        miss_documents = [documents[qa_input.doc_text] for qa_input in miss_inputs]
+        if num_workers > 1 and len(misses) > 1:
+            _, miss_features, miss_documents = _featurize_parallel(
+                miss_inputs,
+                featurize_args,
+                num_workers,
+                documents=miss_documents,
+                return_documents=True,
+            )
+        else:
+            _, miss_features, miss_documents = _featurize_chunk(
+                miss_inputs, documents=miss_documents, return_documents=True, **featurize_args
+            )
+        for i in misses:
+            cached_features[i] = []
+        for f in miss_features:
+            cached_features[misses[f["example_index"]]].append(f)
+        for qa_input, document in zip(miss_inputs, miss_documents):
+            if documents[qa_input.doc_text] is None:
+                documents[qa_input.doc_text] = document
+                cache.put_document(qa_input.doc_text, document)
+        for i in misses:
+            cache.put_features(qa_inputs[i], cached_features[i])
+        cache.commit()
+
+    unique_id_step = 1 if featurize_args["is_training"] else 2
+    qa_examples = []
+    features = []
+    for example_index, qa_input in enumerate(qa_inputs):
+        qa_examples.append(
+            {"qa_id": qa_input.qa_id, "doc_tokens": documents[qa_input.doc_text].doc_tokens}
+        )
+        for f in cached_features[example_index]:
+            features.append(
+                dict(
+                    f,
+                    qa_id=qa_input.qa_id,
+                    unique_id=UNIQUE_ID_START + (len(features) + 1) * unique_id_step,
+                    example_index=example_index,
+                )
+            )
+    return qa_examples, features
 
 
 # Preprocessing helper functions end
@@ -1623,6 +2323,17 @@ _PrelimPrediction = collections.namedtuple(
 _NbestPrediction = collections.namedtuple("NbestPrediction", ["text", "start_logit", "end_logit"])
 
 
+@functools.lru_cache(maxsize=None)
+def _get_basic_tokenizer(do_lower_case):
+    return BasicTokenizer(do_lower_case=do_lower_case)
+
+
+# the n-best answers of a question often span the same original tokens
+@functools.lru_cache(maxsize=_BASIC_TOKENIZE_CACHE_SIZE)
+def _basic_tokenize(text, do_lower_case):
+    return " ".join(_get_basic_tokenizer(do_lower_case).tokenize(text))
+
+
 def _get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
     """Project the tokenized prediction back to the original text."""
 
@@ -1666,9 +2377,7 @@ def _get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
     # and `pred_text`, and check if they are the same length. If they are
     # NOT the same length, the heuristic has failed. If they are the same
     # length, we assume the characters are one-to-one aligned.
-    tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-
-    tok_text = " ".join(tokenizer.tokenize(orig_text))
+    tok_text = _basic_tokenize(orig_text, do_lower_case)
 
     start_position = tok_text.find(pred_text)
     if start_position == -1:
@@ -1719,39 +2428,482 @@ def _get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
     return output_text
 
 
-def _get_best_indexes(logits, n_best_size):
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
+def _postprocess_bert_block(
+    examples_all,
+    features_all,
+    example_features,
+    example_start,
+    example_end,
+    block_predictions,
+    do_lower_case,
+    unanswerable_exists,
+    n_best_size,
+    max_answer_length,
+    null_score_diff_threshold,
+    verbose_logging,
+):
+    """
+    Yields the :class:`QAAnswer` of a block of consecutive examples for BERT, given the
+    :class:`QAPredictions` of their features, see :func:`postprocess_bert_answer_stream`.
+    """
+    # the candidate answer spans of the features of the block are searched at once
+    feature_start = example_features[example_start]
+    start_logits = block_predictions.arrays["start_logits"].astype(np.float64)
+    end_logits = block_predictions.arrays["end_logits"].astype(np.float64)
+    candidates = _get_bert_candidates(
+        features_all, feature_start, start_logits, end_logits, n_best_size, max_answer_length
+    )
+    # The first element of the start end end logits is the
+    # probability of predicting the [CLS] token as the start and
+    # end positions of the answer, which means the answer is
+    # empty.
+    null_scores = start_logits[:, 0] + end_logits[:, 0]
+
+    for example_index in range(example_start, example_end):
+        qa_id = examples_all.qa_id(example_index)
+        # get all the features belonging to the same example,
+        # i.e. paragaraph/question pair, relative to the block.
+        features_start = example_features[example_index] - feature_start
+        features_end = example_features[example_index + 1] - feature_start
+        lo, hi = np.searchsorted(candidates[0], [features_start, features_end])
+        feature_indexes, start_indexes, end_indexes, start_logits_cur, end_logits_cur = (
+            c[lo:hi] for c in candidates
+        )
+
+        # keep track of the minimum score of null start+end of position 0
+        score_null = 1000000  # large and positive
+
+        min_null_feature_index = 0  # the paragraph slice with min null score
+        null_start_logit = 0  # the start logit at the slice with min null score
+        null_end_logit = 0  # the end logit at the slice with min null score
+        # if we could have irrelevant answers, get the min score of irrelevant
+        if unanswerable_exists:
+            if features_end > features_start:
+                feature_index = features_start + int(
+                    np.argmin(null_scores[features_start:features_end])
+                )
+                if null_scores[feature_index] < score_null:
+                    score_null = float(null_scores[feature_index])
+                    min_null_feature_index = feature_index
+                    null_start_logit = float(start_logits[feature_index, 0])
+                    null_end_logit = float(end_logits[feature_index, 0])
+            feature_indexes = np.append(feature_indexes, min_null_feature_index)
+            start_indexes = np.append(start_indexes, 0)
+            end_indexes = np.append(end_indexes, 0)
+            start_logits_cur = np.append(start_logits_cur, null_start_logit)
+            end_logits_cur = np.append(end_logits_cur, null_end_logit)
+
+        # Sort by the sum of the start and end logits in descending order,
+        # so that the first element is the most probable answer
+        order = np.argsort(-(start_logits_cur + end_logits_cur), kind="stable")
+
+        seen_predictions = {}
+        nbest = []
+        for i in order:
+            if len(nbest) >= n_best_size:
+                break
+            pred = _PrelimPrediction(
+                feature_index=int(feature_indexes[i]),
+                start_index=int(start_indexes[i]),
+                end_index=int(end_indexes[i]),
+                start_logit=float(start_logits_cur[i]),
+                end_logit=float(end_logits_cur[i]),
+            )
+            if pred.start_index > 0:  # this is a non-null prediction
+                f = features_all[feature_start + pred.feature_index]
+                tok_tokens = f.tokens(pred.start_index, pred.end_index + 1)
+                orig_doc_start = f.orig_index(pred.start_index)
+                orig_doc_end = f.orig_index(pred.end_index)
+                orig_tokens = examples_all.doc_tokens(
+                    example_index, orig_doc_start, orig_doc_end + 1
+                )
+                tok_text = " ".join(tok_tokens)
+
+                # De-tokenize WordPieces that have been split off.
+                tok_text = tok_text.replace(" ##", "")
+                tok_text = tok_text.replace("##", "")
+
+                # Clean whitespace
+                tok_text = tok_text.strip()
+                tok_text = " ".join(tok_text.split())
+                orig_text = " ".join(orig_tokens)
+
+                final_text = _get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
+                if final_text in seen_predictions:
+                    continue
+
+                seen_predictions[final_text] = True
+            else:
+                final_text = ""
+                seen_predictions[final_text] = True
+
+            nbest.append(
+                _NbestPrediction(
+                    text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit
+                )
+            )
+        # if we didn't include the empty option in the n-best, include it
+        if unanswerable_exists:
+            if "" not in seen_predictions:
+                nbest.append(
+                    _NbestPrediction(
+                        text="", start_logit=null_start_logit, end_logit=null_end_logit
+                    )
+                )
+
+            # In very rare edge cases we could only have single null prediction.
+            # So we just create a nonce prediction in this case to avoid failure.
+            if len(nbest) == 1:
+                nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+
+        # In very rare edge cases we could have no valid predictions. So we
+        # just create a nonce prediction in this case to avoid failure.
+        if not nbest:
+            nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+
+        assert len(nbest) >= 1
+
+        total_scores = []
+        best_non_null_entry = None
+        for ie, entry in enumerate(nbest):
+            total_scores.append(entry.start_logit + entry.end_logit)
+            if not best_non_null_entry:
+                if entry.text:
+                    best_non_null_entry = entry
+                    best_non_null_entry_index = ie
+
+        probs = _compute_softmax(total_scores)
+
+        nbest_json = []
+        for (i, entry) in enumerate(nbest):
+            output = collections.OrderedDict()
+            output["text"] = entry.text
+            output["probability"] = probs[i]
+            output["start_logit"] = entry.start_logit
+            output["end_logit"] = entry.end_logit
+            nbest_json.append(output)
+
+            if entry.text == "":
+                null_prediction_index = i
+
+        assert len(nbest_json) >= 1
+
+        if not unanswerable_exists:
+            yield QAAnswer(
+                qa_id=qa_id,
+                text=nbest_json[0]["text"],
+                probability=nbest_json[0]["probability"],
+                nbest=nbest_json,
+                null_odds=None,
+            )
+        else:
+            # predict "" iff the null score - the score of best non-null > threshold
+            score_diff = (
+                score_null - best_non_null_entry.start_logit - (best_non_null_entry.end_logit)
+            )
+            if score_diff > null_score_diff_threshold:
+                ## TODO: double check this
+                yield QAAnswer(
+                    qa_id=qa_id,
+                    text="",
+                    probability=probs[null_prediction_index],
+                    nbest=nbest_json,
+                    null_odds=score_diff,
+                )
+            else:
+                yield QAAnswer(
+                    qa_id=qa_id,
+                    text=best_non_null_entry.text,
+                    probability=probs[best_non_null_entry_index],
+                    nbest=nbest_json,
+                    null_odds=score_diff,
+                )
+
+
+def _postprocess_xlnet_block(
+    examples_all,
+    features_all,
+    example_features,
+    example_start,
+    example_end,
+    block_predictions,
+    tokenizer,
+    n_best_size,
+    n_top_start,
+    n_top_end,
+    max_answer_length,
+    verbose_logging,
+):
+    """
+    Yields the :class:`QAAnswer` of a block of consecutive examples for XLNet, given the
+    :class:`QAPredictions` of their features, see :func:`postprocess_xlnet_answer_stream`.
+    """
+    # the candidate answer spans of the features of the block are searched at once
+    feature_start = example_features[example_start]
+    arrays = block_predictions.arrays
+    # the end positions are ordered by start position, at most the beams stored are used
+    stored_n_top_start = arrays["start_top_index"].shape[1]
+    stored_n_top_end = arrays["end_top_index"].shape[1] // max(stored_n_top_start, 1)
+    end_shape = (-1, stored_n_top_start, stored_n_top_end)
+    end_slice = (slice(None), slice(0, n_top_start), slice(0, n_top_end))
+    candidates = _get_xlnet_candidates(
+        features_all,
+        feature_start,
+        arrays["start_top_log_probs"][:, :n_top_start].astype(np.float64),
+        arrays["start_top_index"][:, :n_top_start].astype(np.int64),
+        arrays["end_top_log_probs"].reshape(end_shape)[end_slice].astype(np.float64),
+        arrays["end_top_index"].reshape(end_shape)[end_slice].astype(np.int64),
+        max_answer_length,
+    )
+    cls_logits = arrays["cls_logits"].astype(np.float64)
+
+    for example_index in range(example_start, example_end):
+        qa_id = examples_all.qa_id(example_index)
+        # the features of the example, relative to the block
+        features_start = example_features[example_index] - feature_start
+        features_end = example_features[example_index + 1] - feature_start
+        lo, hi = np.searchsorted(candidates[0], [features_start, features_end])
+        feature_indexes, start_indexes, end_indexes, start_log_probs, end_log_probs = (
+            c[lo:hi] for c in candidates
+        )
+
+        # keep track of the minimum score of null start+end of position 0
+        score_null = 1000000  # large and positive
+
+        # if we could have irrelevant answers, get the min score of irrelevant
+        if features_end > features_start:
+            score_null = min(score_null, float(cls_logits[features_start:features_end].min()))
+
+        order = np.argsort(-(start_log_probs + end_log_probs), kind="stable")
+
+        seen_predictions = {}
+        nbest = []
+        for i in order:
+            if len(nbest) >= n_best_size:
+                break
+            pred = _PrelimPrediction(
+                feature_index=int(feature_indexes[i]),
+                start_index=int(start_indexes[i]),
+                end_index=int(end_indexes[i]),
+                start_logit=float(start_log_probs[i]),
+                end_logit=float(end_log_probs[i]),
+            )
+            feature = features_all[feature_start + pred.feature_index]
+
+            # XLNet un-tokenizer
+            # Let's keep it simple for now and see if we need all this later.
+            #
+            # tok_start_to_orig_index = feature.tok_start_to_orig_index
+            # tok_end_to_orig_index = feature.tok_end_to_orig_index
+            # start_orig_pos = tok_start_to_orig_index[pred.start_index]
+            # end_orig_pos = tok_end_to_orig_index[pred.end_index]
+            # paragraph_text = example.paragraph_text
+            # final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
+
+            # Previously used Bert untokenizer
+            tok_tokens = feature.tokens(pred.start_index, pred.end_index + 1)
+            orig_doc_start = feature.orig_index(pred.start_index)
+            orig_doc_end = feature.orig_index(pred.end_index)
+            orig_tokens = examples_all.doc_tokens(example_index, orig_doc_start, orig_doc_end + 1)
+            tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
+
+            # Clean whitespace
+            tok_text = tok_text.strip()
+            tok_text = " ".join(tok_text.split())
+            orig_text = " ".join(orig_tokens)
+
+            final_text = _get_final_text(
+                tok_text, orig_text, tokenizer.do_lower_case, verbose_logging
+            )
+
+            if final_text in seen_predictions:
+                continue
+
+            seen_predictions[final_text] = True
+
+            nbest.append(
+                _NbestPrediction(
+                    text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit
+                )
+            )
 
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+        # In very rare edge cases we could have no valid predictions. So we
+        # just create a nonce prediction in this case to avoid failure.
+        if not nbest:
+            nbest.append(_NbestPrediction(text="", start_logit=-1e6, end_logit=-1e6))
+
+        total_scores = []
+        best_non_null_entry = None
+        for ie, entry in enumerate(nbest):
+            total_scores.append(entry.start_logit + entry.end_logit)
+            if not best_non_null_entry:
+                best_non_null_entry = entry
+                best_non_null_entry_index = ie
+
+        probs = _compute_softmax(total_scores)
+
+        nbest_json = []
+        for (i, entry) in enumerate(nbest):
+            output = collections.OrderedDict()
+            output["text"] = entry.text
+            output["probability"] = probs[i]
+            output["start_logit"] = entry.start_logit
+            output["end_logit"] = entry.end_logit
+            nbest_json.append(output)
+
+        assert len(nbest_json) >= 1
+        assert best_non_null_entry is not None
+
+        # note(zhiliny): always predict best_non_null_entry
+        # and the evaluation script will search for the best threshold
+        yield QAAnswer(
+            qa_id=qa_id,
+            text=best_non_null_entry.text,
+            probability=probs[best_non_null_entry_index],
+            nbest=nbest_json,
+            null_odds=score_null,
+        )
+
+
+def _stack_rows(rows, width=None, fill_value=-np.inf, dtype=np.float64):
+    """
+    Stacks lists or 1D arrays into a 2D array, with rows truncated to `width` values or padded
+    with `fill_value` to the length of the longest row.
+    """
+    if width is None:
+        width = max([len(row) for row in rows] + [1])
+    stacked = np.full((len(rows), width), fill_value, dtype=dtype)
+    for i, row in enumerate(rows):
+        row = row[:width]
+        stacked[i, : len(row)] = row
+    return stacked
+
+
+def _get_bert_candidates(
+    features_all, feature_start, start_logits, end_logits, n_best_size, max_answer_length
+):
+    """
+    Searches the candidate answer spans of consecutive features for BERT, the valid spans
+    between the `n_best_size` largest start logits and end logits of each feature.
+
+    Args:
+        features_all (QAFeatureStore): Store of the features.
+        feature_start (int): Index of the first feature in the store.
+        start_logits (numpy.ndarray): Start logits of the features, of shape
+            (num_features, seq_len).
+        end_logits (numpy.ndarray): End logits of the features, of shape (num_features, seq_len).
+        n_best_size (int): Number of start and end logits of each feature to combine.
+        max_answer_length (int): Maximum length of the answer.
+
+    Returns:
+        tuple: Arrays of the feature indices, relative to `feature_start`, start indices, end
+            indices, start logits and end logits of the candidates, ordered by feature, then by
+            descending start and end logits.
+    """
+    feature_end = feature_start + len(start_logits)
+    start_indexes = _get_best_indexes(start_logits, n_best_size)
+    end_indexes = _get_best_indexes(end_logits, n_best_size)
+
+    # We could hypothetically create invalid predictions, e.g., predict
+    # that the start of the span is in the question. We throw out all
+    # invalid predictions. The document tokens are before the padding.
+    is_valid_start = features_all.max_context_mask(feature_start, feature_end, start_indexes)
+    is_valid_end = features_all.doc_token_mask(feature_start, feature_end, end_indexes)
+    lengths = end_indexes[:, None, :] - start_indexes[:, :, None] + 1
+    is_valid = (
+        is_valid_start[:, :, None]
+        & is_valid_end[:, None, :]
+        & (lengths >= 1)
+        & (lengths <= max_answer_length)
+    )
+
+    feature_indexes, start_ranks, end_ranks = np.nonzero(is_valid)
+    start_indexes = start_indexes[feature_indexes, start_ranks]
+    end_indexes = end_indexes[feature_indexes, end_ranks]
+    return (
+        feature_indexes,
+        start_indexes,
+        end_indexes,
+        start_logits[feature_indexes, start_indexes],
+        end_logits[feature_indexes, end_indexes],
+    )
+
+
+def _get_xlnet_candidates(
+    features_all,
+    feature_start,
+    start_top_log_probs,
+    start_top_index,
+    end_top_log_probs,
+    end_top_index,
+    max_answer_length,
+):
+    """
+    Searches the candidate answer spans of consecutive features for XLNet, the valid spans of
+    the beam search of each feature.
+
+    Args:
+        features_all (QAFeatureStore): Store of the features.
+        feature_start (int): Index of the first feature in the store.
+        start_top_log_probs (numpy.ndarray): Start log probabilities of the features, of shape
+            (num_features, n_top_start).
+        start_top_index (numpy.ndarray): Start indices of the features, of shape
+            (num_features, n_top_start).
+        end_top_log_probs (numpy.ndarray): End log probabilities of the features for each start,
+            of shape (num_features, n_top_start, n_top_end).
+        end_top_index (numpy.ndarray): End indices of the features for each start, of shape
+            (num_features, n_top_start, n_top_end).
+        max_answer_length (int): Maximum length of the answer.
+
+    Returns:
+        tuple: Arrays of the feature indices, relative to `feature_start`, start indices, end
+            indices, start log probabilities and end log probabilities of the candidates, in the
+            order of the beam search of the features.
+    """
+    feature_end = feature_start + len(start_top_index)
+    paragraph_lens = features_all.paragraph_lens[feature_start:feature_end]
+
+    # We could hypothetically create invalid predictions, e.g., predict
+    # that the start of the span is in the question. We throw out all
+    # invalid predictions.
+    is_valid_start = (start_top_index < paragraph_lens[:, None] - 1) & (
+        features_all.max_context_mask(feature_start, feature_end, start_top_index)
+    )
+    is_valid_end = end_top_index < paragraph_lens[:, None, None] - 1
+    lengths = end_top_index - start_top_index[:, :, None] + 1
+    is_valid = (
+        is_valid_start[:, :, None] & is_valid_end & (lengths >= 1) & (lengths <= max_answer_length)
+    )
+
+    feature_indexes, start_ranks, end_ranks = np.nonzero(is_valid)
+    return (
+        feature_indexes,
+        start_top_index[feature_indexes, start_ranks],
+        end_top_index[feature_indexes, start_ranks, end_ranks],
+        start_top_log_probs[feature_indexes, start_ranks],
+        end_top_log_probs[feature_indexes, start_ranks, end_ranks],
+    )
+
+
+def _get_best_indexes(logits, n_best_size):
+    """
+    Get the indexes of the n-best logits of each row of a 2D array, in descending order of the
+    logits.
+    """
+    n_best_size = max(0, min(n_best_size, logits.shape[1]))
+    # a stable sort breaks ties by index, also across the n-best boundary, which a partition
+    # doesn't, and the rows are at most as long as the sequences
+    return np.argsort(-logits, axis=1, kind="stable")[:, :n_best_size]
 
 
 def _compute_softmax(scores):
     """Compute softmax probability over raw logits."""
-    if not scores:
+    if len(scores) == 0:
         return []
 
-    max_score = None
-    for score in scores:
-        if max_score is None or score > max_score:
-            max_score = score
-
-    exp_scores = []
-    total_sum = 0.0
-    for score in scores:
-        x = math.exp(score - max_score)
-        exp_scores.append(x)
-        total_sum += x
-
-    probs = []
-    for score in exp_scores:
-        probs.append(score / total_sum)
-    return probs
+    scores = np.asarray(scores, dtype=np.float64)
+    exp_scores = np.exp(scores - scores.max())
+    return (exp_scores / exp_scores.sum()).tolist()
 
 
 # Post processing helper functions end
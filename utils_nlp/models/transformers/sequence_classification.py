@@ -1,6 +1,8 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import contextlib
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -25,7 +27,9 @@ from transformers.modeling_xlnet import (
 )
 from utils_nlp.common.pytorch_utils import get_device
 from utils_nlp.models.transformers.common import MAX_SEQ_LEN, TOKENIZER_CLASS, Transformer
-from utils_nlp.models.transformers.datasets import SCDataSet, SPCDataSet
+from utils_nlp.models.transformers.datasets import SCDataSet, SPCDataSet, TokenizedDataSet
+from utils_nlp.models.transformers.inference_autotuner import apply_inference_config
+from utils_nlp.models.transformers.memmap_predictions import write_predictions_to_memmap
 
 
 MODEL_CLASS = {}
@@ -64,15 +68,16 @@ class Processor:
     @staticmethod
     def text_transform(text, tokenizer, max_len=MAX_SEQ_LEN):
         """preprocess text"""
+        return Processor.tokens_transform(tokenizer.tokenize(text), tokenizer, max_len)
+
+    @staticmethod
+    def tokens_transform(text_tokens, tokenizer, max_len=MAX_SEQ_LEN):
+        """preprocess tokenized text"""
         if max_len > MAX_SEQ_LEN:
             print("setting max_len to max allowed sequence length: {}".format(MAX_SEQ_LEN))
             max_len = MAX_SEQ_LEN
         # truncate and add CLS & SEP markers
-        tokens = (
-            [tokenizer.cls_token]
-            + tokenizer.tokenize(text)[0 : max_len - 2]
-            + [tokenizer.sep_token]
-        )
+        tokens = [tokenizer.cls_token] + text_tokens[0 : max_len - 2] + [tokenizer.sep_token]
         # get input ids
         input_ids = tokenizer.convert_tokens_to_ids(tokens)
         # pad sequence
@@ -87,6 +92,13 @@ class Processor:
     @staticmethod
     def text_pair_transform(text_1, text_2, tokenizer, max_len=MAX_SEQ_LEN):
         """preprocess data or batches"""
+        return Processor.tokens_pair_transform(
+            tokenizer.tokenize(text_1), tokenizer.tokenize(text_2), tokenizer, max_len
+        )
+
+    @staticmethod
+    def tokens_pair_transform(text_tokens_1, text_tokens_2, tokenizer, max_len=MAX_SEQ_LEN):
+        """preprocess tokenized text pairs"""
 
         def _truncate_seq_pair(tokens_a, tokens_b, max_length):
             """Truncates a sequence pair in place to the maximum length."""
@@ -119,9 +131,10 @@ class Processor:
             print("setting max_len to max allowed tokens: {}".format(MAX_SEQ_LEN))
             max_len = MAX_SEQ_LEN
 
-        tokens_1 = tokenizer.tokenize(text_1)
+        # copy the token lists, they are truncated in place
+        tokens_1 = list(text_tokens_1)
 
-        tokens_2 = tokenizer.tokenize(text_2)
+        tokens_2 = list(text_tokens_2)
 
         tokens_1, tokens_2 = _truncate_seq_pair(tokens_1, tokens_2, max_len - 3)
 
@@ -152,8 +165,48 @@ class Processor:
         batch_size=32,
         num_gpus=None,
         distributed=False,
+        cache_tokens=False,
     ):
-        if text2_col is None:
+        """
+        Creates a dataloader for sequence or sequence pair classification from a data frame.
+
+        Args:
+            df (pandas.DataFrame): Input data frame.
+            text_col (str or int): Column containing the texts.
+            label_col (str or int, optional): Column containing the labels. Defaults to None.
+            text2_col (str or int, optional): Column containing the second texts of sequence
+                pairs. Defaults to None.
+            shuffle (bool, optional): Whether to shuffle the data. Defaults to False.
+            max_len (int, optional): Maximum number of tokens per sample. Defaults to MAX_SEQ_LEN.
+            batch_size (int, optional): Batch size per GPU. Defaults to 32.
+            num_gpus (int, optional): The number of GPUs. Defaults to None, all available GPUs.
+            distributed (bool, optional): Whether to use a distributed sampler. Defaults to False.
+            cache_tokens (bool, optional): Whether to tokenize all texts once when the dataloader
+                is created. The dataset then truncates the cached tokens on access and its
+                maximum length can be changed with `dataset.set_max_len`, which is used by the
+                `max_len_schedule` of :meth:`SequenceClassifier.fit`. Defaults to False, texts are
+                tokenized on access.
+
+        Returns:
+            DataLoader: The dataloader.
+        """
+        if cache_tokens:
+            if text2_col is None:
+                text_cols = [text_col]
+                transform = Processor.tokens_transform
+            else:
+                text_cols = [text_col, text2_col]
+                transform = Processor.tokens_pair_transform
+            ds = TokenizedDataSet(
+                df,
+                text_cols,
+                label_col,
+                tokenize=self.tokenizer.tokenize,
+                transform=transform,
+                max_len=max_len,
+                tokenizer=self.tokenizer,
+            )
+        elif text2_col is None:
             ds = SCDataSet(
                 df,
                 text_col,
@@ -187,12 +240,15 @@ class Processor:
 
 
 class SequenceClassifier(Transformer):
-    def __init__(self, model_name="bert-base-cased", num_labels=2, cache_dir="."):
+    def __init__(
+        self, model_name="bert-base-cased", num_labels=2, cache_dir=".", load_model_from_dir=None
+    ):
         super().__init__(
             model_class=MODEL_CLASS,
             model_name=model_name,
             num_labels=num_labels,
             cache_dir=cache_dir,
+            load_model_from_dir=load_model_from_dir,
         )
 
     @staticmethod
@@ -211,9 +267,44 @@ class SequenceClassifier(Transformer):
         warmup_steps=0,
         verbose=True,
         seed=None,
+        max_len_schedule=None,
+        val_dataloader=None,
+        val_metric=None,
+        validation_steps=None,
+        early_stopping_patience=None,
+        best_model_dir=None,
+        bf16=False,
+        shard_optimizer_state=False,
+        validation_callback=None,
     ):
         """
         Fine-tunes a pre-trained sequence classification model.
+
+        Args:
+            max_len_schedule (list, optional): Maximum sequence length of each epoch, e.g.
+                [128, 128, 512]. The last value is used for the remaining epochs. Requires a
+                dataloader created with `cache_tokens=True`. Defaults to None, the dataloader's
+                `max_len` is used for all epochs.
+            val_dataloader (DataLoader, optional): Dataloader of labeled validation data. If
+                provided, the model is evaluated during training and the weights with the best
+                validation score are restored at the end. Defaults to None.
+            val_metric (function, optional): Function taking the true and predicted labels and
+                returning a score to maximize, e.g. `sklearn.metrics.accuracy_score`. Defaults to
+                None, the negative validation loss is used.
+            validation_steps (int, optional): Number of optimization steps between evaluations.
+                Defaults to None, the model is evaluated at the end of each epoch.
+            early_stopping_patience (int, optional): Number of evaluations without improvement
+                after which training stops. Defaults to None, no early stopping.
+            best_model_dir (str, optional): Directory to save the best model to. Defaults to
+                None, the best weights are kept in CPU memory.
+            bf16 (bool, optional): Whether to run the forward passes with bfloat16 autocast on
+                CPU. The loss and the optimizer stay in float32. Defaults to False.
+            shard_optimizer_state (bool, optional): Whether to divide the AdamW state across the
+                processes of distributed training, each process updating its shard of the
+                parameters. Requires `local_rank` != -1. Defaults to False.
+            validation_callback (function, optional): Function called with the step and the
+                score after each evaluation on `val_dataloader`. Training stops if it returns
+                True, e.g. to prune a hyperparameter trial. Defaults to None.
         """
 
         device, num_gpus = get_device(num_gpus=num_gpus, local_rank=local_rank)
@@ -234,23 +325,84 @@ class SequenceClassifier(Transformer):
             warmup_steps=warmup_steps,
             verbose=verbose,
             seed=seed,
+            max_len_schedule=max_len_schedule,
+            val_dataloader=val_dataloader,
+            val_metric=val_metric,
+            validation_steps=validation_steps,
+            early_stopping_patience=early_stopping_patience,
+            best_model_dir=best_model_dir,
+            bf16=bf16,
+            shard_optimizer_state=shard_optimizer_state,
+            validation_callback=validation_callback,
         )
 
-    def predict(self, eval_dataloader, num_gpus=1, verbose=True):
+    def predict(
+        self,
+        eval_dataloader,
+        num_gpus=1,
+        verbose=True,
+        bf16=False,
+        inference_config=None,
+        output_prefix=None,
+        outputs=("preds",),
+        top_k=5,
+        logits_dtype=np.float32,
+    ):
+        """
+        Predicts the labels of an evaluation dataset.
+
+        Args:
+            eval_dataloader (DataLoader): Evaluation dataloader.
+            num_gpus (int, optional): The number of GPUs to use. Defaults to 1.
+            verbose (bool, optional): Whether to show a progress bar. Defaults to True.
+            bf16 (bool, optional): Whether to run the model with bfloat16 autocast on CPU.
+                Defaults to False.
+            inference_config (str or dict, optional): Configuration saved by
+                :func:`utils_nlp.models.transformers.inference_autotuner.autotune_cpu_inference`,
+                applied on CPU. Defaults to None.
+            output_prefix (str, optional): Path prefix of memory-mapped output files. If
+                provided, the outputs are written batch by batch instead of being kept in memory,
+                see the `write_predictions_to_memmap` function of
+                :mod:`utils_nlp.models.transformers.memmap_predictions`. Defaults to None.
+            outputs (list, optional): Outputs written to the memory-mapped files, among "logits",
+                "preds" and "top_k". Defaults to ("preds",).
+            top_k (int, optional): Number of labels of the "top_k" output. Defaults to 5.
+            logits_dtype (dtype, optional): Dtype of the "logits" output. Defaults to
+                numpy.float32.
+
+        Returns:
+            ndarray or dict: Predicted labels, or if `output_prefix` is provided, a dictionary
+                of memory-mapped arrays.
+        """
         device, num_gpus = get_device(num_gpus=num_gpus, local_rank=-1)
         if isinstance(self.model, nn.DataParallel):
             self.model.module.to(device)
         else:
             self.model.to(device)
 
-        preds = list(
-            super().predict(
+        with contextlib.ExitStack() as stack:
+            if inference_config is not None and device.type == "cpu":
+                # number of threads and batch size tuned by autotune_cpu_inference, until the
+                # predictions are done
+                eval_dataloader = stack.enter_context(
+                    apply_inference_config(inference_config, eval_dataloader)
+                )
+            batches = super().predict(
                 eval_dataloader=eval_dataloader,
                 get_inputs=Processor.get_inputs,
                 device=device,
                 verbose=verbose,
+                bf16=bf16,
             )
-        )
-        preds = np.concatenate(preds)
+            if output_prefix is not None:
+                return write_predictions_to_memmap(
+                    batches,
+                    len(eval_dataloader.dataset),
+                    output_prefix,
+                    outputs=outputs,
+                    top_k=top_k,
+                    logits_dtype=logits_dtype,
+                )
+            preds = np.concatenate(list(batches))
         # todo generator & probs
         return np.argmax(preds, axis=1)
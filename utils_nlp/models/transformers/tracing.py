@@ -0,0 +1,205 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""TorchScript tracing of transformer models at a fixed set of input shapes."""
+
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# values used to pad the sequence dimension of each model input
+PAD_VALUES = {"input_ids": 0, "attention_mask": 0, "token_type_ids": 0, "p_mask": 1}
+
+
+class _PositionalWrapper(torch.nn.Module):
+    """Exposes a model taking keyword inputs as a module taking positional tensors."""
+
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *args):
+        return self.model(**dict(zip(self.input_names, args)))
+
+
+def pad_inputs(inputs, batch_size, seq_len):
+    """
+    Pads a dictionary of model inputs to a given batch size and sequence length.
+
+    Rows are appended by repeating the existing rows, so that the padded batch contains realistic
+    values, and the sequence dimension is padded with the values in `PAD_VALUES`. Inputs longer
+    than `seq_len` are truncated.
+
+    Args:
+        inputs (dict): Dictionary of input tensors as returned by the `get_inputs` method of the
+            processors, e.g.
+            :meth:`utils_nlp.models.transformers.sequence_classification.Processor.get_inputs`.
+        batch_size (int): Target batch size.
+        seq_len (int): Target sequence length.
+
+    Returns:
+        dict: Dictionary of padded input tensors.
+    """
+    cur_seq_len = inputs["input_ids"].size(1)
+    padded = {}
+    for name, tensor in inputs.items():
+        if tensor.size(0) < batch_size:
+            repeats = -(-batch_size // tensor.size(0))
+            tensor = tensor.repeat(repeats, *([1] * (tensor.dim() - 1)))
+        tensor = tensor[:batch_size]
+        if tensor.dim() > 1 and tensor.size(1) == cur_seq_len:
+            if cur_seq_len < seq_len:
+                pad = tensor.new_full(
+                    (tensor.size(0), seq_len - cur_seq_len) + tuple(tensor.shape[2:]),
+                    PAD_VALUES.get(name, 0),
+                )
+                tensor = torch.cat([tensor, pad], dim=1)
+            else:
+                tensor = tensor[:, :seq_len]
+        padded[name] = tensor.contiguous()
+    return padded
+
+
+def _as_tuple(outputs):
+    return (outputs,) if isinstance(outputs, torch.Tensor) else tuple(outputs)
+
+
+def _max_abs_diff(outputs_a, outputs_b):
+    return max((a.float() - b.float()).abs().max().item() for a, b in zip(outputs_a, outputs_b))
+
+
+class BucketedTracedModel:
+    """
+    Runs a transformer model through TorchScript traces taken at a small set of
+    (batch size, sequence length) buckets.
+
+    Each call pads the inputs to the smallest bucket that fits them, runs the trace of that bucket
+    and slices the outputs back to the original shape. Inputs that don't fit in any bucket are
+    run by the eager model. All buckets are warmed up when the traces are created, so that the
+    first requests don't pay the TorchScript optimization cost.
+
+    Args:
+        model (torch.nn.Module): The model to trace. It's set to evaluation mode.
+        example_inputs (dict): Dictionary of input tensors, e.g. the output of the processor's
+            `get_inputs` for one batch of the evaluation data. They are padded to each bucket to
+            create the tracing inputs.
+        buckets (list): List of (batch_size, seq_len) tuples.
+        num_warmup (int, optional): Number of forward passes run on each bucket after tracing.
+            Defaults to 2.
+        validate (bool, optional): Whether to compare the traced outputs with the eager outputs
+            on each bucket. Defaults to True.
+        rtol (float, optional): Relative tolerance of the validation. Defaults to 1e-3.
+        atol (float, optional): Absolute tolerance of the validation. Defaults to 1e-4.
+    """
+
+    def __init__(
+        self, model, example_inputs, buckets, num_warmup=2, validate=True, rtol=1e-3, atol=1e-4
+    ):
+        if not buckets:
+            raise ValueError("At least one (batch_size, seq_len) bucket must be provided.")
+
+        self.model = model
+        self.input_names = list(example_inputs)
+        self.buckets = sorted(set(tuple(b) for b in buckets), key=lambda b: (b[0] * b[1], b))
+        self.device = example_inputs["input_ids"].device
+        self.traces = {}
+
+        wrapper = _PositionalWrapper(model, self.input_names)
+        model.eval()
+        with torch.no_grad():
+            for bucket in self.buckets:
+                inputs = pad_inputs(example_inputs, *bucket)
+                args = tuple(inputs[k] for k in self.input_names)
+                trace = torch.jit.trace(wrapper, args, check_trace=False)
+                for _ in range(num_warmup):
+                    trace_outputs = trace(*args)
+                if validate:
+                    trace_outputs = trace(*args)
+                    eager_outputs = model(**inputs)
+                    for traced, eager in zip(trace_outputs, eager_outputs):
+                        if not torch.allclose(traced, eager, rtol=rtol, atol=atol):
+                            raise RuntimeError(
+                                "Traced model outputs differ from the eager model outputs for "
+                                "bucket {0}, max absolute difference {1}.".format(
+                                    bucket, _max_abs_diff(trace_outputs, eager_outputs)
+                                )
+                            )
+                self.traces[bucket] = trace
+                logger.info("Traced model for bucket {}".format(bucket))
+            self.sequence_outputs = self._find_sequence_outputs(model, example_inputs)
+
+    def _find_sequence_outputs(self, model, example_inputs):
+        """
+        Returns whether each output has a sequence dimension, i.e. a second dimension that
+        follows the sequence length of the inputs, from the output shapes at two lengths.
+        """
+        lengths = sorted(set(b[1] for b in self.buckets))
+        if len(lengths) == 1:
+            if lengths[0] == 1:
+                # the inputs are never shorter than the bucket, nothing is sliced
+                return None
+            lengths.insert(0, lengths[0] - 1)
+        short_len, long_len = lengths[0], lengths[-1]
+        short_outputs = _as_tuple(model(**pad_inputs(example_inputs, 1, short_len)))
+        long_outputs = _as_tuple(model(**pad_inputs(example_inputs, 1, long_len)))
+        return [
+            short.dim() > 1 and short.size(1) == short_len and long.size(1) == long_len
+            for short, long in zip(short_outputs, long_outputs)
+        ]
+
+    def runs_on(self, device):
+        """
+        Returns whether the traces run on `device`. A CUDA device without index is the current
+        CUDA device.
+        """
+        device = torch.device(device)
+        if device.type != self.device.type:
+            return False
+        if device.type != "cuda":
+            return True
+        current = torch.cuda.current_device()
+        index = current if device.index is None else device.index
+        return index == (current if self.device.index is None else self.device.index)
+
+    def get_bucket(self, batch_size, seq_len):
+        """Returns the smallest bucket fitting the given shape, or None if none fits."""
+        for bucket in self.buckets:
+            if bucket[0] >= batch_size and bucket[1] >= seq_len:
+                return bucket
+        return None
+
+    def __call__(self, inputs):
+        """
+        Runs the model on a batch of inputs.
+
+        Args:
+            inputs (dict): Dictionary of input tensors with the same keys as `example_inputs`.
+
+        Returns:
+            tuple: The model outputs for the unpadded inputs.
+        """
+        batch_size, seq_len = inputs["input_ids"].shape[:2]
+        bucket = self.get_bucket(batch_size, seq_len)
+        if bucket is None:
+            logger.warning(
+                "Input shape {} doesn't fit any bucket, running the eager model.".format(
+                    (batch_size, seq_len)
+                )
+            )
+            return self.model(**inputs)
+
+        padded = pad_inputs(inputs, *bucket)
+        outputs = _as_tuple(self.traces[bucket](*(padded[k] for k in self.input_names)))
+
+        # per-token outputs, e.g. token classification logits or answer start/end logits, are
+        # sliced back to the original sequence length
+        unpadded = []
+        for i, out in enumerate(outputs):
+            out = out[:batch_size]
+            if self.sequence_outputs and self.sequence_outputs[i] and bucket[1] != seq_len:
+                out = out[:, :seq_len]
+            unpadded.append(out)
+        return tuple(unpadded)